@@ -1,42 +1,174 @@
-import pandas as pd
 import numpy as np
+import json
 import logging
+import os
+import time
+from collections import OrderedDict
 
-import tensorflow as tf
-from tensorflow import keras
-from tensorflow.keras.layers import Dense, LSTM, Bidirectional
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.callbacks import EarlyStopping
+# Tensorflow is imported only to build and fit models, trained models are scored by BiLSTM in NumPy
+from bilstm import BiLSTM
+
+MODEL_CACHE_SIZE = 256
+MODEL_CACHE_BYTES = 256 * 1024 * 1024
+FINE_TUNE_EPOCHS = 3
+# Keras session is cleared after this many models are built for the cache, along with the cache itself
+CLEAR_SESSION_BUILDS = 4 * MODEL_CACHE_SIZE
+# Most series of a metric family the family model is trained on
+TRAIN_SERIES = 64
+
+
+class CachedModel(object):
+    def __init__(self, model, count):
+        self.model = model
+        # Samples ever appended to the series when the model was last trained, it keeps growing
+        # when the series is cut to a window, unlike the length of the series
+        self.count = count
+        # Weights and two Adam moments for every parameter
+        self.nbytes = model.count_params() * 4 * 3
+
+
+# Compiled models kept between confirmation passes, keyed by (metric, samples, features).
+# Least recently used models are evicted when there are too many of them or they take too much memory.
+class ModelCache(object):
+    def __init__(self, max_models=MODEL_CACHE_SIZE, max_bytes=MODEL_CACHE_BYTES):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()
+        self.nbytes = 0
+        # Models built since the Keras session was cleared
+        self.builds = 0
+
+    def __len__(self):
+        return len(self.models)
+
+    def get(self, key):
+        entry = self.models.get(key)
+        if entry is not None:
+            self.models.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        # Models for other input shapes of the same metric are not going to be used anymore
+        for old_key in [k for k in self.models if k[0] == key[0]]:
+            self.discard(old_key)
+        self.models[key] = entry
+        self.nbytes += entry.nbytes
+        while len(self.models) > 1 and (len(self.models) > self.max_models or self.nbytes > self.max_bytes):
+            self.discard(next(iter(self.models)))
+
+    def discard(self, key):
+        entry = self.models.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+
+    def clear(self):
+        self.models.clear()
+        self.nbytes = 0
+        self.builds = 0
+
+
+class TrainedModel(object):
+    def __init__(self, model, samples_n, features_n):
+        self.model = model
+        self.samples_n = samples_n
+        self.features_n = features_n
+
+
+# Models trained on the reference series, one for every metric family, kept in a dir next to the reference file.
+# The index is replaced only after all the models of a training are saved, so it always points to complete models.
+# Only the weights are saved, they are loaded into BiLSTM.
+class ModelStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.models = {}
+        self.mtime = None
+
+    def index_path(self):
+        return os.path.join(self.path, 'index.json')
+
+    # Loads the models if they were trained since the last call
+    def refresh(self):
+        try:
+            mtime = os.path.getmtime(self.index_path())
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        with open(self.index_path()) as f:
+            index = json.load(f)
+        models = {}
+        for family, info in index.items():
+            model = BiLSTM.load(os.path.join(self.path, info['file']))
+            models[family] = TrainedModel(model, info['samples'], info['features'])
+        self.models = models
+        self.mtime = mtime
+        logging.info("Loaded %s trained models from %s", str(len(models)), self.path)
+
+    def get(self, family):
+        return self.models.get(family)
+
+    def save(self, models):
+        os.makedirs(self.path, exist_ok=True)
+        generation = str(int(time.time() * 1000))
+        index = {}
+        for n, (family, trained) in enumerate(models.items()):
+            fname = 'model-' + generation + '-' + str(n) + '.npz'
+            model = trained.model if isinstance(trained.model, BiLSTM) else BiLSTM.from_model(trained.model)
+            model.save(os.path.join(self.path, fname))
+            index[family] = {'file': fname, 'samples': trained.samples_n, 'features': trained.features_n}
+        with open(self.index_path() + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(self.index_path() + '.tmp', self.index_path())
+        for fname in os.listdir(self.path):
+            if fname.startswith('model-') and not fname.startswith('model-' + generation + '-'):
+                os.remove(os.path.join(self.path, fname))
+        self.models = models
 
 
 class AnomalyDetection(object):
-    def __init__(self, base_sample_size, msx=[1]): #, 0.75, 1.25]):
+    def __init__(self, base_sample_size, msx=[1], cache=None): #, 0.75, 1.25]):
         self.kernel_n = base_sample_size
         self.msx = msx
+        self.cache = cache
 
-    def find_anomalies(self, series, bins=[2, 3, 4], verbose=0):
-        X = self.__Z_scale(series)
+    # Key identifies the series in the model cache, models trained on the previous versions
+    # of the series are fine-tuned on the new samples instead of training from scratch.
+    # Count is the number of samples ever appended to the series, the length of the series by default
+    def find_anomalies(self, series, bins=[2, 3, 4], verbose=0, key=None, count=None):
+        return self.find_anomalies_batch([series], bins, verbose, key, count=count)[0]
 
-        if np.count_nonzero(X) == 0:
-            return {}, {}, {}
+    # Series of the same length are stacked and reconstructed by one model trained on all of them,
+    # returns (samples, ranges, positions) of every series.
+    # With a trained model the last samples of the series are only reconstructed by it, without any training
+    def find_anomalies_batch(self, series, bins=[2, 3, 4], verbose=0, key=None, trained=None, count=None):
+        X = np.array([self.__Z_scale(np.asarray(ts, dtype=float)) for ts in series])
+        results = [({}, {}, {}) for ts in series]
+        nonzero = [i for i in range(len(X)) if np.count_nonzero(X[i]) != 0]
+        if len(nonzero) == 0:
+            return results
+        X = X[nonzero]
 
-        min_norm = 10 ** 6
-        min_idx = 0
-        X_pred_final = None
+        min_norm = np.full(len(X), 10.0 ** 6)
+        min_idx = np.zeros(len(X))
+        X_pred_final = [None] * len(X)
         for i in self.msx:
             current_sample_n = int(self.kernel_n * i)
-            X_pred, offset = self.__reconstruct(X, current_sample_n, verbose)
-            norma = np.linalg.norm(X[offset:] - X_pred)
+            X_pred, offset = self.__reconstruct(X, current_sample_n, verbose=verbose, key=key, trained=trained, count=count)
+            norma = np.linalg.norm(X[:, offset:] - X_pred, axis=-1)
 
-            if norma < min_norm:
-                min_norm = norma
-                min_idx = i
-                X_pred_final = X_pred
+            for n in np.flatnonzero(norma < min_norm):
+                min_norm[n] = norma[n]
+                min_idx[n] = i
+                X_pred_final[n] = X_pred[n]
 
-        if min_idx == 0:
+        if np.any(min_idx == 0):
             raise Exception('Norm is to high for reconstructed TS')
 
+        for n, i in enumerate(nonzero):
+            results[i] = self.__score(X[n], X_pred_final[n], min_idx[n], bins)
+        return results
 
+    def __score(self, X, X_pred_final, min_idx, bins):
         samples_n = int(self.kernel_n * min_idx)
         features_n = int(X_pred_final.shape[0] / samples_n)
         offset = X.shape[0] - X_pred_final.shape[0]
@@ -75,29 +207,86 @@ class AnomalyDetection(object):
         std = X.std()
         return (X - mean) / (std + 0.00001)
 
-    def __reconstruct(self, X, samples_n, epochs_n=40, verbose=0):
-        features_n = int(X.shape[0] / samples_n)
-        offset = X.shape[0] % samples_n
-
-        logging.debug('Smaples = {}, feaures = {}, offset = {}'.format(samples_n, features_n, offset))
-        X = X[offset:]
-
-        X = X.reshape(samples_n, features_n)
-        keras.backend.clear_session()
+    def __build(self, features_n):
+        from tensorflow.keras.layers import Dense, LSTM, Bidirectional
+        from tensorflow.keras.models import Sequential
         model = Sequential()
         model.add(Bidirectional(LSTM(units=32, dropout=0.2, recurrent_dropout=0.2), input_shape=(features_n, 1)))
         model.add(Dense(features_n, activation='linear'))
         model.compile(optimizer='adam', loss='mean_squared_error', metrics=['mean_absolute_error'])
+        return model
+
+    # Trains a model for every family on its series, families is a dict of family -> list of series of the same length
+    def train(self, families, epochs_n=40, verbose=0):
+        from tensorflow.keras.callbacks import EarlyStopping
+        models = {}
+        samples_n = self.kernel_n
+        for family, series in families.items():
+            X = np.array([self.__Z_scale(np.asarray(ts, dtype=float)) for ts in series[:TRAIN_SERIES]])
+            X = X[np.count_nonzero(X, axis=1) > 0]
+            if len(X) == 0:
+                continue
+            features_n = int(X.shape[1] / samples_n)
+            X = X[:, X.shape[1] - samples_n * features_n:].reshape(-1, features_n)
+            logging.info('Training model of {} on {} series, samples = {}, features = {}'.format(family, len(X) // samples_n, samples_n, features_n))
+            model = self.__build(features_n)
+            model.fit(x=np.expand_dims(X, axis=2), y=X, batch_size=16, epochs=epochs_n, validation_split=0.1, verbose=verbose,
+                      callbacks=[EarlyStopping(patience=2)])
+            models[family] = TrainedModel(model, samples_n, features_n)
+        return models
+
+    # X is a (series, length) array, rows of all the series are fitted and predicted together
+    def __reconstruct(self, X, samples_n, epochs_n=40, verbose=0, key=None, trained=None, count=None):
+        columns_n, length = X.shape
+        if count is None:
+            count = length
+        if trained is not None:
+            # Only the last samples fitting the trained model are reconstructed
+            features_n = trained.features_n
+            offset = length - samples_n * features_n
+            X = X[:, offset:].reshape(-1, features_n)
+            pts = trained.model.predict(np.expand_dims(X, axis=2), verbose=verbose)
+            return pts.reshape(columns_n, -1), offset
+        from tensorflow import keras
+        from tensorflow.keras.callbacks import EarlyStopping
+        features_n = int(length / samples_n)
+        offset = length % samples_n
+
+        logging.debug('Smaples = {}, feaures = {}, offset = {}, series = {}'.format(samples_n, features_n, offset, columns_n))
+        X = X[:, offset:]
 
-        dts = np.expand_dims(X, axis=2)
-        model.fit(x=dts, y=X, batch_size=16, epochs=epochs_n, validation_split=0.1, verbose=verbose,
-                  callbacks=[EarlyStopping(patience=2)])
+        X = X.reshape(columns_n, samples_n, features_n)
+        cache_key = (key, samples_n, features_n)
+        entry = self.cache.get(cache_key) if self.cache is not None and key is not None else None
+        if entry is None:
+            # Evicted models leave their state in the Keras session, so it is cleared from time to time
+            if self.cache is None or self.cache.builds >= CLEAR_SESSION_BUILDS:
+                keras.backend.clear_session()
+                if self.cache is not None:
+                    self.cache.clear()
+            model = self.__build(features_n)
+            X_fit = X.reshape(-1, features_n)
+            model.fit(x=np.expand_dims(X_fit, axis=2), y=X_fit, batch_size=16, epochs=epochs_n, validation_split=0.1, verbose=verbose,
+                      callbacks=[EarlyStopping(patience=2)])
+            if self.cache is not None:
+                self.cache.builds += 1
+                if key is not None:
+                    self.cache.put(cache_key, CachedModel(model, count))
+        else:
+            model = entry.model
+            # Rows are aligned to the end of the series, so the new samples are in the last rows of every series
+            new_rows = min(samples_n, -(-(count - entry.count) // features_n))
+            if new_rows > 0:
+                X_fit = X[:, -new_rows:].reshape(-1, features_n)
+                model.fit(x=np.expand_dims(X_fit, axis=2), y=X_fit, batch_size=16, epochs=min(FINE_TUNE_EPOCHS, epochs_n), verbose=verbose)
+            entry.count = max(entry.count, count)
 
-        pts = model.predict(dts)
-        return pts.reshape(-1), offset
+        pts = model.predict(np.expand_dims(X.reshape(-1, features_n), axis=2), verbose=verbose)
+        return pts.reshape(columns_n, -1), offset
 
 
 if __name__ == '__main__':
+    import pandas as pd
     df = pd.read_csv('../data/stocks.csv')
     ad = AnomalyDetection(45)
     print(ad.find_anomalies(df['pgz'].values))
@@ -1,20 +1,15 @@
 #!/usr/bin/python3
 
-import datetime
 import os
 import threading
 import time
-import pandas as pd
 import numpy as np
-import copy
-import matplotlib as mpl
-mpl.use('Agg')
-from matplotlib import pyplot as plt
 
-from anomaly import AnomalyDetection
-
-k1 = '#DC7633'
-k2 = '#E74C3C'
+# Matplotlib (in graph_renderer) and tensorflow (in anomaly) are imported on first use,
+# so the worker starts at once and the median detector does not load them at all.
+# Tensorflow is needed only to fit models, the trained models are scored in NumPy
+from median_detection import MedianDetection
+from metric_registry import registry
 
 #lock = threading.Lock()
 
@@ -23,49 +18,194 @@ processed_column = "None"
 anomaly_info = ""
 anomalies_found = {}
 normals_found = {}
-df_matrix = None
+series_matrix = None
+# Metric id -> number of samples ever appended to the series, see SeriesStore.counts
+series_counts = {}
 progress = 'Waiting'
 columns_handled = []
 draw_all = False
 column_filter = []
+# Number of columns reconstructed together by one model
+batch_size = 1
+# Detector: lstm, median or staged (median first, then lstm for the metrics it finds anomalous)
+detector = 'lstm'
+model_cache = None
+# Dir of the models trained on the reference series and the store loading them
+models_path = None
+model_store = None
+# Last samples of the series analysed by ML, older samples are dropped or averaged into a number of history points
+ml_window = 360
+ml_history = 0
+# Column results: metric id -> (series version, (samples, ranges, positions)) of the last pass
+column_results = {}
+# GraphRenderer drawing the graphs in background
+renderer = None
 
 
-def update_matrix(matrix, columns = []):
-    global df_matrix, column_filter
-    new_matrix = copy.deepcopy(matrix)
-    df_matrix = new_matrix
+# Matrix is a dict of metric id -> samples, with at least the metrics in columns, as SharedMatrix.read returns it.
+# The series come from SeriesStore, which keeps empty values as 0.0, so they have no gaps to fill
+def update_matrix(matrix, columns = [], counts = {}):
+    global series_matrix, column_filter, series_counts
+    series_matrix = matrix
     column_filter = columns
+    series_counts = counts
 
+# Graphs are drawn by the renderer process if there is one, see graph_renderer.py
 def draw_anomaly(column, ranges, ts):
-    fname = column + '.' + str(datetime.datetime.now()) + '.png'
-    fig, ax = plt.subplots(1, 1, figsize=(6, 4))
-    ax.plot(np.arange(ts.shape[0]), ts)
-    for k in ranges.keys():
-        if len(ranges[k]) > 0:
-            for start, end in ranges[k]:
-                c = k1 if k ==1 else k2
-                ax.axvspan(start, end-1, color=c, alpha = 0.16 * k)
-        plt.savefig(fname)
-    plt.close(fig)
+    if renderer is None:
+        from graph_renderer import draw_figure
+        draw_figure(registry.name(column), ts, ranges)
+    else:
+        renderer.draw(registry.name(column), ts, ranges)
+
+# Draws the series of the columns in the matrix (SeriesStore), like the top metrics of a pod,
+# with the ranges of their ML results in found
+def draw_graphs(matrix, columns, found={}):
+    for column in columns:
+        if column is None or column not in matrix:
+            continue
+        draw_anomaly(column, found.get(column, {}).get('ranges', {}), matrix.values(column))
+
+
+# Columns are metric ids, their names are like
+# reviews-v1|cluster.inbound|9080|http|reviews.default.svc.cluster.local.external.upstream_rq_time|P75
+def get_metric(column):
+    return registry.metric(column)
+
+def get_pod(column):
+    return registry.pod(column)
+
+def get_service(column):
+    return get_pod(column).split('-', 1)[0]
+
+# Metrics of a family share the trained model, the family is the stat name like upstream_rq_time|P75
+def get_family(column):
+    return get_metric(column).rsplit('.', 1)[-1]
+
 
+# Anomaly is reported when it is in the last tenth of the samples
+def is_recent(samples, positions):
+    return (0 < len(positions) and (
+        len(positions[1]) > 0 and positions[1][-1] > samples * 0.9 or
+        len(positions[2]) > 0 and positions[2][-1] > samples * 0.9 or
+        len(positions[3]) > 0 and positions[3][-1] > samples * 0.9))
 
-# s == reviews-v1|cluster.inbound|9080|http|reviews.default.svc.cluster.local.external.upstream_rq_time|P75
-def get_metric(s):
-    return s.split('|', 1)[1]
+def lstm_detector(row_len):
+    global model_cache
+    from anomaly import AnomalyDetection, ModelCache
+    if model_cache is None:
+        model_cache = ModelCache()
+    return AnomalyDetection(row_len, cache=model_cache)
 
-def get_pod(s):
-    return s.split('|', 1)[0]
+def trained_models():
+    global model_store
+    if not models_path:
+        return None
+    from anomaly import ModelStore
+    if model_store is None or model_store.path != models_path:
+        model_store = ModelStore(models_path)
+    model_store.refresh()
+    return model_store
 
-def get_service(s):
-    return get_pod(s).split('-', 1)[0]
+# Returns the model trained for the family of the column if it fits the series
+def trained_model(column, row_len, length):
+    if model_store is None:
+        return None
+    trained = model_store.get(get_family(column))
+    if trained is None or trained.samples_n != row_len or trained.samples_n * trained.features_n > length:
+        return None
+    return trained
+
+def find_anomalies(row_len, series, columns, start):
+    ad = lstm_detector(row_len)
+    results = [None] * len(columns)
+    # Metrics with trained models are only scored, in batches of the same family
+    families = {}
+    for i, column in enumerate(columns):
+        trained = trained_model(column, row_len, len(series[i]))
+        if trained is not None:
+            families.setdefault(id(trained), (trained, []))[1].append(i)
+    for trained, indices in families.values():
+        scored = ad.find_anomalies_batch([series[i] for i in indices], trained=trained)
+        for i, result in zip(indices, scored):
+            results[i] = result
+    untrained = [i for i in range(len(columns)) if results[i] is None]
+    if len(untrained) == 1:
+        column = columns[untrained[0]]
+        results[untrained[0]] = ad.find_anomalies(series[untrained[0]], key=column, count=series_counts.get(column))
+    elif untrained:
+        # Batches share one model, cached under the position of the batch
+        count = max(series_counts.get(columns[i], len(series[i])) for i in untrained)
+        trained = ad.find_anomalies_batch([series[i] for i in untrained], key=('batch', start, len(columns)), count=count)
+        for i, result in zip(untrained, trained):
+            results[i] = result
+    return results
+
+# Trains the family models on the reference series, matrix is a dict of metric id -> samples.
+# Models are trained on the points of the series in the ML window, so they fit the input they score later
+def train_models(logging, matrix, path):
+    from anomaly import AnomalyDetection, ModelStore
+    if not matrix:
+        return
+    row_len = min(window_length(len(next(iter(matrix.values())))), 30)
+    families = {}
+    for column, ts in matrix.items():
+        families.setdefault(get_family(column), []).append(window_series(ts)[0])
+    logging.info("Training %s ML models on %s reference series in %s", str(len(families)), str(len(matrix)), path)
+    models = AnomalyDetection(row_len).train(families)
+    ModelStore(path).save(models)
+    logging.info("Saved %s trained ML models to %s", str(len(models)), path)
+
+def detect(row_len, series, columns, start):
+    if detector == 'lstm':
+        return find_anomalies(row_len, series, columns, start)
+    results = MedianDetection(row_len).find_anomalies_batch(series)
+    if detector == 'staged':
+        suspected = [i for i, (samples, ranges, positions) in enumerate(results) if is_recent(samples, positions)]
+        if suspected:
+            confirmed = find_anomalies(row_len, [series[i] for i in suspected], [columns[i] for i in suspected], start)
+            for i, result in zip(suspected, confirmed):
+                results[i] = result
+    return results
+
+# Results are reused while the series and the detection settings stay the same
+def series_version(row_len, ts, points):
+    return detector, model_store.mtime if model_store else None, row_len, ml_window, ml_history, len(ts), hash(points.tobytes())
+
+def window_length(length):
+    if not ml_window or length <= ml_window:
+        return length
+    return ml_window + min(ml_history, length - ml_window)
+
+# Returns the points of the series analysed by ML and the index in the series of the first sample of every point
+def window_series(ts):
+    length = len(ts)
+    if not ml_window or length <= ml_window:
+        return ts, np.arange(length)
+    start = length - ml_window
+    points = ts[start:]
+    index = np.arange(start, length)
+    if ml_history > 0:
+        edges = np.linspace(0, start, min(ml_history, start) + 1).astype(int)
+        history = np.add.reduceat(ts[:start], edges[:-1]) / np.diff(edges)
+        points = np.concatenate((history, points))
+        index = np.concatenate((edges[:-1], index))
+    return points, index
+
+# Maps ranges of the analysed points to the samples of the series
+def series_ranges(ranges, index, length):
+    ends = np.append(index[1:], length)
+    return {bucket: [(int(index[start]), int(ends[end - 1])) for start, end in spans] for bucket, spans in ranges.items()}
 
 
 def process_anomalies(logging, column_filter=[]):
-    global anomalies_found, normals_found, processed_column, anomaly_info, processing, df_matrix, progress, draw_all, columns_handled
-    current_anomalies = copy.deepcopy(anomalies_found)
-    current_normals = copy.deepcopy(normals_found)
+    global anomalies_found, normals_found, processed_column, anomaly_info, processing, series_matrix, progress, draw_all, columns_handled
+    # Entries of the results are not changed once added, they are shared with the results sent to the monitor,
+    # so a pass builds new dicts holding the entries kept and the new ones
+    current_anomalies = dict(anomalies_found)
+    current_normals = dict(normals_found)
     processed_column = "Starting"
-    if not df_matrix or len(column_filter) == 0:
+    if not series_matrix or len(column_filter) == 0:
         return ''
     if not processing:
         current_anomalies = {}
@@ -74,70 +214,82 @@ def process_anomalies(logging, column_filter=[]):
         progress = 'Waiting'
         columns_handled = []
         return ''
-    df = pd.DataFrame.from_dict(df_matrix)
-    row_len = len(next(iter(df_matrix.values())))
+    row_len = window_length(len(next(iter(series_matrix.values()))))
     if row_len > 30:
         row_len = 30
-    logging.info("ML samples: %s, columns: %s", str(row_len), str(column_filter))
-    ad = AnomalyDetection(row_len)
+    logging.info("ML samples: %s, columns: %s", str(row_len), str([registry.name(column) for column in column_filter]))
+    if detector != 'median':
+        trained_models()
     col_count = 0
-    for column in df_matrix.keys():
+    for column in list(current_anomalies.keys()) + list(current_normals.keys()):
         if not column in column_filter:
             current_anomalies.pop(column, None)
             current_normals.pop(column, None)
-            continue
+    columns = [column for column in column_filter if column in series_matrix]
+    size = max(1, batch_size)
+    for start in range(0, len(columns), size):
+        batch = columns[start:start + size]
+        names = [registry.name(column) for column in batch]
         try:
-            col_count += 1
-            logging.info("ML processing column %s", column)
-            processed_column = column
-            M = df[column].mean()
-            ts = df[column].fillna(M).values
-            samples, ranges, positions = ad.find_anomalies(ts)
-            logging.info("Finished processing column %s", column)
-            anomaly_info = "Anomaly in " + column + " ranges: " + str(ranges) + " positions: " + str(positions)
-            logging.info("ML processing column %s", anomaly_info)
-            anomaly = {
-                'info': anomaly_info,
-                'pod': get_pod(column),
-                'service': get_service(column),
-                'metric': get_metric(column),
-                'ranges': ranges,
-                'positions': positions,
-                'ts': ts.tolist()
-            }
-            if (0 < len(positions) and (
-                len(positions[1]) > 0 and positions[1][-1] > samples * 0.9 or
-                len(positions[2]) > 0 and positions[2][-1] > samples * 0.9 or
-                len(positions[3]) > 0 and positions[3][-1] > samples * 0.9)):
-                # TODO: find another criteria for checking for already found anomalies, like timestamp
-                if current_anomalies.get(column, {}).get('info') != anomaly_info:
-                    current_anomalies[column] = anomaly
-                    current_normals.pop(column, None)
-                    if draw_all:
-                        draw_anomaly(column, ranges, ts)
-                    logging.info(anomaly_info)
-            else:
-                current_anomalies.pop(column, None)
-                current_normals[column] = anomaly
-                logging.info("Adding anomaly to normals: %s", column)
+            col_count += len(batch)
+            logging.info("ML processing columns %s", names)
+            processed_column = ', '.join(names)
+            series = [series_matrix[column] for column in batch]
+            windows = [window_series(ts) for ts in series]
+            versions = [series_version(row_len, ts, points) for ts, (points, index) in zip(series, windows)]
+            changed = [i for i, column in enumerate(batch) if column_results.get(column, (None, None))[0] != versions[i]]
+            if changed:
+                results = detect(row_len, [windows[i][0] for i in changed], [batch[i] for i in changed], start)
+                for i, (samples, ranges, positions) in zip(changed, results):
+                    ranges = series_ranges(ranges, windows[i][1], len(series[i]))
+                    column_results[batch[i]] = (versions[i], (samples, ranges, positions))
+            results = [column_results[column][1] for column in batch]
+            logging.info("Finished processing columns %s, %s unchanged", names, str(len(batch) - len(changed)))
+            for column, name, ts, (samples, ranges, positions) in zip(batch, names, series, results):
+                anomaly_info = "Anomaly in " + name + " ranges: " + str(ranges) + " positions: " + str(positions)
+                logging.info("ML processing column %s", anomaly_info)
+                anomaly = {
+                    'info': anomaly_info,
+                    'pod': get_pod(column),
+                    'service': get_service(column),
+                    'metric': get_metric(column),
+                    'ranges': ranges,
+                    'positions': positions,
+                    'ts': ts.tolist()
+                }
+                if is_recent(samples, positions):
+                    # TODO: find another criteria for checking for already found anomalies, like timestamp
+                    if current_anomalies.get(column, {}).get('info') != anomaly_info:
+                        current_anomalies[column] = anomaly
+                        current_normals.pop(column, None)
+                        if draw_all:
+                            draw_anomaly(column, ranges, ts)
+                        logging.info(anomaly_info)
+                else:
+                    current_anomalies.pop(column, None)
+                    current_normals[column] = anomaly
+                    logging.info("Adding anomaly to normals: %s", name)
         except Exception as e:
-            anomaly_info = "Shit happens with " + column + " " + str(e)
-            logging.error("ERROR in processing column %s", column)
+            anomaly_info = "Shit happens with " + ', '.join(names) + " " + str(e)
+            logging.error("ERROR in processing columns %s", names)
             logging.error(e, exc_info=True)
             ranges = []
             positions = []
         finally:
     #            with lock:
-            columns_handled.append(column)
-            progress = str(len(columns_handled)) + '/' + str(len(df_matrix))  
+            columns_handled.extend(batch)
+            progress = str(len(columns_handled)) + '/' + str(len(column_filter))
             
+    for column in list(column_results.keys()):
+        if not column in column_filter:
+            del column_results[column]
     processed_column = "None"
     # Wait for other threads to finish
-#    while len(columns_handled) != len(df_matrix):
+#    while len(columns_handled) != len(column_filter):
 #        time.sleep(1)
     #with lock:
     columns_handled = []
-    anomalies_found = copy.deepcopy(current_anomalies)
-    logging.info("ANOMALIES FOUND: %s", str(anomalies_found))
-    normals_found = copy.deepcopy(current_normals)
+    anomalies_found = current_anomalies
+    logging.info("ANOMALIES FOUND: %s", str([registry.name(column) for column in anomalies_found]))
+    normals_found = current_normals
     return ''
@@ -0,0 +1,660 @@
+#!/usr/bin/python3
+
+# Benchmarks of the monitor hot paths on synthetic data, e.g.:
+#   ./benchmark.py parser -l 50000 -n 20
+#   ./benchmark.py equals -m 1000 10000 100000
+#   ./benchmark.py ml-batch -c 64 -b 1 8 64
+#   ./benchmark.py ml-batch -d median -c 5000 -b 1 5000
+#   ./benchmark.py startup -l 5000
+#   ./benchmark.py bilstm -c 256 -b 1 16 256
+#   ./benchmark.py collector -p 200 -s 5
+
+import argparse
+import datetime
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import envoy_parser
+from envoy_parser import EnvoyStatsParser
+from metric_registry import registry
+
+cluster_stats = ['upstream_cx_total', 'upstream_cx_active', 'upstream_cx_http1_total', 'upstream_cx_destroy', 'upstream_cx_rx_bytes_total',
+				'upstream_cx_tx_bytes_total', 'upstream_rq_total', 'upstream_rq_active', 'upstream_rq_pending_total', 'upstream_rq_200',
+				'upstream_rq_2xx', 'upstream_rq_retry', 'upstream_rq_timeout', 'upstream_rq_completed', 'membership_healthy',
+				'membership_total', 'lb_healthy_panic', 'max_host_weight', 'version', 'update_success']
+histo_stats = ['upstream_rq_time', 'upstream_cx_connect_ms', 'upstream_cx_length_ms', 'external.upstream_rq_time', 'internal.upstream_rq_time']
+quantiles = ['P0', 'P25', 'P50', 'P75', 'P90', 'P95', 'P99', 'P99.5', 'P99.9', 'P100']
+services = ['productpage', 'details', 'ratings', 'reviews', 'istiod', 'prometheus', 'grafana', 'kube-dns', 'zipkin', 'httpbin']
+
+
+def generate_envoy_stats(num_lines, seed=0):
+	rnd = random.Random(seed)
+	rows = []
+	n = 0
+	while len(rows) < num_lines:
+		service = services[n % len(services)]
+		port = '9080' if n % 3 else '15010'
+		cluster = 'cluster.outbound|' + port + '||' + service + str(n) + '.default.svc.cluster.local'
+		for stat in cluster_stats:
+			rows.append(cluster + '.' + stat + ': ' + str(rnd.randint(0, 100000)))
+		for stat in histo_stats:
+			if rnd.random() < 0.2:
+				rows.append(cluster + '.' + stat + ': No recorded values')
+			else:
+				values = ['%s(%s,%.1f)' % (q, 'nan' if rnd.random() < 0.1 else '%.1f' % (rnd.random() * 100), rnd.random() * 100) for q in quantiles]
+				rows.append(cluster + '.' + stat + ': ' + ' '.join(values))
+		n += 1
+	return '\n'.join(rows[:num_lines]) + '\n'
+
+# Per row classification as it was done in Pod.read_envoy_data before the parser, for comparison
+def legacy_parse(prefix, contents, excluded):
+	for row in contents.splitlines():
+		row_split = row.split(':')
+		key = prefix + '|' + row_split[0]
+		value = row_split[1]
+		if envoy_parser.exclude_row(key):
+			excluded.add(key)
+			continue
+		if 'P0(' in value:
+			for hval in value.split():
+				hval_split = re.split('[(,)]', hval)
+				if hval_split[0] in ['P75']:
+					yield key, hval_split[1], 'nan', 'H'
+		else:
+			yield key, value, ' No recorded values', 'G' if envoy_parser.is_gauge(key) else 'C'
+
+def bench_parser(args):
+	contents = generate_envoy_stats(args.lines)
+	num_lines = contents.count('\n')
+	print('Parsing %d files of %d lines' % (args.files, num_lines))
+
+	start = time.perf_counter()
+	excluded = set()
+	for i in range(args.files):
+		legacy = list(legacy_parse('reviews-v1', contents, excluded))
+	elapsed = time.perf_counter() - start
+	print('legacy:  %10.0f lines/s' % (num_lines * args.files / elapsed))
+
+	parser = EnvoyStatsParser('reviews-v1')
+	start = time.perf_counter()
+	for i in range(args.files):
+		rows = [(registry.name(key), value, empty, kind) for key, value, empty, kind in parser.parse(io.StringIO(contents))]
+	elapsed = time.perf_counter() - start
+	print('parser:  %10.0f lines/s (%d rows kept, %d keys filtered out)' % (num_lines * args.files / elapsed, len(rows), len(parser.excluded)))
+	if rows != legacy:
+		print('MISMATCH between legacy and parser results')
+
+
+# Equality grouping as it was done in Pod.process_last_series before the grid, for comparison
+def legacy_group_equals(items):
+	for result in items:
+		if not result.discard():
+			for result2 in items:
+				if result2 is result:
+					break
+				if result2.discard():
+					continue
+				if result.verify_is_equal(result2):
+					break
+
+def generate_pod_results(pod, num_metrics, seed=0):
+	rnd = random.Random(seed)
+	levels = []
+	for i in range(num_metrics):
+		metric_id = registry.intern('bench-%d|cluster.inbound|9080|metric%d' % (num_metrics, i))
+		pod.add_result(metric_id, 'G')
+		# A third of the metrics stay zero, the others are spread around a number of typical value levels
+		levels.append(None if rnd.random() < 0.3 else (rnd.random(), rnd.random()))
+	return levels
+
+def feed_series(stats, levels, series):
+	rnd = random.Random(series)
+	for row, level in enumerate(levels):
+		stats.empty[row] = False
+		stats.min[row] = 0.0
+		if level is None:
+			stats.max[row] = stats.norm_last_value[row] = stats.norm_avg[row] = 0.0
+		else:
+			stats.max[row] = 1.0
+			stats.norm_last_value[row] = level[0] + rnd.gauss(0, 0.05)
+			stats.norm_avg[row] = level[1] + rnd.gauss(0, 0.01)
+
+def bench_equals(args):
+	# The monitor module sets up its log files and redirects stderr when imported
+	import monitor_envoy_stats as monitor
+	sys.stderr = sys.__stderr__
+
+	for num_metrics in args.metrics:
+		timings = {}
+		groups = {}
+		for variant in ['legacy', 'grid']:
+			if variant == 'legacy' and num_metrics > args.legacy_limit:
+				continue
+			pod = monitor.Pod('bench', '')
+			levels = generate_pod_results(pod, num_metrics)
+			elapsed = 0.0
+			for series in range(args.series):
+				feed_series(pod.pod_stats, levels, series)
+				start = time.perf_counter()
+				if variant == 'legacy':
+					items = sorted(pod.results.values(), key=lambda result_: result_.name)
+					for result in items:
+						result.verify_equaled_out()
+					legacy_group_equals(items)
+				else:
+					pod.process_last_series()
+				elapsed += time.perf_counter() - start
+			timings[variant] = elapsed / args.series
+			groups[variant] = sorted((result.id, result.primary_equal.id if result.equaled_out else None) for result in pod.results.values())
+		line = '%7d metrics: grid %9.2f ms/series' % (num_metrics, timings['grid'] * 1000)
+		if 'legacy' in timings:
+			line += ', legacy %9.2f ms/series' % (timings['legacy'] * 1000)
+			if groups['legacy'] != groups['grid']:
+				line += ', MISMATCH in equal groups'
+		print(line)
+
+
+def generate_ml_series(num_columns, length, seed=0):
+	rnd = random.Random(seed)
+	series = []
+	for i in range(num_columns):
+		level = rnd.uniform(10, 100)
+		ts = [level + rnd.random() for n in range(length)]
+		# Every other metric gets a spike at the end
+		if i % 2 == 0:
+			ts[-2:] = [level * 3] * 2
+		series.append(ts)
+	return series
+
+def bench_ml_batch(args):
+	import numpy as np
+	sys.stderr = sys.__stderr__
+
+	series = [np.array(ts) for ts in generate_ml_series(args.columns, args.length)]
+	for batch_size in args.batch:
+		if args.detector == 'median':
+			from median_detection import MedianDetection
+			ad = MedianDetection(min(args.length, 30))
+		else:
+			from anomaly import AnomalyDetection, ModelCache
+			ad = AnomalyDetection(min(args.length, 30), cache=ModelCache())
+		rates = []
+		for n in range(args.passes):
+			start = time.perf_counter()
+			for first in range(0, len(series), batch_size):
+				batch = series[first:first + batch_size]
+				if len(batch) == 1:
+					ad.find_anomalies(batch[0], key=first)
+				else:
+					ad.find_anomalies_batch(batch, key=('batch', first, batch_size))
+			rates.append(len(series) / (time.perf_counter() - start))
+		print('batch %4d: first pass %8.1f columns/s, next passes %8.1f columns/s' %
+			(batch_size, rates[0], sum(rates[1:]) / max(1, len(rates) - 1)))
+
+# Checks that BiLSTM gives the same reconstruction and anomalies as the Keras model it is loaded from,
+# and compares their throughput when scoring suspected metrics with a trained model
+def bench_bilstm(args):
+	import numpy as np
+	sys.stderr = sys.__stderr__
+	from anomaly import AnomalyDetection, ModelStore
+
+	series = [np.array(ts) for ts in generate_ml_series(args.columns, args.length)]
+	row_len = min(args.length, 30)
+	ad = AnomalyDetection(row_len)
+	trained = ad.train({'bench': series}, epochs_n=args.epochs)['bench']
+	# A single step of the LSTM does not use the recurrent kernels nor the reversal of the backward layer
+	if trained.features_n < 2:
+		print('%d samples give a single step of %d, MISMATCH: use at least %d samples' % (args.length, row_len, 2 * row_len))
+		return
+	with tempfile.TemporaryDirectory() as path:
+		ModelStore(path).save({'bench': trained})
+		store = ModelStore(path)
+		store.refresh()
+		loaded = store.get('bench')
+
+	X = np.array([(ts - ts.mean()) / (ts.std() + 0.00001) for ts in series])
+	rows = X[:, X.shape[1] - row_len * trained.features_n:].reshape(-1, trained.features_n, 1)
+	diff = np.abs(trained.model.predict(rows, verbose=0) - loaded.model.predict(rows)).max()
+	line = 'reconstruction of %d rows: max difference %.2e' % (len(rows), diff)
+	if diff > args.tolerance:
+		line += ', MISMATCH'
+	print(line)
+	results = {}
+	for name, model in [('keras', trained), ('numpy', loaded)]:
+		results[name] = ad.find_anomalies_batch(series, trained=model)
+	differ = sum(1 for keras_result, numpy_result in zip(results['keras'], results['numpy']) if keras_result != numpy_result)
+	print('anomalies of %d columns: %d differ' % (len(series), differ) + (', MISMATCH' if differ else ''))
+
+	for batch_size in args.batch:
+		line = 'batch %4d:' % batch_size
+		for name, model in [('keras', trained), ('numpy', loaded)]:
+			start = time.perf_counter()
+			for n in range(args.passes):
+				for first in range(0, len(series), batch_size):
+					ad.find_anomalies_batch(series[first:first + batch_size], trained=model)
+			line += ' %s %9.1f columns/s' % (name, args.passes * len(series) / (time.perf_counter() - start))
+		print(line)
+
+
+# Writes series of stats files the way the collector does
+def generate_data_dir(path, pods, num_series, num_lines):
+	start = datetime.datetime(2020, 6, 1, 10, 0, 0, tzinfo=datetime.timezone.utc)
+	for i in range(num_series):
+		timestamp = (start + datetime.timedelta(seconds=5 * i)).isoformat(timespec='seconds')
+		with open(os.path.join(path, 'pods.' + timestamp), 'w') as f:
+			for pod in pods:
+				f.write('Name:         %s-v1-abc-1\nNode:         node1/10.0.0.1\n' % pod)
+		for pod in pods:
+			with open(os.path.join(path, pod + '-v1-abc-1.' + timestamp), 'w') as f:
+				f.write(generate_envoy_stats(num_lines, seed=i))
+
+def bench_startup(args):
+	monitor_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'monitor_envoy_stats.py')
+	pods = ['productpage', 'details', 'ratings']
+	with tempfile.TemporaryDirectory() as workdir:
+		data = os.path.join(workdir, 'data')
+		os.mkdir(data)
+		generate_data_dir(data, pods, args.series, args.lines)
+		promise = os.path.join(workdir, 'promise')
+		log = os.path.join(workdir, 'monitor_envoy.log')
+		start = time.perf_counter()
+		# Logs are written to the working dir of the monitor
+		monitor = subprocess.Popen([sys.executable, monitor_path, data, '-B', '-p'] + pods, cwd=workdir,
+								stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		first_series = None
+		ml_ready = None
+		while first_series is None or ml_ready is None:
+			if time.perf_counter() - start > args.timeout:
+				break
+			if ml_ready is None and os.path.exists(log):
+				with open(log) as f:
+					if 'Starting ML anomalies confirming' in f.read():
+						ml_ready = time.perf_counter() - start
+			if first_series is None:
+				if os.path.exists(promise):
+					os.remove(promise)
+				monitor.stdin.write(json.dumps({'command': 'query_load', 'promise': promise}).encode() + b'\0')
+				monitor.stdin.flush()
+				while not (os.path.exists(promise) and os.path.getsize(promise)) and time.perf_counter() - start < args.timeout:
+					time.sleep(0.01)
+				if os.path.exists(promise) and json.load(open(promise))['samples']['total'] > 0:
+					first_series = time.perf_counter() - start
+			time.sleep(0.01)
+		monitor.stdin.write(json.dumps({'command': 'quit'}).encode() + b'\0')
+		monitor.stdin.close()
+		monitor.wait(60)
+	print('startup: first series processed %s, ML worker ready %s' %
+		tuple('%.2f s' % t if t is not None else 'timed out' for t in [first_series, ml_ready]))
+def latency_line(name, latencies, elapsed):
+	latencies = sorted(latencies)
+	return '  %-24s mean %7.2f ms  p50 %7.2f ms  p99 %7.2f ms  %8.1f commands/s' % (name, 1000 * sum(latencies) / len(latencies),
+		1000 * latencies[len(latencies) // 2], 1000 * latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)], len(latencies) / elapsed)
+
+class SocketClient:
+
+	def __init__(self, path):
+		import socket
+		self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.socket.connect(path)
+		self.buffer = b''
+
+	def command(self, command):
+		self.socket.sendall(json.dumps(command).encode() + b'\0')
+		while b'\0' not in self.buffer:
+			data = self.socket.recv(65536)
+			if not data:
+				raise ConnectionError('Monitor closed the socket')
+			self.buffer += data
+		reply, _, self.buffer = self.buffer.partition(b'\0')
+		return json.loads(reply.decode())
+
+	def close(self):
+		self.socket.close()
+
+def timed_commands(send, count):
+	latencies = []
+	for _ in range(count):
+		start = time.perf_counter()
+		send()
+		latencies.append(time.perf_counter() - start)
+	return latencies
+
+def bench_commands(args):
+	import http.client
+	import socket
+	import threading
+	monitor_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'monitor_envoy_stats.py')
+	pods = ['productpage', 'details', 'ratings']
+	with socket.socket() as s:
+		s.bind(('127.0.0.1', 0))
+		port = s.getsockname()[1]
+	with tempfile.TemporaryDirectory() as workdir:
+		data = os.path.join(workdir, 'data')
+		os.mkdir(data)
+		generate_data_dir(data, pods, args.series, args.lines)
+		path = os.path.join(workdir, 'monitor.sock')
+		monitor = subprocess.Popen([sys.executable, monitor_path, data, '-B', '-p'] + pods + ['--socket', path, '--http', str(port)],
+								cwd=workdir, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		start = time.perf_counter()
+		while not os.path.exists(path) and time.perf_counter() - start < args.timeout:
+			time.sleep(0.05)
+		client = SocketClient(path)
+		query = {'command': args.command}
+		while client.command({'command': 'query_load'})['samples']['total'] == 0 and time.perf_counter() - start < args.timeout:
+			time.sleep(0.05)
+		print('commands: %s, %d requests, monitor of %d pods with %d series' % (args.command, args.requests, len(pods), args.series))
+
+		# Stdin with a promise file polled by the client, as the demo script does
+		promise = os.path.join(workdir, 'promise')
+		def stdin_command():
+			if os.path.exists(promise):
+				os.remove(promise)
+			monitor.stdin.write(json.dumps(dict(query, promise=promise)).encode() + b'\0')
+			monitor.stdin.flush()
+			while not (os.path.exists(promise) and os.path.getsize(promise)):
+				time.sleep(0.001)
+			with open(promise) as f:
+				json.load(f)
+		elapsed = time.perf_counter()
+		latencies = timed_commands(stdin_command, args.requests)
+		print(latency_line('stdin + promise file', latencies, time.perf_counter() - elapsed))
+
+		elapsed = time.perf_counter()
+		latencies = timed_commands(lambda: client.command(query), args.requests)
+		print(latency_line('socket', latencies, time.perf_counter() - elapsed))
+
+		connection = http.client.HTTPConnection('127.0.0.1', port)
+		def http_command():
+			connection.request('POST', '/', json.dumps(query), {'Content-Type': 'application/json'})
+			json.loads(connection.getresponse().read().decode())
+		elapsed = time.perf_counter()
+		latencies = timed_commands(http_command, args.requests)
+		print(latency_line('http', latencies, time.perf_counter() - elapsed))
+
+		# GET passes the version as a string of the query, which has to match the version of the snapshot
+		def get_load(version):
+			connection.request('GET', '/query_load?version=%s' % version)
+			return json.loads(connection.getresponse().read().decode())
+		version = get_load('null')['version']
+		elapsed = time.perf_counter()
+		latencies = timed_commands(lambda: get_load(version), args.requests)
+		print(latency_line('http GET, not modified', latencies, time.perf_counter() - elapsed))
+		if not get_load(version).get('not_modified'):
+			print('http GET of query_load with the current version %s: modified, MISMATCH' % version)
+		connection.close()
+
+		for clients in args.clients:
+			results = []
+			def run_client():
+				client = SocketClient(path)
+				results.extend(timed_commands(lambda: client.command(query), max(1, args.requests // clients)))
+				client.close()
+			threads = [threading.Thread(target=run_client) for _ in range(clients)]
+			elapsed = time.perf_counter()
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			print(latency_line('socket, %d clients' % clients, results, time.perf_counter() - elapsed))
+
+		client.command({'command': 'quit'})
+		client.close()
+		monitor.stdin.close()
+		monitor.wait(60)
+
+# Anomalies found by ML as the workers send them, every one with its series
+def generate_found(pod, num_anomalies, length, seed=0):
+	rnd = random.Random(seed)
+	found = {}
+	for i in range(num_anomalies):
+		metric = 'cluster.inbound|9080|metric%d' % i
+		metric_id = registry.intern(pod + '|' + metric)
+		ranges = {1: [(length - 3, length)], 2: [], 3: []}
+		positions = {1: [length - 2], 2: [], 3: []}
+		found[metric_id] = {'info': 'Anomaly in %s|%s ranges: %s positions: %s' % (pod, metric, ranges, positions), 'pod': pod,
+							'service': pod, 'metric': metric, 'ranges': ranges, 'positions': positions,
+							'ts': [rnd.random() for _ in range(length)]}
+	return found
+
+# Report of query_anomalies_info as it was done before the snapshots, for comparison
+def legacy_report(pods, anomalies_found, normals_found):
+	import copy
+	current_anomalies = copy.deepcopy(anomalies_found)
+	current_all = copy.deepcopy(normals_found)
+	current_all.update(current_anomalies)
+	report = {}
+	for key, val in current_anomalies.items():
+		anomaly_info = copy.deepcopy(val)
+		anomaly_info['pod'] = pods[anomaly_info['pod']]
+		report[registry.name(key)] = anomaly_info
+	return json.dumps(report)
+
+def bench_queries(args):
+	import types
+	import monitor_envoy_stats
+	from snapshot import Snapshot
+	pod = types.SimpleNamespace(name='productpage', full_name='productpage-v1-abc-1', metrics_count=0, anomaly_maxed=0, anomaly_ml=0,
+								suspected_anomalies=[], memory_footprint=lambda: 0)
+	for num_anomalies in args.anomalies:
+		for length in args.length:
+			anomalies_found = generate_found(pod.name, num_anomalies, length)
+			normals_found = generate_found(pod.name + '-normal', num_anomalies, length, seed=1)
+			monitor = types.SimpleNamespace(reported_anomalies={})
+			monitor.snapshot = Snapshot().publish(1, [pod], anomalies_found, normals_found)
+			servant = monitor_envoy_stats.Servant(monitor, inline=True)
+			version = monitor.snapshot.anomalies_version
+			line = 'queries: %5d anomalies of %5d samples:' % (num_anomalies, length)
+			timings = [
+				('deepcopy', lambda: legacy_report({pod.name: pod.full_name}, anomalies_found, normals_found)),
+				# Every query reports all the anomalies again, as the first query after they are found
+				('snapshot', lambda: (monitor.reported_anomalies.clear(), servant.query_anomalies_info({}), json.dumps(servant.value))),
+				('not modified', lambda: (servant.query_anomalies_info({'version': version}), json.dumps(servant.value))),
+			]
+			for name, query in timings:
+				start = time.perf_counter()
+				for _ in range(args.queries):
+					query()
+				line += ' %s %8.3f ms' % (name, 1000 * (time.perf_counter() - start) / args.queries)
+			print(line)
+
+
+# Columns which depend on the equal groups, settled after every series by process_pod and once by backfill
+group_columns = ['equaled_out', 'equals_count', 'ref_equals_count', 'diff_equals_count', 'anomalies', 'anomaly_unequal']
+
+# Reads the files of the pod by process_pod or backfill, learning on the first half and checking against the reference on the rest.
+# Returns the pod, the time of parsing the files and the time of processing the series
+def run_pod_files(monitor, pod_name, path, files, bulk):
+	import types
+	from retention import SeriesStore
+	monitor.monitor = types.SimpleNamespace(global_matrix=SeriesStore(), ml=types.SimpleNamespace(anomalies_found={}))
+	pod = monitor.Pod(pod_name, path)
+	reading = [0.0]
+	read_series = pod.read_series
+	def timed_read_series(fname):
+		start = time.perf_counter()
+		series = read_series(fname)
+		reading[0] += time.perf_counter() - start
+		return series
+	pod.read_series = timed_read_series
+	half = len(files) // 2
+	start = time.perf_counter()
+	for learning, part in [(True, files[:half]), (False, files[half:])]:
+		monitor.learning = learning
+		if bulk:
+			pod.backfill(part)
+		else:
+			pod.process_pod(part)
+		if learning:
+			pod.set_reference()
+	return pod, reading[0], time.perf_counter() - start - reading[0]
+
+def bench_backfill(args):
+	import numpy as np
+	import monitor_envoy_stats
+	from pod_stats import columns
+	with tempfile.TemporaryDirectory() as path:
+		generate_data_dir(path, ['productpage'], args.series, args.lines)
+		files = sorted(f for f in os.listdir(path) if f.startswith('productpage-'))
+		pod, reading, sequential = run_pod_files(monitor_envoy_stats, 'productpage', path, files, False)
+		bulk_pod, bulk_reading, bulk = run_pod_files(monitor_envoy_stats, 'productpage', path, files, True)
+	samples = sum(pod.matrix.count(metric_id) for metric_id in pod.pod_stats.column('ids').tolist())
+	# Parsing is the same in both, so it is shown apart from processing of the series
+	line = 'backfill: %d series of %d metrics, parsing %.2f s, process_pod %.2f s %.0f samples/s, backfill %.2f s %.0f samples/s' % (
+		len(files), len(pod.matrix), bulk_reading, sequential, samples / sequential, bulk, samples / bulk)
+	stats, bulk_stats = pod.pod_stats, bulk_pod.pod_stats
+	if not np.array_equal(stats.column('ids'), bulk_stats.column('ids')):
+		print(line + ' MISMATCH of metrics')
+		return
+	for name in columns:
+		if name in group_columns:
+			continue
+		a, b = stats.column(name), bulk_stats.column(name)
+		equal = np.array_equal(a, b) if a.dtype != np.float64 else np.allclose(a, b, rtol=args.tolerance, atol=args.tolerance, equal_nan=True)
+		if not equal:
+			line += ' MISMATCH of %s in %d rows' % (name, int((~np.isclose(a, b, rtol=args.tolerance, atol=args.tolerance, equal_nan=True)).sum()))
+	for metric_id in stats.column('ids').tolist():
+		if not np.allclose(pod.matrix.values(metric_id), bulk_pod.matrix.values(metric_id), equal_nan=True):
+			line += ' MISMATCH of samples of %s' % registry.name(metric_id)
+			break
+	print(line)
+
+# Stand-in of the envoy admin endpoint of one pod, counts the connections open at once
+async def start_stats_server(body, delay, active):
+	import asyncio
+	async def serve(reader, writer):
+		active[0] += 1
+		active[1] = max(active[1], active[0])
+		try:
+			await reader.readuntil(b'\r\n\r\n')
+			await asyncio.sleep(delay)
+			writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\n' + body)
+			await writer.drain()
+		# Slow answers are cancelled when the check is over
+		except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+			pass
+		finally:
+			active[0] -= 1
+			writer.close()
+	return await asyncio.start_server(serve, '127.0.0.1', 0)
+
+# Scrapes stand-in servers by the collector and checks the files it writes
+def bench_collector(args):
+	import asyncio
+	from envoy_collector import STASH, Collector, PodTarget
+	from file_index import JOURNAL
+
+	async def collect(path):
+		active = [0, 0]
+		bodies = [generate_envoy_stats(args.lines, seed=i).encode() for i in range(args.pods)]
+		servers = []
+		for i, body in enumerate(bodies):
+			servers.append(await start_stats_server(body, args.timeout * 2 if i < args.slow else args.delay, active))
+		pods = [PodTarget('pod%d-v1-abc-1' % i, 'node%d/10.0.0.%d' % (i % 3, i % 3), 'http://127.0.0.1:%d/stats' % server.sockets[0].getsockname()[1])
+				for i, server in enumerate(servers)]
+		collector = Collector(path, args.concurrency, args.timeout)
+		start = time.perf_counter()
+		timestamp, fnames = await collector.collect(pods)
+		elapsed = time.perf_counter() - start
+		for server in servers:
+			server.close()
+			await server.wait_closed()
+		return pods, bodies, collector, timestamp, fnames, elapsed, active[1]
+
+	with tempfile.TemporaryDirectory() as path:
+		pods, bodies, collector, timestamp, fnames, elapsed, most_active = asyncio.run(collect(path))
+		line = 'collector: %d pods, %d slow, %.2f s, at most %d connections' % (len(pods), args.slow, elapsed, most_active)
+		# Slow pods time out and are left out of the series, the others are stored along with the journal
+		expected = [pod.name + '.' + timestamp for pod in pods[args.slow:]]
+		if sorted(fnames) != sorted(expected):
+			line += ' MISMATCH of stored files'
+		for pod, body in zip(pods[args.slow:], bodies[args.slow:]):
+			with open(os.path.join(path, pod.name + '.' + timestamp), 'rb') as f:
+				if f.read() != collector.filter_stats(body):
+					line += ' MISMATCH of stats of ' + pod.name
+		with open(os.path.join(path, 'pods.' + timestamp)) as f:
+			if f.read() != ''.join('Name:         %s\nNode:         %s\n' % (pod.name, pod.node) for pod in pods):
+				line += ' MISMATCH of pods file'
+		with open(os.path.join(path, JOURNAL)) as f:
+			if sorted(f.read().splitlines()) != sorted(expected):
+				line += ' MISMATCH of journal'
+		if most_active > args.concurrency:
+			line += ' MISMATCH of concurrency'
+		# Pods are scraped at once, so a round takes about one timeout however many pods there are
+		if elapsed > args.timeout + args.delay * (len(pods) // args.concurrency + 1) + 1:
+			line += ' MISMATCH of round time'
+		if any(name.startswith(STASH) for name in os.listdir(path)):
+			line += ' MISMATCH of stash files left'
+	print(line)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	subparsers = parser.add_subparsers(dest='bench')
+	subparsers.required = True
+	p = subparsers.add_parser('parser', help='envoy stats parser throughput')
+	p.add_argument('-l', '--lines', type=int, default=50000, help='lines per admin dump')
+	p.add_argument('-n', '--files', type=int, default=20, help='number of dumps to parse')
+	p.set_defaults(func=bench_parser)
+	p = subparsers.add_parser('equals', help='equality grouping of pod metrics')
+	p.add_argument('-m', '--metrics', type=int, nargs='+', default=[1000, 10000, 100000], help='numbers of metrics per pod')
+	p.add_argument('-s', '--series', type=int, default=5, help='number of series to group')
+	p.add_argument('--legacy-limit', type=int, default=10000, help='largest number of metrics to run the former grouping on')
+	p.set_defaults(func=bench_equals)
+	p = subparsers.add_parser('ml-batch', help='ML confirmation throughput by batch size')
+	p.add_argument('-c', '--columns', type=int, default=64, help='number of suspected metrics')
+	p.add_argument('-l', '--length', type=int, default=58, help='samples per metric')
+	p.add_argument('-b', '--batch', type=int, nargs='+', default=[1, 8, 64], help='batch sizes')
+	p.add_argument('-n', '--passes', type=int, default=3, help='confirmation passes per batch size')
+	p.add_argument('-d', '--detector', choices=['lstm', 'median'], default='lstm', help='anomaly detector')
+	p.set_defaults(func=bench_ml_batch)
+	p = subparsers.add_parser('bilstm', help='scoring with a trained model in NumPy against Keras')
+	p.add_argument('-c', '--columns', type=int, default=256, help='number of suspected metrics')
+	p.add_argument('-l', '--length', type=int, default=120, help='samples per metric')
+	p.add_argument('-b', '--batch', type=int, nargs='+', default=[1, 16, 256], help='batch sizes')
+	p.add_argument('-n', '--passes', type=int, default=3, help='scoring passes per batch size')
+	p.add_argument('-e', '--epochs', type=int, default=5, help='training epochs of the model')
+	p.add_argument('--tolerance', type=float, default=1e-4, help='largest allowed difference of reconstructed values')
+	p.set_defaults(func=bench_bilstm)
+	p = subparsers.add_parser('startup', help='time from launch of the monitor in background mode to the first processed series')
+	p.add_argument('-l', '--lines', type=int, default=5000, help='lines per admin dump')
+	p.add_argument('-s', '--series', type=int, default=3, help='number of series in the data dir')
+	p.add_argument('-t', '--timeout', type=float, default=120, help='seconds to wait')
+	p.set_defaults(func=bench_startup)
+	p = subparsers.add_parser('commands', help='latency of the background mode commands over stdin, socket and HTTP')
+	p.add_argument('-c', '--command', default='query_load', help='command to send')
+	p.add_argument('-n', '--requests', type=int, default=200, help='number of commands sent by every way')
+	p.add_argument('-C', '--clients', type=int, nargs='+', default=[4, 16], help='numbers of concurrent socket clients')
+	p.add_argument('-l', '--lines', type=int, default=5000, help='lines per admin dump')
+	p.add_argument('-s', '--series', type=int, default=3, help='number of series in the data dir')
+	p.add_argument('-t', '--timeout', type=float, default=120, help='seconds to wait for the monitor')
+	p.set_defaults(func=bench_commands)
+	p = subparsers.add_parser('queries', help='cost of query_anomalies_info by the number of anomalies and their length')
+	p.add_argument('-a', '--anomalies', type=int, nargs='+', default=[10, 100], help='numbers of anomalies and normals found by ML')
+	p.add_argument('-l', '--length', type=int, nargs='+', default=[60, 360], help='samples of every anomaly')
+	p.add_argument('-n', '--queries', type=int, default=20, help='queries per case')
+	p.set_defaults(func=bench_queries)
+	p = subparsers.add_parser('collector', help='collector of envoy stats against local stand-in admin endpoints')
+	p.add_argument('-p', '--pods', type=int, default=50, help='number of pods')
+	p.add_argument('-s', '--slow', type=int, default=2, help='number of pods answering after the timeout')
+	p.add_argument('-l', '--lines', type=int, default=2000, help='lines of stats per pod')
+	p.add_argument('-c', '--concurrency', type=int, default=16, help='max number of simultaneous scrapes')
+	p.add_argument('-t', '--timeout', type=float, default=1.0, help='per pod scrape timeout in seconds')
+	p.add_argument('-d', '--delay', type=float, default=0.05, help='answer delay of the other pods in seconds')
+	p.set_defaults(func=bench_collector)
+	p = subparsers.add_parser('backfill', help='bulk reading of the history at warm up against reading it file by file')
+	p.add_argument('-l', '--lines', type=int, default=5000, help='lines per admin dump')
+	p.add_argument('-s', '--series', type=int, default=200, help='number of series in the data dir')
+	p.add_argument('--tolerance', type=float, default=1e-9, help='largest allowed relative difference of the stats')
+	p.set_defaults(func=bench_backfill)
+	args = parser.parse_args()
+	args.func(args)
+
+if __name__ == '__main__':
+	main()
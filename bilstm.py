@@ -0,0 +1,62 @@
+import numpy as np
+
+
+def sigmoid(x):
+    # Same as the logistic function, without overflows of exp for large negative values
+    return 0.5 * (1.0 + np.tanh(0.5 * x))
+
+
+# Forward pass of the Bidirectional(LSTM) + Dense model built by AnomalyDetection, in NumPy only,
+# so the trained models are scored without TensorFlow and without the overhead of model.predict.
+# Weights are in the order of model.get_weights(): kernel, recurrent kernel and bias of the forward
+# and of the backward LSTM (gates i, f, c, o), then kernel and bias of the dense layer.
+# All the rows of all the columns go through every step of the LSTM at once.
+class BiLSTM(object):
+    def __init__(self, weights):
+        self.weights = [np.asarray(w, dtype=np.float32) for w in weights]
+        if len(self.weights) != 8:
+            raise ValueError('Expected 8 weight arrays of Bidirectional(LSTM) + Dense, got %d' % len(self.weights))
+        self.forward = self.weights[0:3]
+        self.backward = self.weights[3:6]
+        self.kernel, self.bias = self.weights[6:8]
+        self.units = self.forward[1].shape[0]
+        self.features_n = self.kernel.shape[1]
+
+    @classmethod
+    def from_model(cls, model):
+        return cls(model.get_weights())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls([f['arr_%d' % i] for i in range(len(f.files))])
+
+    def save(self, path):
+        # Path must end with .npz, otherwise numpy adds it
+        np.savez(path, *self.weights)
+
+    # Takes the same input as model.predict: (rows, steps, 1), returns (rows, features)
+    def predict(self, x, verbose=0):
+        x = np.asarray(x, dtype=np.float32)
+        if x.ndim == 2:
+            x = x[:, :, np.newaxis]
+        h = np.concatenate((self.__lstm(x, *self.forward), self.__lstm(x[:, ::-1], *self.backward)), axis=1)
+        return h @ self.kernel + self.bias
+
+    # Returns the last output of the LSTM over the steps of x
+    def __lstm(self, x, kernel, recurrent, bias):
+        units = self.units
+        rows, steps = x.shape[0], x.shape[1]
+        # Input part of the gates of all the steps at once
+        gates_x = x @ kernel + bias
+        h = np.zeros((rows, units), dtype=np.float32)
+        c = np.zeros((rows, units), dtype=np.float32)
+        for t in range(steps):
+            z = gates_x[:, t] + h @ recurrent
+            i = sigmoid(z[:, :units])
+            f = sigmoid(z[:, units:2 * units])
+            g = np.tanh(z[:, 2 * units:3 * units])
+            o = sigmoid(z[:, 3 * units:])
+            c = f * c + i * g
+            h = o * np.tanh(c)
+        return h
@@ -0,0 +1,43 @@
+# Checkpoints of the live state of the monitor, see Monitor.checkpoint.
+# The state is pickled in the monitor thread and written to the file in background, the file is
+# replaced only when it is complete. A checkpoint of another version is not used, in that case
+# the monitor replays the whole history as before.
+
+import logging
+import os
+import pickle
+from os.path import isfile
+
+# Version 2 keeps the series of the pods
+CHECKPOINT_VERSION = 2
+# Checkpoint is kept next to the reference file unless its path is given
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+
+def dump_checkpoint(state):
+	return pickle.dumps((CHECKPOINT_VERSION, state), pickle.HIGHEST_PROTOCOL)
+
+def write_checkpoint(path, data):
+	try:
+		with open(path + '.tmp', 'wb') as f:
+			f.write(data)
+		os.replace(path + '.tmp', path)
+		logging.info("Saved checkpoint %s of %s bytes", path, str(len(data)))
+	except OSError as e:
+		logging.error("ERROR in saving checkpoint %s", path)
+		logging.error(e, exc_info=True)
+
+# Returns the saved state or None if there is no usable checkpoint
+def load_checkpoint(path):
+	if not isfile(path):
+		return None
+	try:
+		with open(path, 'rb') as f:
+			version, state = pickle.load(f)
+	except Exception as e:
+		logging.error("Checkpoint %s can not be read: %s", path, str(e))
+		return None
+	if version != CHECKPOINT_VERSION:
+		logging.info("Checkpoint %s has version %s, expected %s", path, str(version), str(CHECKPOINT_VERSION))
+		return None
+	return state
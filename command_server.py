@@ -0,0 +1,191 @@
+# Command server of the background mode.
+# Commands are read from stdin as before, NUL terminated JSON objects with a promise file for the result, and
+# optionally from clients of a Unix domain socket and of HTTP on localhost, which get the result back inline:
+#   socket: send {"command": "query_load"}\0 and read the JSON result up to \0, several commands per connection
+#   HTTP: curl -H 'Content-Type: application/json' -d '{"command": "query_load"}' http://localhost:PORT/
+#   or curl http://localhost:PORT/query_load for the queries which do not change the monitor.
+# Commands which change the monitor need POST of JSON, which a web page can send only after a CORS preflight.
+# Connections are served concurrently by asyncio, the commands are run one at a time in a separate thread,
+# so a long command (e.g. toggle_learning, which saves the pods) does not hold reading of the other requests.
+
+import asyncio
+import json
+import logging
+import os
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+# Longest command accepted from a client
+MAX_REQUEST = 1 << 20
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 405: 'Method Not Allowed', 413: 'Payload Too Large', 415: 'Unsupported Media Type'}
+# Commands allowed by GET
+GET_COMMANDS = ['query_load', 'query_anomalies_info', 'is_learning']
+
+
+def parse_command(data):
+	try:
+		return json.loads(data.decode())
+	except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+		return None
+
+# Command of an HTTP request: the JSON body of POST or GET /command?name=value
+def http_command(method, target, body):
+	if method == 'POST':
+		return parse_command(body)
+	url = urlsplit(target)
+	command = dict(parse_qsl(url.query))
+	command['command'] = url.path.strip('/')
+	# The version is a number or null as in the JSON commands, see Servant._set_versioned
+	if 'version' in command:
+		command['version'] = parse_command(command['version'].encode())
+	return command
+
+def http_response(status, value, keep_alive):
+	body = json.dumps(value).encode()
+	head = 'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n' % (
+		status, HTTP_STATUS[status], len(body), 'keep-alive' if keep_alive else 'close')
+	return head.encode() + body
+
+
+# Execute takes the command (None if it is not valid JSON) and whether the result is sent inline,
+# and returns whether the monitor goes on along with the result
+class CommandServer:
+
+	def __init__(self, execute, socket_path=None, http_port=None):
+		self.execute = execute
+		self.socket_path = socket_path
+		self.http_port = http_port
+		self.executor = ThreadPoolExecutor(1)
+		self.loop = None
+		self.done = None
+
+	def run(self):
+		try:
+			asyncio.run(self.serve())
+		finally:
+			self.executor.shutdown()
+
+	async def serve(self):
+		self.loop = asyncio.get_running_loop()
+		self.done = asyncio.Event()
+		servers = []
+		if self.socket_path:
+			self.remove_socket()
+			servers.append(await asyncio.start_unix_server(self.serve_socket, path=self.socket_path, limit=MAX_REQUEST))
+			logging.info("Serving commands on socket %s", self.socket_path)
+		if self.http_port:
+			servers.append(await asyncio.start_server(self.serve_http, '127.0.0.1', self.http_port, limit=MAX_REQUEST))
+			logging.info("Serving commands on http://127.0.0.1:%s", str(self.http_port))
+		commands = asyncio.Queue()
+		# Blocking reads of stdin are left to a daemon thread, so they do not hold the exit when a client quits
+		threading.Thread(target=self.read_stdin, args=(commands,), daemon=True).start()
+		stdin = asyncio.create_task(self.serve_stdin(commands))
+		try:
+			await self.done.wait()
+		finally:
+			stdin.cancel()
+			for server in servers:
+				server.close()
+				await server.wait_closed()
+			if self.socket_path:
+				self.remove_socket()
+
+	# Only a socket left by a previous run is removed, not a file given by mistake
+	def remove_socket(self):
+		try:
+			mode = os.stat(self.socket_path).st_mode
+		except FileNotFoundError:
+			return
+		if not stat.S_ISSOCK(mode):
+			raise FileExistsError("%s exists and is not a socket" % self.socket_path)
+		os.remove(self.socket_path)
+
+	async def run_command(self, command, inline):
+		go_on, value = await self.loop.run_in_executor(self.executor, self.execute, command, inline)
+		if not go_on:
+			self.done.set()
+		return value
+
+	def read_stdin(self, commands):
+		buffer = b''
+		while True:
+			try:
+				data = os.read(0, 1024)
+			except OSError:
+				data = b''
+			buffer += data
+			*lines, buffer = buffer.split(b'\0')
+			# None tells that stdin is closed
+			for line in lines + ([] if data else [None]):
+				try:
+					self.loop.call_soon_threadsafe(commands.put_nowait, line)
+				except RuntimeError:
+					# The loop is closed after quit
+					return
+			if not data:
+				break
+
+	async def serve_stdin(self, commands):
+		while True:
+			line = await commands.get()
+			# The monitor stops when stdin is closed
+			if line is None:
+				self.done.set()
+				break
+			await self.run_command(parse_command(line), False)
+
+	async def serve_socket(self, reader, writer):
+		try:
+			while not self.done.is_set():
+				try:
+					data = await reader.readuntil(b'\0')
+				except asyncio.IncompleteReadError:
+					break
+				value = await self.run_command(parse_command(data[:-1]), True)
+				writer.write(json.dumps(value).encode() + b'\0')
+				await writer.drain()
+		except asyncio.LimitOverrunError:
+			logging.error("Command on socket %s is longer than %s bytes", self.socket_path, str(MAX_REQUEST))
+		except ConnectionError:
+			pass
+		finally:
+			writer.close()
+
+	async def serve_http(self, reader, writer):
+		try:
+			keep_alive = True
+			while keep_alive and not self.done.is_set():
+				try:
+					head = await reader.readuntil(b'\r\n\r\n')
+				except asyncio.IncompleteReadError:
+					break
+				lines = head.decode('latin-1').split('\r\n')
+				request = lines[0].split()
+				headers = dict((name.strip().lower(), value.strip()) for name, _, value in (line.partition(':') for line in lines[1:] if line))
+				keep_alive = headers.get('connection', '').lower() != 'close'
+				length = int(headers.get('content-length', '0') or 0)
+				if len(request) != 3:
+					status, value, keep_alive = 400, {'error': 'bad request line'}, False
+				elif length > MAX_REQUEST:
+					status, value, keep_alive = 413, {'error': 'command is too long'}, False
+				elif request[0] not in ['GET', 'POST']:
+					status, value = 405, {'error': 'use GET or POST'}
+					await reader.readexactly(length)
+				elif request[0] == 'POST' and headers.get('content-type', '').split(';')[0].strip().lower() != 'application/json':
+					status, value = 415, {'error': 'use Content-Type: application/json'}
+					await reader.readexactly(length)
+				else:
+					body = await reader.readexactly(length)
+					command = http_command(request[0], request[1], body)
+					if request[0] == 'GET' and command['command'] not in GET_COMMANDS:
+						status, value = 405, {'error': 'use POST for %s' % command['command']}
+					else:
+						status, value = 200, await self.run_command(command, True)
+				writer.write(http_response(status, value, keep_alive))
+				await writer.drain()
+		except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+			pass
+		finally:
+			writer.close()
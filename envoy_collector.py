@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+# Concurrent collector of envoy admin /stats for all running pods.
+# Produces the same layout as envoy_stats.sh: "pods.<timestamp>" with pod/node
+# names and "<pod>.<timestamp>" with the stats of each pod, which is what
+# Monitor.prepare_file_series consumes.
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from os.path import join
+from urllib.parse import urlsplit
+
+from file_index import append_journal
+
+COLLECT_PERIOD = 5
+DEFAULT_CONCURRENCY = 32
+DEFAULT_TIMEOUT = 3.0
+DEFAULT_GREP = '9080'
+STASH = 'intermediate'
+
+# url is None when stats are to be taken through "kubectl exec" as envoy_stats.sh does
+PodTarget = namedtuple('PodTarget', ['name', 'node', 'url'])
+
+
+def get_timestamp():
+	# Same format as "date -Iseconds", e.g. 2020-06-01T10:00:00+00:00
+	return datetime.datetime.now().astimezone().isoformat(timespec='seconds')
+
+
+async def run_command(*args):
+	process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+	try:
+		stdout, _ = await process.communicate()
+	except asyncio.CancelledError:
+		process.kill()
+		raise
+	if process.returncode != 0:
+		raise RuntimeError('"' + ' '.join(args) + '" exited with ' + str(process.returncode))
+	return stdout
+
+
+async def fetch_http(url):
+	parts = urlsplit(url)
+	path = parts.path or '/'
+	if parts.query:
+		path += '?' + parts.query
+	reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+	try:
+		writer.write(('GET ' + path + ' HTTP/1.0\r\nHost: ' + parts.netloc + '\r\n\r\n').encode())
+		await writer.drain()
+		response = await reader.read()
+	finally:
+		writer.close()
+	head, _, body = response.partition(b'\r\n\r\n')
+	status = head.split(b'\r\n', 1)[0].split()
+	if len(status) < 2 or status[1] != b'200':
+		raise RuntimeError('Bad response from ' + url + ': ' + head.split(b'\r\n', 1)[0].decode(errors='replace'))
+	return body
+
+
+async def fetch_kubectl(pod):
+	return await run_command('kubectl', 'exec', pod, '-c', 'istio-proxy', '--', 'sh', '-c', 'curl -s localhost:15000/stats')
+
+
+async def discover_pods(url_template=None):
+	stdout = await run_command('kubectl', 'get', 'pods', '-o', 'json', '--field-selector=status.phase=Running')
+	pods = []
+	for item in json.loads(stdout).get('items', []):
+		status = item.get('status', {})
+		node = item.get('spec', {}).get('nodeName', '')
+		if status.get('hostIP'):
+			node += '/' + status['hostIP']
+		url = None
+		if url_template:
+			url = url_template.format(ip=status.get('podIP', ''), name=item['metadata']['name'])
+		pods.append(PodTarget(item['metadata']['name'], node, url))
+	return pods
+
+
+class Collector:
+
+	def __init__(self, path, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT, grep=DEFAULT_GREP):
+		self.path = path
+		self.concurrency = concurrency
+		self.timeout = timeout
+		self.grep = grep.encode() if grep else None
+
+	def filter_stats(self, body):
+		if not self.grep:
+			return body
+		lines = [row for row in body.splitlines(True) if self.grep in row]
+		return b''.join(lines)
+
+	def write_pods_info(self, pods, timestamp):
+		# Same rows as from "kubectl describe pods | grep -w '^Name:\|^Node:'", read by Pod.get_node
+		with open(join(self.path, 'pods.' + timestamp), 'w') as f:
+			for pod in pods:
+				f.write('Name:         ' + pod.name + '\nNode:         ' + pod.node + '\n')
+
+	def write_stats(self, pod, timestamp, body):
+		# Write into a stash first so that the monitor never sees partially written files
+		stash = join(self.path, STASH + '-' + pod.name)
+		with open(stash, 'wb') as f:
+			f.write(body)
+		fname = pod.name + '.' + timestamp
+		os.replace(stash, join(self.path, fname))
+		append_journal(self.path, fname)
+		return fname
+
+	async def scrape_pod(self, pod, timestamp, semaphore):
+		async with semaphore:
+			try:
+				if pod.url:
+					body = await asyncio.wait_for(fetch_http(pod.url), self.timeout)
+				else:
+					body = await asyncio.wait_for(fetch_kubectl(pod.name), self.timeout)
+			except (asyncio.TimeoutError, OSError, RuntimeError) as e:
+				logging.error("ERROR scraping pod %s: %s", pod.name, str(e) or type(e).__name__)
+				return None
+		return self.write_stats(pod, timestamp, self.filter_stats(body))
+
+	async def collect(self, pods, timestamp=None):
+		if not timestamp:
+			timestamp = get_timestamp()
+		self.write_pods_info(pods, timestamp)
+		semaphore = asyncio.Semaphore(self.concurrency)
+		fnames = await asyncio.gather(*[self.scrape_pod(pod, timestamp, semaphore) for pod in pods])
+		return timestamp, [fname for fname in fnames if fname]
+
+	async def run(self, url_template=None, period=COLLECT_PERIOD):
+		while True:
+			start = time.monotonic()
+			try:
+				pods = await discover_pods(url_template)
+				timestamp, fnames = await self.collect(pods)
+				logging.info("Stored %s of %s pods for %s in %.2fs", len(fnames), len(pods), timestamp, time.monotonic() - start)
+			except (OSError, RuntimeError, ValueError) as e:
+				logging.error("ERROR collecting stats: %s", str(e))
+			await asyncio.sleep(max(0, period - (time.monotonic() - start)))
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('path', nargs='?', default='.', help='metrics dir')
+	parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='max number of simultaneous scrapes')
+	parser.add_argument('-t', '--timeout', type=float, default=DEFAULT_TIMEOUT, help='per pod scrape timeout in seconds')
+	parser.add_argument('-u', '--url', help='admin url template instead of kubectl exec, e.g. http://{ip}:15000/stats')
+	parser.add_argument('-g', '--grep', default=DEFAULT_GREP, help='keep only stats rows containing this string')
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+	collector = Collector(args.path, args.concurrency, args.timeout, args.grep)
+	try:
+		asyncio.run(collector.run(args.url))
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == '__main__':
+	main()
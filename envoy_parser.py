@@ -0,0 +1,112 @@
+# Streaming parser of envoy admin /stats text.
+# Decisions about a metric key (filtered out or not, gauge or counter) are taken once per key
+# and memoized, so every subsequent file costs one dict lookup per row.
+
+import logging
+
+from metric_registry import registry
+
+gauges = ['_buffered', '_active', 'uptime', 'concurrency', '_allocated', '_size', '.live', '.state', '_connections',
+					'version', '_expiring', '_epoch', '_clusters', '_clusters', '_healthy','_degraded', '_total',	'_weight',
+					'.healthy', '_open', '_cx', '_pending', '_rq', '_retries', 	'.size', '_per_host', 'gradient', '_limit',
+					'_size', '_msecs', '_faults', '_warming', '_draining', '_started', '_keys', '_layers', '.active', '_requests']
+
+exclude_keys = ['version', 'istio', 'prometheus', 'grafana', 'nginx', 'kube', 'jaeger', 'BlackHole', 'grpc', 'zipkin', 'mixer', 'rq_timeout', 'external', 'internal']
+include_keys = ['rq_time']
+
+# Quantile taken from histograms, its interval value is used as the metric value
+HISTO_QUANTILE = 'P75'
+HISTO_EMPTY = 'nan'
+EMPTY = ' No recorded values'
+
+
+def exclude_row(key):
+	for exclude in exclude_keys:
+		if exclude in key:
+			return True
+	if not '9080' in key:
+		return True
+	for include in include_keys:
+		if include in key:
+			return False
+	return True
+
+def is_gauge(key):
+	for item in gauges:
+		if key.endswith(item):
+			return True
+	return False
+
+# Returns interval value of the quantile from histogram value like " P0(nan,1) P25(nan,2) ... P75(3.5,4) ..."
+def get_quantile(value, tag):
+	i = value.find(tag)
+	while i > 0 and value[i - 1] != ' ':
+		i = value.find(tag, i + 1)
+	if i < 0:
+		return None
+	start = i + len(tag)
+	end = start
+	while end < len(value) and value[end] not in ',)':
+		end += 1
+	return value[start:end]
+
+
+class EnvoyStatsParser:
+
+	def __init__(self, prefix, excluded=None, quantile=HISTO_QUANTILE):
+		# Prefix: pod name prepended to every metric key
+		self.prefix = prefix + '|'
+		# Excluded: full keys of filtered out metrics
+		self.excluded = excluded if excluded is not None else set()
+		self.quantile_tag = quantile + '('
+		# Keys: stats key -> (metric id, 'G' or 'C'), or (full key, None) for filtered out keys
+		self.keys = {}
+
+	# The memoized keys are cheap to rebuild so they are not saved along with pods
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['keys'] = {}
+		return state
+
+	def classify(self, stats_key):
+		key = self.prefix + stats_key
+		if exclude_row(key):
+			self.excluded.add(key)
+			kind = None
+		elif is_gauge(key):
+			kind = 'G'
+		else:
+			kind = 'C'
+		if kind is not None:
+			key = registry.intern(key)
+		self.keys[stats_key] = (key, kind)
+		return key, kind
+
+	# Yields (metric id, value, empty, kind) for every not filtered out row of the stream
+	def parse(self, stream, fname=''):
+		keys = self.keys
+		tag = self.quantile_tag
+		for row in stream:
+			stats_key, sep, value = row.partition(':')
+			if not sep:
+				if row.strip():
+					logging.error("ERROR parsing value: %s %s", fname, row.rstrip('\r\n'))
+				continue
+			classified = keys.get(stats_key)
+			if classified is None:
+				classified = self.classify(stats_key)
+			key, kind = classified
+			if kind is None:
+				continue
+			value = value.rstrip('\r\n')
+			if ':' in value:
+				value = value.partition(':')[0]
+			if 'P0(' in value:
+				hvalue = get_quantile(value, tag)
+				if hvalue is not None:
+					# Not adding the quantile postfix to the key because it's a single percentile we take now and also
+					# When there is "No recorded value" it's being added as a non-histo metric without "|P75" postfix
+					# and ruins evenness of the global matrix
+					yield key, hvalue, HISTO_EMPTY, 'H'
+			else:
+				yield key, value, EMPTY, kind
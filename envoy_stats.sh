@@ -3,8 +3,19 @@
 DIR=${1:-"."}
 THIS=$$
 STASH=intermediate
+JOURNAL=journal
+# Journal is rotated into journal.1 over this size, see file_index.py
+JOURNAL_MAX=16777216
 RECORDINGS=${DIR}/../recordings
 
+function append_journal() {
+	echo "$1" >> ${DIR}/${JOURNAL}
+	if [[ $(stat -c %s ${DIR}/${JOURNAL}) -gt ${JOURNAL_MAX} ]]
+	then
+		mv ${DIR}/${JOURNAL} ${DIR}/${JOURNAL}.1
+	fi
+}
+
 function delay() {
 	local p=$1
 	local N=$(date +%s)
@@ -45,6 +56,7 @@ then
 					if [[ 0 -eq $? ]]
 					then
 						mv ${DIR}/$STASH ${DIR}/$pod.$w
+						append_journal "$pod.$w"
 					fi
 				done
 			done
@@ -67,6 +79,7 @@ do
 		if [[ 0 -eq $? ]]
 		then
 			mv ${DIR}/$STASH ${DIR}/$pod.$d
+			append_journal "$pod.$d"
 		fi
 	done
 	delay $n
@@ -0,0 +1,53 @@
+# Grouping of metrics with equal normalized values.
+# Points (norm_last_value, norm_avg) are bucketed into a grid with cells sized by the equality threshold,
+# so a metric is compared only with the metrics from its own and adjacent cells instead of all the others.
+
+import math
+
+
+class EqualityGrid:
+
+	def __init__(self, threshold):
+		# Cells are slightly larger than the threshold so that equal points never end up two cells apart
+		self.size = threshold * (1 + 1e-9)
+		# Cells: (column, row) -> list of (order, result) in the order of adding
+		self.cells = {}
+
+	def cell(self, x, y):
+		return math.floor(x / self.size), math.floor(y / self.size)
+
+	def add(self, x, y, order, result):
+		self.cells.setdefault(self.cell(x, y), []).append((order, result))
+
+	def neighbours(self, x, y):
+		column, row = self.cell(x, y)
+		for i in (column - 1, column, column + 1):
+			for j in (row - 1, row, row + 1):
+				cell = self.cells.get((i, j))
+				if cell:
+					yield from cell
+
+
+# Equals out every candidate result with the first preceding candidate which is equal to it and belongs to the same group,
+# the same way as comparing it with all the preceding candidates one by one.
+# Items are all the results in order, x and y are their normalized last values and averages,
+# candidates are the positions of not discarded results in ascending order
+def group_equals(items, x, y, candidates, threshold):
+	grid = EqualityGrid(threshold)
+	for order in candidates:
+		result = items[order]
+		point_x = x[order]
+		point_y = y[order]
+		# Results with infinite or undefined values are never equal to anything
+		if not (math.isfinite(point_x) and math.isfinite(point_y)):
+			continue
+		primary = None
+		for order2, result2 in grid.neighbours(point_x, point_y):
+			if ((primary is None or order2 < primary) and result2.primary_equal == result.primary_equal and
+					abs(point_x - x[order2]) <= threshold and abs(point_y - y[order2]) <= threshold):
+				primary = order2
+		if primary is None:
+			# Only results left not equaled out can be primary equals for the following ones
+			grid.add(point_x, point_y, order, result)
+		else:
+			result.join_equal(items[primary])
@@ -0,0 +1,159 @@
+# Incremental index of the stats files in the metrics dir.
+# Collectors append the name of every stored "<pod>.<timestamp>" file to the journal,
+# so each poll reads only the journal tail instead of listing the whole dir.
+# Writers rotate the journal into "journal.1" when it grows over JOURNAL_MAX, the index reads the rest
+# of the rotated one before the new one.
+# For dirs without journal (e.g. old recordings) it falls back to listing the dir whenever its mtime
+# changes and looking only for the names not seen before.
+
+import logging
+import os
+import time
+from os.path import isfile, join
+
+JOURNAL = 'journal'
+ROTATED_SUFFIX = '.1'
+JOURNAL_MAX = 16 * 1024 * 1024
+# Listing of the dir is not trusted for changes made this close to its mtime, which may have the same mtime
+MTIME_GRANULARITY = 1000000000
+
+
+def append_journal(path, fname):
+	journal = join(path, JOURNAL)
+	with open(journal, 'a') as f:
+		f.write(fname + '\n')
+		size = f.tell()
+	if size > JOURNAL_MAX:
+		os.replace(journal, journal + ROTATED_SUFFIX)
+
+# Returns the complete rows of the file after offset and their size
+def read_rows(f, offset):
+	f.seek(offset)
+	contents = f.read()
+	# Only complete rows are taken, the rest is read on the next poll
+	end = contents.rfind('\n') + 1
+	return contents[:end].splitlines(), len(contents[:end].encode())
+
+
+class FileIndex:
+
+	def __init__(self, path, pod_names):
+		self.path = path
+		self.pod_names = pod_names
+		self.pods_count = len(pod_names)
+		# Journal offset: position in journal up to which the files are indexed
+		self.journal_offset = None
+		# Journal inode: the journal read so far, it is in the rotated journal once it is replaced
+		self.journal_inode = None
+		# Known: names of files seen so far, used only when there is no journal
+		self.known = None
+		# Scanned mtime: mtime of the dir when it was listed, it is not listed again until it changes
+		self.scanned_mtime = None
+		# Prefixes: full pod name -> names of monitored pods it belongs to
+		self.prefixes = {}
+		# Pending: timestamp -> set of files for not yet complete series
+		self.pending = {}
+		# Completed: the latest complete timestamp, files with older timestamps are not awaited anymore
+		self.completed = ''
+		# Latest: the latest timestamp encountered
+		self.latest = ''
+
+	# Position: what is indexed so far, saved in the monitor checkpoints
+	def position(self):
+		return {'journal_offset': self.journal_offset, 'journal_inode': self.journal_inode, 'known': self.known, 'pending': self.pending,
+				'completed': self.completed, 'latest': self.latest}
+
+	# Continues indexing from the saved position, only the files added after it are returned by poll
+	def restore(self, position):
+		self.__dict__.update(position)
+
+	def get_pods(self, pod_name):
+		pods = self.prefixes.get(pod_name)
+		if pods is None:
+			pods = [name for name in self.pod_names if pod_name.startswith(name)]
+			self.prefixes[pod_name] = pods
+		return pods
+
+	def read_journal(self):
+		journal = join(self.path, JOURNAL)
+		if self.journal_offset is None:
+			# First poll: take the journal position and then index everything which is already there
+			if isfile(journal):
+				stat = os.stat(journal)
+				self.journal_offset, self.journal_inode = stat.st_size, stat.st_ino
+			else:
+				self.journal_offset = 0
+			return self.scan()
+		if not isfile(journal):
+			return self.scan()
+		rows = []
+		with open(journal, 'r') as f:
+			stat = os.fstat(f.fileno())
+			if stat.st_size < self.journal_offset or self.journal_inode not in [None, stat.st_ino]:
+				rows = self.read_rotated(journal + ROTATED_SUFFIX)
+				self.journal_offset = 0
+			self.journal_inode = stat.st_ino
+			new_rows, size = read_rows(f, self.journal_offset)
+		self.journal_offset += size
+		return rows + new_rows
+
+	# Returns the rest of the journal read so far if it was rotated
+	def read_rotated(self, rotated):
+		try:
+			with open(rotated, 'r') as f:
+				stat = os.fstat(f.fileno())
+				# Offsets saved without the inode are taken as of the rotated journal if it is that long
+				if stat.st_ino == self.journal_inode or self.journal_inode is None and stat.st_size >= self.journal_offset:
+					logging.info("Journal was rotated, reading the rest of %s", rotated)
+					return read_rows(f, self.journal_offset)[0]
+		except FileNotFoundError:
+			pass
+		logging.info("Journal in %s was truncated, reading from the start", self.path)
+		return []
+
+	def scan(self):
+		mtime = os.stat(self.path).st_mtime_ns
+		if self.known is not None and mtime == self.scanned_mtime:
+			return []
+		listed = time.time_ns()
+		fnames = [f for f in os.listdir(self.path) if "+" in f]
+		self.scanned_mtime = mtime if listed - mtime > MTIME_GRANULARITY else None
+		if self.known is not None:
+			fnames = [f for f in fnames if f not in self.known]
+			self.known.update(fnames)
+		elif not isfile(join(self.path, JOURNAL)):
+			self.known = set(fnames)
+		return fnames
+
+	def add(self, fname):
+		try:
+			pod_name, timestamp = fname.split('.')
+		except ValueError:
+			return
+		if not self.get_pods(pod_name) or timestamp <= self.completed:
+			return
+		if timestamp not in self.pending:
+			self.pending[timestamp] = set()
+		self.pending[timestamp].add(fname)
+		if timestamp > self.latest:
+			self.latest = timestamp
+
+	# Returns a list of (timestamp, {pod name: [files]}) for the series completed since the last poll
+	def poll(self):
+		for fname in self.read_journal():
+			self.add(fname)
+		series = []
+		for timestamp in sorted(self.pending.keys()):
+			fnames = self.pending[timestamp]
+			if len(fnames) < self.pods_count:
+				continue
+			pod_files = {}
+			for fname in sorted(fnames):
+				for pod_name in self.get_pods(fname.split('.')[0]):
+					pod_files.setdefault(pod_name, []).append(fname)
+			series.append((timestamp, pod_files))
+			self.completed = timestamp
+		# Series older than the latest complete one are not going to be processed anymore
+		for timestamp in [t for t in self.pending.keys() if t <= self.completed]:
+			del self.pending[timestamp]
+		return series
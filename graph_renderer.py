@@ -0,0 +1,88 @@
+# Rendering of anomaly graphs in a separate process.
+# ML workers and the monitor only put drawing requests into the queue, so neither of them waits
+# for matplotlib. The renderer takes all the queued requests at once and keeps only the latest one
+# for every metric, so a metric requested several times is drawn once, and skips the metrics
+# already drawn with the same samples and ranges.
+
+import datetime
+import logging
+import multiprocessing
+import queue
+
+import numpy as np
+
+k1 = '#DC7633'
+k2 = '#E74C3C'
+
+
+def pyplot():
+	import matplotlib as mpl
+	mpl.use('Agg')
+	from matplotlib import pyplot as plt
+	return plt
+
+# Ranges are bucket -> list of (start, end) samples, like the ranges of the anomalies found by ML
+def draw_figure(name, ts, ranges):
+	plt = pyplot()
+	fname = name + '.' + str(datetime.datetime.now()) + '.png'
+	fig, ax = plt.subplots(1, 1, figsize=(6, 4))
+	ax.plot(np.arange(ts.shape[0]), ts)
+	for k in ranges.keys():
+		for start, end in ranges[k]:
+			c = k1 if k == 1 else k2
+			ax.axvspan(start, end-1, color=c, alpha = 0.16 * k)
+	fig.savefig(fname)
+	plt.close(fig)
+	return fname
+
+
+def run_renderer(requests):
+	drawn = {}
+	while True:
+		request = requests.get()
+		pending = {}
+		while request is not None:
+			name, ts, ranges = request
+			pending.pop(name, None)
+			pending[name] = (ts, ranges)
+			try:
+				request = requests.get_nowait()
+			except queue.Empty:
+				break
+		for name, (ts, ranges) in pending.items():
+			version = (hash(ts.tobytes()), str(ranges))
+			if drawn.get(name) == version:
+				continue
+			try:
+				logging.info("Drawn graph %s", draw_figure(name, ts, ranges))
+				drawn[name] = version
+			except Exception as e:
+				logging.error("ERROR in drawing graph of %s", name)
+				logging.error(e, exc_info=True)
+		if request is None:
+			break
+
+
+# Client side of the renderer, it is passed to the ML workers along with its queue
+class GraphRenderer:
+
+	def __init__(self):
+		context = multiprocessing.get_context('spawn')
+		self.requests = context.Queue()
+		self.process = context.Process(target=run_renderer, args=(self.requests,))
+		self.process.daemon = True
+
+	def __getstate__(self):
+		return {'requests': self.requests, 'process': None}
+
+	def start(self):
+		self.process.start()
+
+	def stop(self):
+		self.requests.put(None)
+		self.process.join(10)
+		# Graphs not drawn by now are dropped instead of waiting for the queue to be read
+		self.requests.cancel_join_thread()
+
+	def draw(self, name, ts, ranges={}):
+		self.requests.put((name, np.asarray(ts, dtype=float), ranges))
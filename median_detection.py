@@ -0,0 +1,57 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Number of preceding samples the median is taken over
+MEDIAN_WINDOW = 5
+# Scales median absolute deviation to standard deviation of normally distributed values
+MAD_SCALE = 1.4826
+
+
+# Detector with the same results as AnomalyDetection, but the series is reconstructed by
+# the rolling median of its preceding samples instead of a trained model.
+# Series are split into the same samples, which are scored by robust z-score of their errors.
+class MedianDetection(object):
+    def __init__(self, base_sample_size, window=MEDIAN_WINDOW):
+        self.kernel_n = base_sample_size
+        self.window = window
+
+    def find_anomalies(self, series, bins=[2, 3, 4], verbose=0, key=None):
+        return self.find_anomalies_batch([series], bins)[0]
+
+    def find_anomalies_batch(self, series, bins=[2, 3, 4], verbose=0, key=None):
+        X = np.array(series, dtype=float)
+        X = (X - X.mean(axis=1, keepdims=True)) / (X.std(axis=1, keepdims=True) + 0.00001)
+        columns_n, length = X.shape
+        samples_n = self.kernel_n
+        features_n = int(length / samples_n)
+        offset = length % samples_n
+
+        # Median of the window before every sample, the first samples are compared with the first one
+        padded = np.concatenate((np.repeat(X[:, :1], self.window, axis=1), X), axis=1)
+        median = np.median(sliding_window_view(padded, self.window, axis=1)[:, :length], axis=-1)
+        error = (X - median)[:, offset:].reshape(columns_n, samples_n, features_n)
+        dist = np.linalg.norm(error, axis=-1)
+
+        center = np.median(dist, axis=1, keepdims=True)
+        deviation = np.abs(dist - center)
+        scale = MAD_SCALE * np.median(deviation, axis=1, keepdims=True)
+        scale = np.where(scale > 0, scale, dist.std(axis=1, keepdims=True))
+        t_stat = deviation / (scale + 0.00001)
+        buckets = np.searchsorted(bins, t_stat, side='right')
+
+        results = []
+        for n in range(columns_n):
+            if np.count_nonzero(X[n]) == 0:
+                results.append(({}, {}, {}))
+                continue
+            ranges = {}
+            positions = {}
+            for i in range(len(bins)):
+                ranges[i+1] = []
+                positions[i+1] = []
+            for i in np.flatnonzero(buckets[n]).tolist():
+                bucket = int(buckets[n, i])
+                ranges[bucket].append((offset + i * features_n, offset + (i + 1) * features_n))
+                positions[bucket].append(i + 1)
+            results.append((samples_n, ranges, positions))
+        return results
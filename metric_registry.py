@@ -0,0 +1,75 @@
+# Registry of metric keys like "reviews-v1|cluster.inbound|9080|http|reviews.default.svc.cluster.local.upstream_rq_time".
+# Every key gets a stable integer id which is used for indexing everywhere in the hot paths,
+# the strings are looked up only for display and reports.
+
+
+class MetricRegistry:
+
+	def __init__(self):
+		# Names: id -> key
+		self.names = []
+		# Ids: key -> id
+		self.ids = {}
+		# Counter: shared counter to take new ids from when the id space is shared by several processes
+		self.counter = None
+		# Added: ids added in this process since the last take_added()
+		self.added = []
+
+	def __len__(self):
+		return len(self.names)
+
+	def intern(self, key):
+		metric_id = self.ids.get(key)
+		if metric_id is None:
+			if self.counter is None:
+				metric_id = len(self.names)
+				self.names.append(key)
+				self.ids[key] = metric_id
+			else:
+				with self.counter.get_lock():
+					metric_id = self.counter.value
+					self.counter.value += 1
+				self.add(metric_id, key)
+				self.added.append(metric_id)
+		return metric_id
+
+	# Adds the key with the id taken in another process, ids of other processes are left as None
+	def add(self, metric_id, key):
+		if metric_id >= len(self.names):
+			self.names.extend([None] * (metric_id + 1 - len(self.names)))
+		self.names[metric_id] = key
+		self.ids[key] = metric_id
+
+	# Shares the id space with other processes through multiprocessing.Value counter of the next id
+	def share(self, counter):
+		self.counter = counter
+		self.added = []
+
+	# Returns (id, key) pairs added since the last call
+	def take_added(self):
+		added = [(metric_id, self.names[metric_id]) for metric_id in self.added]
+		self.added = []
+		return added
+
+	def find(self, key):
+		return self.ids.get(key)
+
+	def lookup(self, pod, metric):
+		return self.ids.get(pod + '|' + metric)
+
+	def name(self, metric_id):
+		return self.names[metric_id]
+
+	def pod(self, metric_id):
+		return self.names[metric_id].split('|', 1)[0]
+
+	def metric(self, metric_id):
+		return self.names[metric_id].split('|', 1)[1]
+
+	# Replaces the contents keeping the same registry object, as it is shared by all modules
+	def load(self, names):
+		self.names = list(names)
+		self.ids = {key: metric_id for metric_id, key in enumerate(self.names)}
+
+
+registry = MetricRegistry()
@@ -0,0 +1,350 @@
+# ML confirmation of suspected anomalies in separate processes.
+# The monitor publishes the metric matrix into a double buffered shared memory segment
+# on every tick, the workers take the rows of suspected metrics from the latest published
+# buffer without any pickling, and send back only the ML results.
+# Suspected metrics are partitioned between the workers by metric id, so every metric stays
+# in the same worker along with its cached model.
+# Graphs of the anomalies are drawn by a renderer process shared by the workers and the monitor.
+
+import logging
+import multiprocessing
+import queue
+import threading
+
+import numpy as np
+from multiprocessing import shared_memory
+
+from graph_renderer import GraphRenderer
+from metric_registry import registry
+
+# Anomaly detectors available in the worker, see anomaly_graph.detect
+DETECTORS = ['lstm', 'median', 'staged']
+STATE_PERIOD = 0.5
+# Trained models are kept in a dir next to the reference file
+MODELS_SUFFIX = '.models'
+
+# Header: version, active buffer, then rows, samples and sequence number of each buffer
+HEADER_SIZE = 8
+VERSION = 0
+ACTIVE = 1
+ROWS = 2
+SAMPLES = 4
+SEQUENCE = 6
+
+
+def attach_shared_memory(name):
+	try:
+		return shared_memory.SharedMemory(name, track=False)
+	except TypeError:
+		# Before python 3.13 the segment gets registered again in the resource tracker shared with the monitor,
+		# which is harmless as it is unregistered once the monitor unlinks it
+		return shared_memory.SharedMemory(name)
+
+
+class SharedMatrix:
+
+	def __init__(self, capacity, window, name=None):
+		self.capacity = capacity
+		self.window = window
+		size = 8 * (HEADER_SIZE + 4 * capacity + 2 * capacity * window)
+		if name:
+			self.shm = attach_shared_memory(name)
+		else:
+			self.shm = shared_memory.SharedMemory(create=True, size=size)
+		self.name = self.shm.name
+		self.header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=self.shm.buf)
+		self.ids = np.ndarray((2, capacity), dtype=np.int64, buffer=self.shm.buf, offset=8 * HEADER_SIZE)
+		# Samples ever appended to every metric, they keep growing when the rows are cut to the window
+		self.counts = np.ndarray((2, capacity), dtype=np.int64, buffer=self.shm.buf, offset=8 * (HEADER_SIZE + 2 * capacity))
+		self.data = np.ndarray((2, capacity, window), dtype=np.float64, buffer=self.shm.buf, offset=8 * (HEADER_SIZE + 4 * capacity))
+		if not name:
+			self.header[:] = 0
+
+	def close(self, unlink=False):
+		self.header = self.ids = self.counts = self.data = None
+		self.shm.close()
+		if unlink:
+			self.shm.unlink()
+
+	@property
+	def version(self):
+		return int(self.header[VERSION])
+
+	# Writer side: fills the inactive buffer and then makes it active
+	def publish(self, store):
+		buffer = 1 - int(self.header[ACTIVE])
+		self.header[SEQUENCE + buffer] += 1
+		samples = store.copy_ordered(self.data[buffer], self.ids[buffer])
+		# Rows of the store are copied in order, so their counts are in the same order as the ids
+		self.counts[buffer, :len(store)] = store.counts[:len(store)]
+		self.header[ROWS + buffer] = len(store)
+		self.header[SAMPLES + buffer] = samples
+		self.header[SEQUENCE + buffer] += 1
+		self.header[ACTIVE] = buffer
+		self.header[VERSION] += 1
+
+	# Reader side: zero-copy view of the active buffer (or of the given one), valid until the writer publishes twice more
+	def snapshot(self, buffer=None):
+		if buffer is None:
+			buffer = int(self.header[ACTIVE])
+		rows = int(self.header[ROWS + buffer])
+		samples = int(self.header[SAMPLES + buffer])
+		return buffer, self.ids[buffer, :rows], self.data[buffer, :rows, :samples]
+
+	# Reader side: copies rows of the given metrics and their counts, retrying if the buffer was rewritten meanwhile.
+	# The sequence of the buffer is taken before its header and data, and checked again after copying them
+	def read(self, metric_ids):
+		while True:
+			version = self.version
+			buffer = int(self.header[ACTIVE])
+			sequence = int(self.header[SEQUENCE + buffer])
+			if sequence % 2:
+				continue
+			buffer, ids, data = self.snapshot(buffer)
+			rows = {metric_id: row for row, metric_id in enumerate(ids.tolist())}
+			matrix = {metric_id: data[rows[metric_id]].copy() for metric_id in metric_ids if metric_id in rows}
+			counts = {metric_id: int(self.counts[buffer, rows[metric_id]]) for metric_id in matrix}
+			if sequence == int(self.header[SEQUENCE + buffer]):
+				return version, matrix, counts
+
+
+# Runs in the worker process, results are sent tagged with the worker index
+def run_worker(index, matrix_name, capacity, window, commands, results, renderer):
+	import anomaly_graph as ml
+
+	ml.renderer = renderer
+	shared = SharedMatrix(capacity, window, matrix_name)
+	state = {}
+	quit = threading.Event()
+
+	def send_state():
+		while not quit.wait(STATE_PERIOD):
+			current = {'progress': ml.progress, 'processed_column': ml.processed_column, 'anomaly_info': ml.anomaly_info}
+			if current != state:
+				state.update(current)
+				results.put((index, current))
+
+	reporter = threading.Thread(target=send_state)
+	reporter.daemon = True
+	reporter.start()
+
+	logging.info("Starting ML anomalies confirming")
+	while not quit.is_set():
+		# The monitor sends the suspected metrics after publishing every new matrix, so waiting for commands
+		# instead of polling runs a pass only when there is new data or the settings changed
+		command, value = commands.get()
+		while True:
+			if command == 'quit':
+				quit.set()
+				break
+			elif command == 'names':
+				start, names = value
+				if start == 0:
+					registry.load(names)
+				else:
+					registry.names.extend(names)
+					registry.ids.update((key, start + i) for i, key in enumerate(names))
+			elif command == 'matrix':
+				shared.close()
+				shared = SharedMatrix(value[1], value[2], value[0])
+			elif command == 'columns':
+				ml.column_filter = value
+			else:
+				setattr(ml, command, value)
+			try:
+				command, value = commands.get_nowait()
+			except queue.Empty:
+				break
+		if quit.is_set():
+			break
+
+		try:
+			if len(ml.column_filter):
+				logging.info("ML running confirming for %s", "".join(registry.name(column) for column in ml.column_filter))
+				version, matrix, counts = shared.read(ml.column_filter)
+				ml.update_matrix(matrix, ml.column_filter, counts)
+				ml.process_anomalies(logging.getLogger(), ml.column_filter)
+			else:
+				ml.anomalies_found = {}
+			results.put((index, {'anomalies_found': ml.anomalies_found, 'normals_found': ml.normals_found}))
+		except Exception as e:
+			logging.error("ERROR in ML thread")
+			logging.error(e, exc_info=True)
+	shared.close()
+
+
+# Runs in the trainer process, trains the models on the matrix published at the end of learning
+def run_trainer(matrix_name, capacity, window, names, path, ml_window, ml_history):
+	import anomaly_graph as ml
+
+	# Models are trained on the same window of the series as the workers analyse
+	ml.ml_window = ml_window
+	ml.ml_history = ml_history
+	registry.load(names)
+	shared = SharedMatrix(capacity, window, matrix_name)
+	try:
+		buffer, ids, data = shared.snapshot()
+		version, matrix, counts = shared.read(ids.tolist())
+	finally:
+		shared.close()
+	try:
+		ml.train_models(logging.getLogger(), matrix, path)
+	except Exception as e:
+		logging.error("ERROR in ML training")
+		logging.error(e, exc_info=True)
+
+
+class MLWorker:
+
+	def __init__(self, window, capacity=1024, workers=1):
+		# ML state merged from the workers
+		self.anomalies_found = {}
+		self.normals_found = {}
+		self.progress = 'Waiting'
+		self.processed_column = 'None'
+		self.anomaly_info = ''
+		# Settings forwarded to the workers
+		self.processing = False
+		self.draw_all = False
+		self.batch_size = 1
+		self.detector = DETECTORS[0]
+		self.models_path = None
+		self.ml_window = 360
+		self.ml_history = 0
+		self.column_filter = []
+
+		self.window = window
+		self.matrix = SharedMatrix(capacity, window)
+		self.names = None
+		self.names_sent = 0
+		self.lock = threading.Lock()
+		self.trainer = None
+		self.renderer = GraphRenderer()
+		# Latest results and state of every worker
+		self.found = [({}, {}) for i in range(workers)]
+		self.states = [{} for i in range(workers)]
+		context = multiprocessing.get_context('spawn')
+		self.results = context.Queue()
+		self.workers = []
+		for i in range(workers):
+			commands = context.Queue()
+			process = context.Process(target=run_worker, args=(i, self.matrix.name, capacity, window, commands, self.results, self.renderer))
+			process.daemon = True
+			self.workers.append((process, commands))
+
+	def start(self):
+		self.renderer.start()
+		for process, commands in self.workers:
+			process.start()
+		receiver = threading.Thread(target=self.receive)
+		receiver.daemon = True
+		receiver.start()
+
+	def stop(self):
+		if self.trainer:
+			self.trainer.terminate()
+		self.send('quit', None)
+		for process, commands in self.workers:
+			process.join(10)
+		self.renderer.stop()
+		self.matrix.close(unlink=True)
+
+	def send(self, command, value):
+		for process, commands in self.workers:
+			commands.put((command, value))
+
+	def receive(self):
+		while True:
+			try:
+				index, state = self.results.get()
+			except (EOFError, OSError):
+				break
+			self.update(index, state)
+
+	def update(self, index, state):
+		with self.lock:
+			if 'anomalies_found' in state:
+				self.found[index] = (state['anomalies_found'], state['normals_found'])
+				anomalies_found = {}
+				normals_found = {}
+				for anomalies, normals in self.found:
+					anomalies_found.update(anomalies)
+					normals_found.update(normals)
+				# Readers get the results of all the workers replaced at once
+				self.anomalies_found, self.normals_found = anomalies_found, normals_found
+			else:
+				self.states[index].update(state)
+				if 'anomaly_info' in state:
+					self.anomaly_info = state['anomaly_info']
+				states = [state_ for state_ in self.states if state_]
+				self.progress = ' '.join(state_['progress'] for state_ in states)
+				self.processed_column = ', '.join(state_['processed_column'] for state_ in states if state_['processed_column'] not in ['', 'None'])
+				if not self.processed_column:
+					self.processed_column = states[0]['processed_column']
+
+	# Results saved in a checkpoint, they are replaced once the workers finish their first pass
+	def restore(self, anomalies_found, normals_found):
+		with self.lock:
+			self.found[0] = (anomalies_found, normals_found)
+			self.anomalies_found, self.normals_found = anomalies_found, normals_found
+
+	def set_processing(self, processing):
+		self.processing = processing
+		self.send('processing', processing)
+
+	def set_draw_all(self, draw_all):
+		self.draw_all = draw_all
+		self.send('draw_all', draw_all)
+
+	def set_batch_size(self, batch_size):
+		self.batch_size = batch_size
+		self.send('batch_size', batch_size)
+
+	def set_detector(self, detector):
+		self.detector = detector
+		self.send('detector', detector)
+
+	def set_window(self, ml_window, ml_history):
+		self.ml_window = ml_window
+		self.ml_history = ml_history
+		self.send('ml_window', ml_window)
+		self.send('ml_history', ml_history)
+
+	def set_models_path(self, models_path):
+		self.models_path = models_path
+		self.send('models_path', models_path)
+
+	# Trains the models on the last published matrix in a separate process,
+	# workers pick them up once they are saved and until then keep confirming as before
+	def train(self, models_path):
+		if self.trainer and self.trainer.is_alive():
+			self.trainer.terminate()
+		self.set_models_path(models_path)
+		context = multiprocessing.get_context('spawn')
+		self.trainer = context.Process(target=run_trainer,
+									args=(self.matrix.name, self.matrix.capacity, self.window, list(registry.names), models_path,
+										self.ml_window, self.ml_history))
+		self.trainer.daemon = True
+		self.trainer.start()
+
+	def send_names(self):
+		if self.names is not registry.names:
+			self.names = registry.names
+			self.names_sent = 0
+		if self.names_sent < len(self.names):
+			self.send('names', (self.names_sent, self.names[self.names_sent:]))
+			self.names_sent = len(self.names)
+
+	def update_matrix(self, store, columns):
+		if len(store) > self.matrix.capacity:
+			capacity = self.matrix.capacity
+			while capacity < len(store):
+				capacity *= 2
+			self.matrix.close(unlink=True)
+			self.matrix = SharedMatrix(capacity, self.window)
+			self.send('matrix', (self.matrix.name, capacity, self.window))
+		self.send_names()
+		self.matrix.publish(store)
+		self.column_filter = list(dict.fromkeys(columns))
+		for i, (process, commands) in enumerate(self.workers):
+			commands.put(('columns', [column for column in self.column_filter if column % len(self.workers) == i]))
@@ -4,42 +4,45 @@ import argparse
 import curses
 import datetime
 import logging
-import math
 import os
-import pickle
-import re
 import sys
 import json
 import time
-import fcntl
-import select
 import functools
 import threading
 import subprocess
 from copy import deepcopy
 from curses import wrapper
 from os.path import isfile, join
+import numpy as np
 from tabulate import tabulate
 from platform import node
 
-import anomaly_graph as ml
+import anomaly_graph
+from checkpoint import CHECKPOINT_SUFFIX, dump_checkpoint, load_checkpoint, write_checkpoint
+from command_server import CommandServer
+from envoy_parser import EnvoyStatsParser
+from equal_groups import group_equals
+from file_index import FileIndex
+from metric_registry import registry
+from ml_worker import DETECTORS, MODELS_SUFFIX, MLWorker
+from pod_pool import PodPool
+from pod_stats import PodStats, columns as stats_columns
+from reference import convert_reference, is_reference, open_reference, pod_reference, save_reference
+from retention import DEFAULT_WINDOW, SeriesStore
+from snapshot import Snapshot
+from top_k import top_k, top_k_indices
 
 EQUAL_ROWS_THRESHOLD = 0.1
 ANOMALY_MAX_THRESHOLD = 0.5
 ANOMALY_DEVIATION_THRESHOLD = 0.3
+# Most series read into one block by Pod.backfill
+BACKFILL_SERIES = 1000
 
 learning = True
 
 DISPLAY_REFRESH_FREQUENCY = 5
 
-gauges = ['_buffered', '_active', 'uptime', 'concurrency', '_allocated', '_size', '.live', '.state', '_connections',
-					'version', '_expiring', '_epoch', '_clusters', '_clusters', '_healthy','_degraded', '_total',	'_weight',
-					'.healthy', '_open', '_cx', '_pending', '_rq', '_retries', 	'.size', '_per_host', 'gradient', '_limit', 
-					'_size', '_msecs', '_faults', '_warming', '_draining', '_started', '_keys', '_layers', '.active', '_requests']
-
-exclude_keys = ['version', 'istio', 'prometheus', 'grafana', 'nginx', 'kube', 'jaeger', 'BlackHole', 'grpc', 'zipkin', 'mixer', 'rq_timeout', 'external', 'internal']
-include_keys = ['rq_time']
-
 # Next structures are to be entered by user later, now hardcoded for bookinfo app
 sibling_prefix = 'reviews-'
 siblings = ['reviews-v1', 'reviews-v2', 'reviews-v3']
@@ -87,44 +90,6 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # FATAL
 sys.stderr = StderrWriter(general_logger)
 monitor = None
 
-def exclude_row(key, value):
-	for exclude in exclude_keys:
-		if exclude in key:
-			return True
-	if not '9080' in key:
-		return True
-	for include in include_keys:
-		if include in key:
-			return False
-	return True
-
-def process_ml(filter=''):
-	global monitor
-	general_logger.info("Starting ML processing")
-	while True:
-		try:
-			monitor.ml_anomalies = ml.process_anomalies(general_logger, filter)
-		except Exception as e:
-			general_logger.error("ERROR in ML thread: " + str(e))
-		time.sleep(1)
-
-def confirm_anomalies():
-	global monitor
-	general_logger.info("Starting ML anomalies confirming")
-	while True:
-		try:
-			if len(ml.column_filter):
-				general_logger.info("ML running confirming for %s", "".join(ml.column_filter))
-				monitor.ml_anomalies = ml.process_anomalies(general_logger, ml.column_filter)
-			else:
-				ml.anomalies_found = {}
-				ml_normals_found = {}
-				monitor.ml_anomalies = []
-		except Exception as e:
-			logging.error("ERROR in ML thread")
-			logging.error(e, exc_info=True)
-		time.sleep(1)
-
 class Results:
 	cols = ['name', 'kind', 'eq', 'anom', 'min', 'avg', 'max', 'dev', 'navg', 'ndev', 'val', 'nval']
 	cols_props = {'name': 'name', 'kind': 'kind',
@@ -133,84 +98,23 @@ class Results:
 				'd_eq': 'diff_equals_count', 'd_max': 'diff_max', 'd_dev': 'diff_dev', 'd_ndev': 'diff_norm_dev',
 				'anom': 'anomalies'}
 	# function tabulate_values holds the code collecting the values for the above columns
+	# Numbers are kept in the PodStats columns of the pod, see pod_stats.py, results are views of their rows
 	
-	def __init__(self, name, kind):
+	def __init__(self, stats, row, metric_id, kind):
+		# Stats: PodStats statistics object of the pod
+		self.stats = stats
+		# Row: row of the metric in the stats
+		self.row = row
+		# Id: id of the metric in registry
+		self.id = metric_id
 		# Name: name of the metric
-		self.name = name
+		self.name = registry.name(metric_id)
 		# kind: 'histo', 'counter', 'gauge' - counters are growing
 		self.kind = kind
-		# Start: first number in sequence for counters
-		self.start = ''
-		# Counter: last increment of the counter
-		self.counter = None
-		# Filtered out: the metric should be skipped everywhere
-		self.filtered_out = False
 		# Primary equal: for those metrics equaled out by some other metric
 		self.primary_equal = None
-		# Equaled out: is a part of some other equaled group
-		self.equaled_out = False
-		# Equals: a group of equal metrics names contained in primary equal
+		# Equals: a group of equal metrics ids contained in primary equal
 		self.equals = set()
-		# Equals count: a number of equals in the group
-		self.equals_count = 0
-		# Stats: ResultStats statistics object
-		self.stats = None
-		# Norm stats: normalized ResultStats statistics object
-		self.norm_stats = None
-		# Empty: sign that this metric never had any value
-		self.empty = True
-		# Last value: last read value
-		self.last_value = None
-		# Norm last value: normalized last read value
-		self.norm_last_value = None
-		# Count: number of values for this metric encountered so far
-		self.count = 0
-
-		# Stats: various math stats
-		# Min: minimum
-		self.min = float('inf')
-		# Avg: average
-		self.avg = 0.0
-		# Max: maximum
-		self.max = 0.0
-		# Var: variance
-		self.var = 0.0
-		# Dev: deviation
-		self.dev = 0.0
-		
-		# Norm stats: normalized stats - min is always 0 and max is always 1
-		# Avg: normalized average
-		self.norm_avg = 0.0
-		# Dev: normalized deviation
-		self.norm_dev = 0.0
-		
-		# Reference stats: stats frozen after learning stage and diffs with current stats for anomalies:
-		# Ref count: point of freeze
-		self.ref_count = 0
-		# Ref equals count: reference number of equals
-		self.ref_equals_count = 0
-		# Ref max: reference maximum
-		self.ref_max = 0.0
-		# Ref deviation: reference deviation
-		self.ref_dev = 0.0
-		# Ref normalized deviation: reference normalize deviation
-		self.ref_norm_dev = 0.0
-		# Equals count diff: difference between current and reference equals count
-		self.diff_equals_count = 0
-		# Max diff: difference between current and reference max values
-		self.diff_max = 0.0
-		# Deviation diff: difference between current and reference deviations
-		self.diff_dev = 0.0
-		# Normalized deviation diff: difference between current and reference normalized deviations
-		self.diff_norm_dev = 0.0
-		
-		# Anomalies: count of anomalies of metrics
-		self.anomalies = 0
-		self.anomaly_unequal = 0
-		self.anomaly_maxed = 0
-		self.anomaly_deviated = 0
-		self.anomaly_ml = 0
-
 
 	def get(self, prop):
 		return getattr(self, prop)
@@ -227,159 +131,105 @@ class Results:
 				self.norm_avg, self.norm_dev, self.last_value, self.norm_last_value]
 				#self.diff_equals_count, self.diff_max, self.diff_dev, self.diff_norm_dev]
 	
-	def is_gauge(key):
-		for item in gauges:
-			if key.endswith(item):
-				return True
-		return False
-	
 	def is_equal(self, result):
 		return (abs(self.norm_last_value - result.norm_last_value) <= EQUAL_ROWS_THRESHOLD and
 				abs(self.norm_avg - result.norm_avg) <= EQUAL_ROWS_THRESHOLD)
 
 	def normalize(self, value):
 		return value / self.max
-	
-	def return_to_normal(self):
-		
-		self.equals_count = self.ref_equals_count
-		self.max = self.ref_max
-		self.dev = self.ref_dev
-		self.norm_dev = self.ref_norm_dev
-		self.anomalies = 0
-		self.anomaly_unequal = 0
-		self.anomaly_maxed = 0
-		self.anomaly_deviated = 0
-		self.anomaly_ml = 0
-
-	def set_reference(self):
-		self.ref_count = self.count
-		self.ref_equals_count = self.equals_count
-		self.ref_max = self.max
-		self.ref_dev = self.dev
-		self.ref_norm_dev = self.norm_dev
-		self.diff_equals_count = 0
-		self.diff_max = 0.0
-		self.diff_dev = 0.0
-		self.diff_norm_dev = 0.0
-		self.anomalies = 0
-		self.anomaly_unequal = 0
-		self.anomaly_maxed = 0
-		self.anomaly_deviated = 0
-		self.anomaly_ml = 0
 
 	# Verifies if result is still equaled out by its primary equal and removes equality if not
 	def verify_equaled_out(self):
 		if (not (self.filtered_out or self.zeroed_out() or self.empty) and
 				self.equaled_out and not self.primary_equal.empty and not self.is_equal(self.primary_equal)):
-			self.equaled_out = False
-			self.primary_equal.equals.remove(self.name)
-			if learning == False:
-				self.anomaly_unequal = abs(self.norm_last_value - self.primary_equal.norm_last_value)
-				self.anomalies += 1
+			self.split_equal()
+
+	def split_equal(self):
+		self.equaled_out = False
+		self.primary_equal.equals.remove(self.id)
+		if learning == False:
+			self.anomaly_unequal = abs(self.norm_last_value - self.primary_equal.norm_last_value)
+			self.anomalies += 1
 			
 	# Verify if previously non-equal results are equal and set the grouping if they are (expects non-discard() self and result)
 	def verify_is_equal(self, result):
 		if self.is_equal(result) and self.primary_equal == result.primary_equal:
-			self.equaled_out = True
-			result.equals.add(self.name)
-			self.primary_equal = result
+			self.join_equal(result)
 			return True
 		else:
 			return False
 
-	def process_stat(self, value):
-		if value < self.min:
-			self.min = value
-		delta = value - self.avg
-		self.avg = self.avg + delta  / self.count
-		if value > self.max:
-			self.max = value
-		self.var = (self.var * (self.count - 1) + delta * (value - self.avg)) / self.count
-		self.dev = math.sqrt(self.var)
-
-	def process_value(self, value):
-		if value == '':
-			self.last_value = None
-			self.norm_last_value = None
-			self.empty = True
-			return
-		
-		value = float(value)
-		
-		# Normalize counters
-		if self.kind == 'C':
-			old_value = self.counter
-			if old_value:
-				self.counter = value
-				value = value - old_value
-			else:
-				self.counter = value											
-				self.start = value
-				value = 0.0
-
-		# Calculate stats
-		self.empty = False
-		self.last_value = value
-		self.count += 1
-		self.process_stat(value)
-		if self.max != 0:
-			norm_value = self.normalize(value)
-			self.norm_avg = self.normalize(self.avg)
-			self.norm_dev = self.normalize(self.dev)
-		else:
-			norm_value = 0.0
-		self.norm_last_value = norm_value
-		if learning:
-			self.diff_equals_count = 0
-			self.diff_max = 0.0
-			self.diff_dev = 0.0
-			self.diff_norm_dev = 0.0
-		else:
-			# We'll be looking for metrics with less equals than in reference, which means less uniformity
-			self.diff_equals_count = self.ref_equals_count - self.equals_count
-			# We'll be looking for metrics with increased values
-			self.diff_max = self.max - self.ref_max
-			self.diff_dev = self.dev - self.ref_dev
-			self.diff_norm_dev = self.norm_dev - self.ref_norm_dev
-			self.anomaly_maxed = 0
-			self.anomaly_deviated = 0
-			if self.diff_max > self.ref_max * (1 + ANOMALY_MAX_THRESHOLD):
-				general_logger.info("MAXED value in %s - %s %s %s", self.name, str(value), str(self.diff_max), str(self.ref_max))
-				self.anomaly_maxed = self.diff_max
-				self.anomalies += 1
-			if self.diff_norm_dev > ANOMALY_DEVIATION_THRESHOLD:
-				self.anomaly_deviated = self.diff_norm_dev
-				self.anomalies += 1
-
-			if self.name in ml.anomalies_found:
-				self.anomaly_ml = 1
-				self.anomalies += 1
-			elif self.anomaly_ml == 1:
-				self.anomaly_ml = 0
-				self.anomalies -= 1
+	def join_equal(self, result):
+		self.equaled_out = True
+		result.equals.add(self.id)
+		self.primary_equal = result
+
+
+def stats_property(name):
+	def get(self):
+		return getattr(self.stats, name)[self.row].item()
+	def set(self, value):
+		getattr(self.stats, name)[self.row] = value
+	return property(get, set)
+
+def last_value_property(name):
+	def get(self):
+		if self.stats.empty[self.row]:
+			return None
+		return getattr(self.stats, name)[self.row].item()
+	return property(get)
+
+def counter_property(name, none_value):
+	def get(self):
+		if not self.stats.has_counter[self.row]:
+			return none_value
+		return getattr(self.stats, name)[self.row].item()
+	return property(get)
+
+for name in stats_columns:
+	if name in ['ids', 'is_counter', 'has_counter']:
+		continue
+	elif name in ['last_value', 'norm_last_value']:
+		setattr(Results, name, last_value_property(name))
+	elif name == 'start':
+		setattr(Results, name, counter_property(name, ''))
+	elif name == 'counter':
+		setattr(Results, name, counter_property(name, None))
+	else:
+		setattr(Results, name, stats_property(name))
 
 
 class Pod:
 	path = ''
+	# Series kept for every metric (-w), pods_info keeps the pods of as many series
+	window = DEFAULT_WINDOW
 	pods_info = {}
 
-	def __init__(self, name, path):
+	def __init__(self, name, path, window=DEFAULT_WINDOW):
 		Pod.path = path
+		Pod.window = window
 		self.name = name
 		self.full_name = ''
 		self.node = ''
 		self.processed_files = 0
+		self.window = window
+		# Timestamp and raw values of the latest series
+		self.timestamp = ''
 		self.stats = {}
 		self.results = {}
-		self.matrix = {}
-		self.files = set()
+		# Stats of all the results, one row per metric in the order of adding
+		self.pod_stats = PodStats()
+		# Ordered: results sorted by name and their rows in stats, rebuilt only when new metrics appear
+		self.ordered = []
+		self.order = None
+		self.matrix = SeriesStore(window)
 		self.series_count = 0
 		self.metrics_count = 0
 		self.top = []
 		self.unique = 0
 		self.empty = 0
 		self.filtered_out_keys = set()
+		self.parser = EnvoyStatsParser(name, self.filtered_out_keys)
 		self.filtered_out = 0
 		self.equaled_out = 0
 		self.zeroed_out = 0
@@ -389,11 +239,35 @@ class Pod:
 		self.anomaly_deviated = 0
 		self.anomaly_ml = 0
 		self.suspected_anomalies = []
+		# Reference: PodReference with the reference stats loaded from the reference file, looked up for new metrics
+		self.reference = None
+
+	# Raw values of the latest series and the order of the results are not pickled, they are rebuilt.
+	# The series are kept, so a pod restored from a checkpoint goes on with them
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['stats'] = {}
+		state['ordered'] = []
+		state['order'] = None
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		# Pods restored from a checkpoint or sent to a pod worker follow the window as in __init__
+		Pod.window = self.window
+		self.ordered = []
+		self.order = None
+
+	# Approximate memory taken by the pod: series buffers and results
+	def memory_footprint(self):
+		size = self.matrix.nbytes + self.pod_stats.nbytes + sys.getsizeof(self.results) + sys.getsizeof(self.stats)
+		for result in self.results.values():
+			size += sys.getsizeof(result) + sys.getsizeof(result.__dict__) + sys.getsizeof(result.equals)
+		return size
 
 	def return_to_normal(self):
 		general_logger.info("Returning to normal pod %s", self.full_name)
-		for result in self.results.values():
-			result.return_to_normal()
+		self.pod_stats.return_to_normal()
 		self.anomaly_unequal = 0
 		self.anomaly_maxed = 0
 		self.anomaly_deviated = 0
@@ -401,28 +275,39 @@ class Pod:
 		self.suspected_anomalies = []
 
 	def set_reference(self):
-		for result in self.results.values():
-			result.set_reference()
-
-	def add_value(self, key, value, empty, kind):
+		self.pod_stats.set_reference()
+
+	def add_result(self, key, kind):
+		result = Results(self.pod_stats, self.pod_stats.add(key, kind), key, kind)
+		self.results[key] = result
+		if self.reference is not None:
+			self.reference.apply(self.pod_stats, result.row, registry.metric(key))
+		return result
+
+	# Restores the reference equal groups of the new results, the primary equals are in the same series
+	def join_reference_equals(self, results):
+		for result in results:
+			primary = self.reference.primary_equal(registry.metric(result.id))
+			primary_id = registry.lookup(self.name, primary) if primary is not None else None
+			if primary_id in self.results:
+				result.join_equal(self.results[primary_id])
+
+	# Adds the values of a series given as metric id -> value, or None for empty values
+	def add_series(self, series):
 		global monitor
-		if not key in self.results:
-			result = Results(key, kind) 
-			self.results[key] = result
-		else:
-			result = self.results[key]
-		if not key in self.matrix:
-			self.matrix[key] = []
-		if not key in monitor.global_matrix:
-			monitor.global_matrix[key] = []
-		if value == empty:
-			value = ''
-			mvalue = 0
-		else:
-			mvalue = float(value)
-		self.matrix[key].append(mvalue)
-		monitor.global_matrix[key].append(mvalue)
-		result.process_value(value)
+		keys = list(series)
+		values = np.array([0.0 if value is None else float(value) for value in series.values()])
+		self.matrix.extend(keys, values)
+		monitor.global_matrix.extend(keys, values)
+		results = self.results
+		rows = np.fromiter((results[key].row for key in keys), dtype=np.int64, count=len(keys))
+		empty = np.fromiter((value is None for value in series.values()), dtype=bool, count=len(keys))
+		self.pod_stats.set_empty(rows[empty])
+		maxed = self.pod_stats.update(rows[~empty], values[~empty], learning, monitor.ml.anomalies_found,
+								ANOMALY_MAX_THRESHOLD, ANOMALY_DEVIATION_THRESHOLD)
+		for row in maxed.tolist():
+			result = results[self.pod_stats.ids[row].item()]
+			general_logger.info("MAXED value in %s - %s %s %s", result.name, str(result.last_value), str(result.diff_max), str(result.ref_max))
 
 	def shorten(self, key):
 		key = key.replace('cluster', 'c')
@@ -444,6 +329,9 @@ class Pod:
 	@classmethod
 	def get_node(cls, timestamp, pod_name):
 		if not Pod.pods_info.get(timestamp):
+			# Only the recent series are kept, pods are looked up for the series being processed
+			while len(Pod.pods_info) >= Pod.window:
+				del Pod.pods_info[next(iter(Pod.pods_info))]
 			Pod.pods_info[timestamp] = {}
 			with open(join(Pod.path, 'pods.' + timestamp)) as f:
 				fcontents = f.read()
@@ -455,137 +343,163 @@ class Pod:
 					Pod.pods_info[timestamp][pod] = node
 		return Pod.pods_info[timestamp][pod_name]
 		
-	def read_envoy_data(self, fname, file_series, pods_count):
-		with open(join(self.path, fname), 'r') as f:
-			fcontents = f.read()
-			contents = fcontents.splitlines()
-			pod_name, timestamp = fname.split('.')
-			# Check that time series is complete in regard to all pods
-			fs_timestamp = file_series.get(timestamp)
-			if not fs_timestamp or len(fs_timestamp) < pods_count:
-				return False
-
-			if self.full_name != pod_name:
-				general_logger.info("Returning to normal for changed pod old %s new %s", self.full_name, pod_name)
-				self.full_name = pod_name
-				self.return_to_normal()
-
-			if not timestamp in self.stats:
-				self.stats[timestamp] = {}
-				self.node = Pod.get_node(timestamp, self.full_name)
-			for row in contents:
-				row_split = row.split(':')
-				try:
-					key = self.generate_key(row_split[0])
-					value = row_split[1]
-				except Exception as e:
-					logging.error("ERROR parsing value: %s %s", fname, row)
-					logging.error(e, exc_info=True)
-					continue
-				if exclude_row(key, value):
-					self.filtered_out_keys.add(key)
-					continue
-				if 'P0(' in value:
-					histogram = value.split()
-					for hval in histogram:
-						hval_split = re.split('[(,)]', hval)
-						if hval_split[0] in ['P75']:
-							# Not adding the postfix here because it's a single percentile we take now and also
-							# When there is "No recorded value" it's being added as a non-histo metric without "|P95" postfix
-							# and ruins evenness of the global matrix
-							hkey = key # + '|' + hval_split[0]
-							self.stats[timestamp][key] = hval_split[1]
-							self.add_value(hkey, hval_split[1], 'nan', 'H')
-				else:
-					self.stats[timestamp][key] = value
-					if Results.is_gauge(key):
-						kind = 'G'
-					else:
-						kind = 'C'
-					self.add_value(key, value, ' No recorded values', kind)
-		self.files.add(fname)
+	def read_envoy_data(self, fname):
+		if not isfile(join(self.path, fname)):
+			return False
+		self.add_series(self.read_series(fname))
 		self.series_count += 1
-		self.metrics_count = len(self.matrix.values())
+		self.metrics_count = len(self.matrix)
 		return True
+
+	# Reads the file into a series of metric id -> value, or None for empty values
+	def read_series(self, fname):
+		pod_name, timestamp = fname.split('.')
+
+		if self.full_name != pod_name:
+			general_logger.info("Returning to normal for changed pod old %s new %s", self.full_name, pod_name)
+			self.full_name = pod_name
+			self.return_to_normal()
+
+		if timestamp != self.timestamp:
+			self.timestamp = timestamp
+			self.stats = {}
+			self.node = Pod.get_node(timestamp, self.full_name)
+		stats = self.stats
+		series = {}
+		added = []
+		with open(join(self.path, fname), 'r') as f:
+			for key, value, empty, kind in self.parser.parse(f, fname):
+				stats[key] = value
+				if not key in self.results:
+					added.append(self.add_result(key, kind))
+				series[key] = None if value == empty else value
+		if added and self.reference is not None:
+			self.join_reference_equals(added)
+		return series
+
+	# Bulk counterpart of process_pod for the history read during warm up: the files are read into blocks
+	# of series which are added at once, see add_series_block, and the equal groups are settled only after the last one
+	def backfill(self, files):
+		block = []
+		for fname in files:
+			if not isfile(join(self.path, fname)):
+				continue
+			# Series of the former pod are added before it returns to normal in read_series
+			if len(block) == BACKFILL_SERIES or (block and fname.split('.')[0] != self.full_name):
+				self.add_series_block(block)
+				block = []
+			block.append(self.read_series(fname))
+		if block:
+			self.add_series_block(block)
+		if files:
+			self.process_last_series()
+			general_logger.info("Backfilled %s files of pod %s", str(len(files)), self.name)
+
+	def add_series_block(self, block):
+		global monitor
+		keys = list(dict.fromkeys(key for series in block for key in series))
+		columns = {key: column for column, key in enumerate(keys)}
+		values = np.zeros((len(block), len(keys)))
+		present = np.zeros((len(block), len(keys)), dtype=bool)
+		empty = np.zeros((len(block), len(keys)), dtype=bool)
+		for i, series in enumerate(block):
+			series_columns = np.fromiter((columns[key] for key in series), dtype=np.int64, count=len(series))
+			values[i, series_columns] = [0.0 if value is None else float(value) for value in series.values()]
+			present[i, series_columns] = True
+			empty[i, series_columns] = [value is None for value in series.values()]
+		self.matrix.extend_many(keys, values, present)
+		monitor.global_matrix.extend_many(keys, values, present)
+		rows = np.fromiter((self.results[key].row for key in keys), dtype=np.int64, count=len(keys))
+		maxed = self.pod_stats.update_many(rows, values, present, empty, learning, monitor.ml.anomalies_found,
+										ANOMALY_MAX_THRESHOLD, ANOMALY_DEVIATION_THRESHOLD)
+		for row in maxed.tolist():
+			result = self.results[self.pod_stats.ids[row].item()]
+			general_logger.info("MAXED value in %s - %s %s %s", result.name, str(result.last_value), str(result.diff_max), str(result.ref_max))
+		self.series_count += len(block)
+		self.processed_files += len(block)
+		self.metrics_count = len(self.matrix)
 	
 	def process_last_series(self):
-		items = sorted(self.results.items())
-		# First split items which are not equal anymore
-		for key, result in items:			
-			result.verify_equaled_out()
+		stats = self.pod_stats
+		if len(self.ordered) != len(self.results):
+			self.ordered = sorted(self.results.values(), key=lambda result_: result_.name)
+			self.order = np.array([result.row for result in self.ordered], dtype=np.int64)
+		items = self.ordered
+		order = self.order
+		# First split items which are not equal anymore, see Results.verify_equaled_out
+		equaled_out = stats.column('equaled_out') & ~(stats.column('filtered_out') | stats.column('empty') | stats.zeroed_out())
+		rows = np.flatnonzero(equaled_out)
+		if len(rows):
+			results = list(self.results.values())
+			primaries = np.array([results[row].primary_equal.row for row in rows.tolist()], dtype=np.int64)
+			unequal = ~stats.empty[primaries] & ~(
+				(np.abs(stats.norm_last_value[rows] - stats.norm_last_value[primaries]) <= EQUAL_ROWS_THRESHOLD) &
+				(np.abs(stats.norm_avg[rows] - stats.norm_avg[primaries]) <= EQUAL_ROWS_THRESHOLD))
+			for row in rows[unequal].tolist():
+				results[row].split_equal()
 		# Create equal groups
-		for key, result in items:			
-			if not result.discard():
-				for key2, result2 in items:
-					if key2 == key:
-						break
-					if result2.discard():
-						continue
-					if result.verify_is_equal(result2):
-						break
+		group_equals(items, stats.norm_last_value[order].tolist(), stats.norm_avg[order].tolist(),
+					np.flatnonzero(~stats.discarded()[order]).tolist(), EQUAL_ROWS_THRESHOLD)
 			
-		self.equaled_out = 0
-		self.empty = 0
-		self.unique = 0
-		self.zeroed_out = 0
-		self.anomalies = 0
-		self.anomaly_unequal = 0
-		self.anomaly_maxed = 0
-		self.anomaly_deviated = 0
-		self.anomaly_ml = 0
-		self.suspected_anomalies = []
 		self.filtered_out = len(self.filtered_out_keys)
-		for result in self.results.values():
-			result.equals_count = len(result.equals)
-			if result.anomalies:
-				self.anomalies += 1
-				if result.anomaly_unequal:
-					self.anomaly_unequal += 1
-				if result.anomaly_maxed:
-					self.anomaly_maxed += 1
-					# Adding only maxed to suspected because other kinds are non-important for demo
-					self.suspected_anomalies.append(result.name)
-					general_logger.info("Suspecting max anomaly in metric %s with diff_max %s and diff_dev %s", result.name, str(result.anomaly_maxed), str(result.anomaly_deviated))
-				if result.anomaly_deviated:
-					self.anomaly_deviated += 1
-				if result.anomaly_ml:
-					self.anomaly_ml += 1
-			if result.equaled_out:
-				self.equaled_out += 1
-			elif result.empty:
-				self.empty += 1
-			elif result.zeroed_out():
-				self.zeroed_out += 1
-			else:
-				self.unique += 1
+		stats.column('equals_count')[:] = [len(result.equals) for result in self.results.values()]
+		anomalies = stats.column('anomalies') != 0
+		maxed = anomalies & (stats.column('anomaly_maxed') != 0)
+		self.anomalies = int(anomalies.sum())
+		self.anomaly_unequal = int((anomalies & (stats.column('anomaly_unequal') != 0)).sum())
+		self.anomaly_maxed = int(maxed.sum())
+		self.anomaly_deviated = int((anomalies & (stats.column('anomaly_deviated') != 0)).sum())
+		self.anomaly_ml = int((anomalies & (stats.column('anomaly_ml') != 0)).sum())
+		# Adding only maxed to suspected because other kinds are non-important for demo
+		self.suspected_anomalies = stats.column('ids')[maxed].tolist()
+		for metric_id in self.suspected_anomalies:
+			result = self.results[metric_id]
+			general_logger.info("Suspecting max anomaly in metric %s with diff_max %s and diff_dev %s", result.name, str(result.anomaly_maxed), str(result.anomaly_deviated))
+		equaled_out = stats.column('equaled_out')
+		empty = stats.column('empty') & ~equaled_out
+		zeroed_out = stats.zeroed_out() & ~(equaled_out | empty)
+		self.equaled_out = int(equaled_out.sum())
+		self.empty = int(empty.sum())
+		self.zeroed_out = int(zeroed_out.sum())
+		self.unique = len(stats) - self.equaled_out - self.empty - self.zeroed_out
 
 	def sort_top(self, sort_metric, num_rows, empty_filter):
-		self.top = []
 		if sort_metric in ['name', 'kind']:
 				init_value = ''
 		else:
 				init_value = -1
-		for i in range(0, num_rows):
-				self.top.append((None, init_value))
-		for metric, result in self.results.items():
-				if result.discard() and not (result.empty and not empty_filter):
-						continue
-				value = result.get(sort_metric)
-				for i in range(0, num_rows):
-						if value != None and value > self.top[i][1]:
-								self.top.insert(i, (metric, value))
-								del self.top[-1]
-								break
-
-
-	def process_pod(self, files, file_series, pods_count, warming_up = False):
+		stats = self.pod_stats
+		shown = ~stats.discarded()
+		if not empty_filter:
+				shown |= stats.column('empty')
+		rows = np.flatnonzero(shown)
+		results = list(self.results.values())
+		if sort_metric in stats_columns:
+				rows = rows[top_k_indices(stats.column(sort_metric)[rows], num_rows, init_value)]
+				self.top = [(results[row].id, results[row].get(sort_metric)) for row in rows.tolist()]
+		else:
+				top = top_k((results[row] for row in rows.tolist()), num_rows, lambda result_: result_.get(sort_metric), init_value)
+				self.top = [(result.id, value) for result, value in top]
+		self.top += [(None, init_value)] * (num_rows - len(self.top))
+
+	def top_rows(self, num_rows):
+		rows = []
+		for metric, value in self.top:
+			if len(rows) == num_rows:
+				break
+			if metric is None:
+				continue
+			rows.append(self.results[metric].tabulate_values())
+		return rows
+
+
+	def process_pod(self, files):
 		for f in files:
-			if isfile(join(self.path, f)) and f.startswith(self.name) and (f not in self.files or warming_up):
-				if self.read_envoy_data(f, file_series, pods_count):
-					general_logger.info("Processing pod file %s", f)
-					self.process_last_series()
-					self.processed_files += 1
-				# break #Uncomment this break to process each existing series per second
+			if self.read_envoy_data(f):
+				general_logger.info("Processing pod file %s", f)
+				self.process_last_series()
+				self.processed_files += 1
+			# break #Uncomment this break to process each existing series per second
 
 class Monitor:
 	
@@ -596,7 +510,7 @@ class Monitor:
 		self.args = args
 		self.pods = {}
 		self.refpods = {}
-		self.file_series = {}
+		self.file_index = FileIndex(args.path, args.pods)
 		self.sort_column = 'eq'
 		self.sort_metric = 'equals_count'
 		self.current_pod = ''
@@ -608,75 +522,79 @@ class Monitor:
 		self.series_count = 0
 		self.ml_anomalies = ''
 		self.suspected_anomalies = []
-		self.global_matrix = {}
+		self.global_matrix = SeriesStore(args.window)
+		# Multithreading confirms the metrics of every pod in its own worker unless the number of workers is given
+		ml_workers = len(args.pods) if args.multithreading and args.ml_workers == 1 else args.ml_workers
+		self.ml = MLWorker(args.window, workers=max(1, ml_workers))
+		self.ml.set_batch_size(args.ml_batch)
+		self.ml.set_detector(args.detector)
+		self.ml.set_window(args.ml_window, args.ml_history)
+		anomaly_graph.renderer = self.ml.renderer
+		# Pool: worker processes holding the pods in parallel mode
+		self.pool = None
 		self.reported_anomalies = {}
+		# Snapshot: state published for the queries once per tick, see publish()
+		self.snapshot = Snapshot()
+		self.snapshot_lock = threading.Lock()
+		# Checkpoint: file of the live state saved periodically, see checkpoint()
+		self.checkpoint_file = args.checkpoint or (args.reffile + CHECKPOINT_SUFFIX if args.reffile else '')
+		self.checkpoint_time = 0
+		self.checkpoint_writer = None
 		Pod.path = args.path
 		for pod_name in self.args.pods:
-			self.pods[pod_name] = Pod(pod_name, args.path)
+			self.pods[pod_name] = Pod(pod_name, args.path, args.window)
 
 		monitor = self
 
 	def adjust_matrix(self):
-		val_count = 0
-		for key, vals in self.global_matrix.items():
-			if val_count == 0 or len(vals) < val_count:
-				general_logger.info("Matrix minimal metric is %s with %s", key, str(len(vals)))
-				val_count = len(vals)
-		logged = False
-		for key, vals in self.global_matrix.items():
-			while len(vals) > val_count:
-				if not logged:
-					general_logger.info("Matrix is uneven: key %s has %s with %s for others, adjusting", key, str(len(vals)), val_count)
-					logged = True
-				vals.pop()
+		val_count = self.global_matrix.min_count()
+		general_logger.info("Matrix minimal metric count is %s", str(val_count))
+		if self.global_matrix.max_count() > val_count:
+			general_logger.info("Matrix is uneven: adjusting to %s", val_count)
+			self.global_matrix.truncate(val_count)
 		self.series_count = val_count
-	
-	def prepare_file_series(self, path, pod_names):
-		files = [f for f in os.listdir(path) if "+" in f]
-		files = sorted(files, key=lambda x_: x_.split('.')[1])
-		self.file_series = {}
-		for fname in files:
-			pod_name, timestamp = fname.split('.')
-			filter_out = True
-			for filter_name in pod_names:
-				if pod_name.startswith(filter_name):
-					filter_out = False
-					break
-			if filter_out:
-				continue
-			fseries = self.file_series.get(timestamp)
-			if not fseries:
-				self.file_series[timestamp] = []
+
+	# Returns files of newly completed series for each pod in order of timestamps
+	def prepare_file_series(self):
+		pod_files = {}
+		for timestamp, files in self.file_index.poll():
 			# Skipping files after saved ref during startup
 			if ((self.ref_timestamp == '' or timestamp <= self.ref_timestamp) or
 				(self.start_timestamp != '' and timestamp > self.start_timestamp)):
-				self.file_series[timestamp].append(fname)
-			if timestamp > self.current_timestamp:
-				self.current_timestamp = timestamp
-		return files
+				for pod_name, fnames in files.items():
+					pod_files.setdefault(pod_name, []).extend(fnames)
+		if self.file_index.latest > self.current_timestamp:
+			self.current_timestamp = self.file_index.latest
+		return pod_files
 
 	def process_pods(self, path, pod_names, warming_up = False):
 		global learning
 		self.pods_count = len(pod_names)
-		files = self.prepare_file_series(path, pod_names)
+		pod_files = self.prepare_file_series()
 		self.suspected_anomalies = []
+		if self.pool:
+			self.pool.process(pod_files, learning, warming_up, self.ml.anomalies_found,
+							(self.current_pod, self.sort_metric, 20, self.empty_filter), self.global_matrix)
 		for pod_name in pod_names:
 			pod = self.pods.get(pod_name)
-			pod.process_pod(files, self.file_series, self.pods_count, warming_up)
-			if warming_up:
-				pod.return_to_normal()
+			if not self.pool:
+				if warming_up:
+					pod.backfill(pod_files.get(pod_name, []))
+					pod.return_to_normal()
+				else:
+					pod.process_pod(pod_files.get(pod_name, []))
 			if pod_name.startswith(sibling_prefix):
 				suspected_anomalies = []
 				for anomaly in pod.suspected_anomalies:
-					metric = anomaly.split('|', 1)[1]
+					metric = registry.metric(anomaly)
 					for sibling in siblings:
-						full_name = sibling + '|' + metric
-						if full_name not in self.suspected_anomalies:
-							general_logger.info("Adding sibling metric to check %s ", full_name)
-							suspected_anomalies.append(full_name)					
+						sibling_id = registry.lookup(sibling, metric)
+						if sibling_id is not None and sibling_id not in self.suspected_anomalies:
+							general_logger.info("Adding sibling metric to check %s ", sibling + '|' + metric)
+							suspected_anomalies.append(sibling_id)
 			else:
 				suspected_anomalies = pod.suspected_anomalies
-				general_logger.info("Adding metrics to check %s ", str(pod.suspected_anomalies))
+				general_logger.info("Adding metrics to check %s ", str([registry.name(anomaly) for anomaly in pod.suspected_anomalies]))
 			self.suspected_anomalies.extend(suspected_anomalies)
 				
 		
@@ -684,41 +602,108 @@ class Monitor:
 			self.ref_timestamp = self.current_timestamp
 		# Make sure that matrix is even and update the ML
 		self.adjust_matrix()
-		general_logger.info("Updating matrix with %s suspected anomalies %s", str(len(self.suspected_anomalies)), self.suspected_anomalies)
-		ml.update_matrix(self.global_matrix, self.suspected_anomalies)
+		general_logger.info("Updating matrix with %s suspected anomalies %s", str(len(self.suspected_anomalies)), [registry.name(anomaly) for anomaly in self.suspected_anomalies])
+		self.ml.update_matrix(self.global_matrix, self.suspected_anomalies)
 
-		self.pods[self.current_pod].sort_top(self.sort_metric, 20, self.empty_filter)
+		if not self.pool:
+			self.pods[self.current_pod].sort_top(self.sort_metric, 20, self.empty_filter)
+		# Published before the screen is drawn, which shows the memory footprints taken by the snapshot
+		self.publish()
 		self.display_screen(self.pods[self.current_pod], 20)
+		if not warming_up:
+			self.checkpoint()
+
+	# Also called by the commands changing the pods, so that the following queries see the change
+	def publish(self):
+		with self.snapshot_lock:
+			self.snapshot = self.snapshot.publish(self.series_count, list(self.pods.values()), self.ml.anomalies_found, self.ml.normals_found)
+
+	# Saves the live state once in the checkpoint period, so that a restart replays only the files
+	# which arrived after it instead of the whole history, see restore_checkpoint
+	def checkpoint(self, wait=False):
+		if not self.checkpoint_file or (not wait and time.time() - self.checkpoint_time < self.args.checkpoint_period):
+			return
+		if self.checkpoint_writer and self.checkpoint_writer.is_alive():
+			if not wait:
+				return
+			self.checkpoint_writer.join()
+		self.checkpoint_time = time.time()
+		state = {
+			'path': self.args.path,
+			'ref_file': self.ref_file,
+			'window': self.args.window,
+			'names': registry.names,
+			'pods': self.pool.fetch_pods() if self.pool else self.pods,
+			'file_index': self.file_index.position(),
+			'global_matrix': self.global_matrix,
+			'learning': learning,
+			'ref_timestamp': self.ref_timestamp,
+			'start_timestamp': self.start_timestamp,
+			'current_timestamp': self.current_timestamp,
+			'anomalies_found': self.ml.anomalies_found,
+			'normals_found': self.ml.normals_found,
+			'reported_anomalies': self.reported_anomalies,
+		}
+		# Pickled here to have a consistent state, only writing goes to background
+		self.checkpoint_writer = threading.Thread(target=write_checkpoint, args=(self.checkpoint_file, dump_checkpoint(state)))
+		self.checkpoint_writer.start()
+		if wait:
+			self.checkpoint_writer.join()
+
+	def restore_checkpoint(self):
+		global learning
+		state = load_checkpoint(self.checkpoint_file) if self.checkpoint_file else None
+		if state is None:
+			return False
+		if (state['path'], list(state['pods']), state['ref_file'], state['window']) != (self.args.path, self.args.pods, self.ref_file, self.args.window):
+			general_logger.info("Checkpoint %s was saved with other settings, not using it", self.checkpoint_file)
+			return False
+		registry.load(state['names'])
+		self.pods = state['pods']
+		self.file_index.restore(state['file_index'])
+		self.global_matrix = state['global_matrix']
+		self.ref_timestamp = state['ref_timestamp']
+		self.start_timestamp = state['start_timestamp']
+		self.current_timestamp = state['current_timestamp']
+		self.reported_anomalies = state['reported_anomalies']
+		learning = state['learning']
+		self.ml.set_processing(not learning)
+		self.ml.restore(state['anomalies_found'], state['normals_found'])
+		general_logger.info("Restored %s pods from checkpoint %s at %s", str(len(self.pods)), self.checkpoint_file, self.current_timestamp)
+		return True
 
 	def save_pods(self):
 		general_logger.info("Saving ref file to %s with timestamp %s", self.ref_file, self.ref_timestamp)
-		for pod in self.pods.values():
-			pod.matrix = {}
-			pod.stats = {}
-		with open(self.ref_file, 'wb') as output:
-			pickle.dump((self.ref_timestamp, self.pods), output, pickle.HIGHEST_PROTOCOL)
+		pods = self.pool.fetch_pods() if self.pool else self.pods
+		save_reference(self.ref_file, self.ref_timestamp, {pod_name: pod_reference(pod) for pod_name, pod in pods.items()})
 		self.start_timestamp = self.ref_timestamp
 
+	# Models are trained on the reference series when learning is over
+	# The median detector does not use the models, so TensorFlow is not loaded for it
+	def train_models(self):
+		if self.ref_file and self.args.detector != 'median':
+			general_logger.info("Training ML models on the reference series")
+			self.ml.train(self.ref_file + MODELS_SUFFIX)
+
 	def load_pods(self):
 		global learning
 		general_logger.info("Loading pods from %s", self.ref_file)
 		if isfile(join(self.ref_file)):
-			with open(self.ref_file, 'rb') as instream:
-				self.ref_timestamp, self.pods = pickle.load(instream)
-				general_logger.info("Loaded %s pods with timestamp %s", str(len(self.pods)), self.ref_timestamp)
+			if not is_reference(self.ref_file):
+				general_logger.info("Converting pickled reference file %s, it is kept as %s", self.ref_file, self.ref_file + '.pickle')
+				os.replace(self.ref_file, self.ref_file + '.pickle')
+				convert_reference(self.ref_file + '.pickle', self.ref_file)
+			reference = open_reference(self.ref_file)
+			self.ref_timestamp = reference.timestamp
+			# Stats of the pods are looked up in the reference as their metrics are read
+			for pod_name, pod in self.pods.items():
+				pod.reference = reference.pod(pod_name)
+			general_logger.info("Loaded reference of %s pods with timestamp %s", str(len(reference.pods)), self.ref_timestamp)
 			learning = False
-			ml.processing = True
+			self.ml.set_processing(True)
 
 	def display_top_table(self, pod, num_rows):
-		top_table = []
-		n = 0
-		for metric, value in pod.top:
-			if n == num_rows:
-				break
-			if not metric:
-				continue
-			top_table.append(pod.results[metric].tabulate_values())
-			n += 1
+		top_table = pod.top_rows(num_rows)
 		titles = deepcopy(Results.cols)
 		titles[titles.index(self.sort_column)] = self.sort_column.upper()
 		self.screen.addstr(tabulate(top_table, headers=titles, tablefmt="plain", floatfmt=".2f"))
@@ -730,7 +715,8 @@ class Monitor:
 			if name == self.current_pod:
 				name = name.upper()
 			self.screen.addstr("    " + name.ljust(20) + "Node: " + pod.node + ', Anomalies: ' + str(pod.anomalies) + ', Unequal: ' + str(pod.anomaly_unequal) +
-						', Maxed: ' + str(pod.anomaly_maxed) + ', Deviated: ' + str(pod.anomaly_deviated) + ', ML: ' + str(pod.anomaly_ml) + '\n')
+						', Maxed: ' + str(pod.anomaly_maxed) + ', Deviated: ' + str(pod.anomaly_deviated) + ', ML: ' + str(pod.anomaly_ml) +
+						', Memory: ' + '{:.1f}MB'.format(self.snapshot.memory_footprint(pod.name) / 1048576) + '\n')
 	
 	def highlight(self, arr, key):
 		arr[arr.index(key)] = key.upper()
@@ -746,15 +732,18 @@ class Monitor:
 			top_table.append([item[0]] + item[1])
 		self.screen.addstr(tabulate(top_table, tablefmt="orgtbl"))
 
-	def draw_graphs(self):
+	# Graphs of the top metrics of the current pod are drawn by the renderer process of the ML worker
+	def draw_graphs(self, num_rows=20):
 		current_pod = self.pods[self.current_pod]
-		anomaly_graph.draw_graphs(current_pod.matrix, current_pod.name, [i[0] for i in current_pod.top])
+		found = {**self.ml.normals_found, **self.ml.anomalies_found}
+		general_logger.info("Drawing graphs of top %s metrics of %s", str(num_rows), current_pod.name)
+		anomaly_graph.draw_graphs(self.global_matrix, [i[0] for i in current_pod.top[:num_rows]], found)
 
 	def display_screen(self, pod, num_rows):
 		self.screen.clear()
-		self.screen.addstr('Keys: "q" - exit, "l" - learning/monitoring, "e" - empty on/off, "s" - save, "d" - draw all on/off, arrows left/right - shift sorting\n')
-		self.screen.addstr(str(datetime.datetime.now()) + ' Learning: ' + str(learning) + ' ML: ' + str(len(ml.anomalies_found)) + ' progress: ' + ml.progress +
-			' processing: ' + ml.processed_column + '\n')
+		self.screen.addstr('Keys: "q" - exit, "l" - learning/monitoring, "e" - empty on/off, "s" - save, "d" - draw all on/off, "g" - draw top graphs, arrows left/right - shift sorting\n')
+		self.screen.addstr(str(datetime.datetime.now()) + ' Learning: ' + str(learning) + ' ML: ' + str(len(self.ml.anomalies_found)) + ' progress: ' + self.ml.progress +
+			' processing: ' + self.ml.processed_column + '\n')
 		self.display_pods_summary()
 		if pod:
 			self.screen.addstr('Pods: ' + str(len(self.pods)) + ' Metrics: ' + str(pod.metrics_count) + ' Series: ' + str(pod.series_count) +
@@ -765,7 +754,7 @@ class Monitor:
 			self.display_top_table(pod, num_rows)
 		else:
 			self.screen.addstr('Processing')
-		self.screen.addstr('\n' + ml.anomaly_info)
+		self.screen.addstr('\n' + self.ml.anomaly_info)
 		self.screen.refresh()
 	
 	def shift_index(self, key, shift, arr):
@@ -786,26 +775,22 @@ class Monitor:
 	def warm_up(self):
 		if self.args.reffile:
 			self.ref_file = self.args.reffile
+			self.ml.set_models_path(self.ref_file + MODELS_SUFFIX)
+		# The checkpoint has the reference stats of the pods as well, only newer files are processed then
+		restored = self.restore_checkpoint()
+		if self.args.reffile and not restored:
 			self.load_pods()
 		self.current_pod = self.args.pods[0]		
-		general_logger.info("Starting ML thread(s)")
-		# The following block is for background processing of selected metrics
-		#if self.args.multithreading:
-		#	column_filters = self.args.pods
-		#else:
-		#	column_filters = ['']
-		#ml_threads = {}
-		#for filter in column_filters:
-		#	ml_threads[filter] = threading.Thread(target=process_ml, args=(filter,))
-		#	ml_threads[filter].daemon = True
-		#	ml_threads[filter].start()
-
-		# Now we use instead the block for confirming suspected metrics
-		ml_thread = threading.Thread(target=confirm_anomalies)
-		ml_thread.daemon = True
-		ml_thread.start()
+		general_logger.info("Starting %s ML worker(s)", str(len(self.ml.workers)))
+		self.ml.start()
+
+		if self.args.jobs > 1:
+			general_logger.info("Starting %s pod workers", str(self.args.jobs))
+			self.pool = PodPool(self.args.jobs, self.pods, self.args.path)
+			self.pool.start()
+			self.pods = self.pool.pods
 				
-		self.process_pods(self.args.path, self.args.pods, True)
+		self.process_pods(self.args.path, self.args.pods, not restored)
 		self.start_timestamp = self.current_timestamp
 		if not self.start_timestamp:
 			self.start_timestamp = subprocess.check_output("date -Iseconds", shell=True, universal_newlines=True).strip()
@@ -842,18 +827,27 @@ class Monitor:
 					self.save_pods()
 				if key == ord('l'):
 					learning = not learning
-					ml.processing = not learning
+					self.ml.set_processing(not learning)
 					for pod in self.pods.values():
 						pod.set_reference()
+					if not learning:
+						self.train_models()
 				if key == ord('g'):
 					self.draw_graphs()
 				if key == ord('d'):
-					ml.draw_all = not ml.draw_all
+					self.ml.set_draw_all(not self.ml.draw_all)
 				self.screen.refresh()
 				if key == -1 or key == ord('q'):
 					break
+		self.stop()
 		exit(0)
 
+	def stop(self):
+		self.checkpoint(wait=True)
+		if self.pool:
+			self.pool.stop()
+		self.ml.stop()
+
 # Emulation class to use instead of curses in IDE
 class Screen:
 	def addstr(self, s):
@@ -875,8 +869,11 @@ class Screen:
 		pass
 
 class Servant:
-	def __init__(self, monitor_):
+	# Inline: the result is kept in value to be sent back to the client instead of writing it to the promise file
+	def __init__(self, monitor_, inline=False):
 		self.monitor = monitor_
+		self.inline = inline
+		self.value = None
 
 	def save(self, json_):
 		general_logger.error('Save the pods')
@@ -888,17 +885,22 @@ class Servant:
 		global learning
 
 		learning = not learning
-		ml.processing = not learning
+		self.monitor.ml.set_processing(not learning)
 		for pod in self.monitor.pods.values():
 			pod.set_reference()
 		if learning == False:
 			self.monitor.save_pods()
+			self.monitor.train_models()
 		return True
 
 	def quit(self, json_):
 		return False
 
 	def _set_value(self, request_, value_):
+		if self.inline:
+			self.value = value_
+			return True
+
 		if 'promise' not in request_:
 			general_logger.error("There is no promise element. Don't know where to store the result")
 			return False
@@ -911,20 +913,23 @@ class Servant:
 
 		return True
 
+	# Clients passing the version they have get {"version": v, "not_modified": true} if it is still the same,
+	# otherwise {"version": v, "result": ...}, the query runs only in that case
+	def _set_versioned(self, request_, version_, query_):
+		if 'version' not in request_:
+			return self._set_value(request_, query_())
+		if request_['version'] == version_:
+			return self._set_value(request_, {"version": version_, "not_modified": True})
+		return self._set_value(request_, {"version": version_, "result": query_()})
+
 	def is_learning(self, json_):
 		global learning
 
 		return self._set_value(json_, {"learning": learning})
 
 	def query_load(self, json_):
-		series_info = {"ref": 0, "total": self.monitor.series_count}
-
-		anomalies_info = []
-		for p in filter(lambda p_: 0 < p_.anomaly_maxed, self.monitor.pods.values()):
-			anomalies_info.append({"name": p.full_name, "ordinary": p.anomaly_maxed, "ml_confirmed": p.anomaly_ml})
-
-		p = [{"name": v.full_name, "ordinary": v.anomaly_maxed, "ml_confirmed": v.anomaly_ml} for v in self.monitor.pods.values()]
-		return self._set_value(json_, {"pods": p, "anomalies": anomalies_info, "samples": series_info})
+		snapshot = self.monitor.snapshot
+		return self._set_versioned(json_, snapshot.load_version, lambda: snapshot.load)
 
 	def reset_pod_service(self, json_):
 		if "pod" not in json_:
@@ -934,6 +939,7 @@ class Servant:
 		n = str(json_["pod"])
 		for p in filter(lambda p_: n == p_.full_name, self.monitor.pods.values()):
 			p.return_to_normal()
+			self.monitor.publish()
 			return True
 
 		logging.error("Unknown pod %s", n)
@@ -942,51 +948,55 @@ class Servant:
 	def reset_anomalies(self, json_):
 		for p in filter(lambda p_: 0 < p_.anomaly_maxed, self.monitor.pods.values()):
 			p.return_to_normal()
+		self.monitor.publish()
 
 		return True
 
-	def prepare_anomaly_to_report(self, name, anomaly_info, is_sibling=False):
-		anomaly_info = deepcopy(anomaly_info)
-		p = self.monitor.pods[anomaly_info['pod']]
-		anomaly_info['pod'] = p.full_name
+	# Entries of the snapshot are shared, so the report gets its own dict and only the changed parts are new
+	def prepare_anomaly_to_report(self, snapshot, name, anomaly_info, is_sibling=False):
+		report = dict(anomaly_info, pod=snapshot.pods[anomaly_info['pod']][0])
 		# Cleaning up ranges and positions for siblings of an incident
 		if is_sibling:
-			for position in anomaly_info['positions'].keys():
-				anomaly_info['positions'][position] = []
-			for range in anomaly_info['ranges'].keys():
-				anomaly_info['ranges'][range] = []
-		return anomaly_info
+			report['positions'] = {position: [] for position in anomaly_info['positions'].keys()}
+			report['ranges'] = {range: [] for range in anomaly_info['ranges'].keys()}
+		return report
 
 	def query_anomalies_info(self, json_):
-		current_anomalies = deepcopy(ml.anomalies_found)
-		current_all = deepcopy(ml.normals_found)
-		current_all.update(current_anomalies)
+		snapshot = self.monitor.snapshot
+		return self._set_versioned(json_, snapshot.anomalies_version, lambda: self.report_anomalies(snapshot))
+
+	def report_anomalies(self, snapshot):
+		current_anomalies = snapshot.anomalies_found
 		anomalies_to_report = {}
 		for key, val in current_anomalies.items():
+			name = registry.name(key)
 			if key not in self.monitor.reported_anomalies:
 				# Check that non-guilty siblings are not marked as anomalied by ML because of low peaks
-				if key.startswith(sibling_prefix) and key not in self.monitor.pods[val['pod']].suspected_anomalies:
-					general_logger.info("Skipping reporting of sibling as primary incident %s", key)
+				if name.startswith(sibling_prefix) and key not in snapshot.pods[val['pod']][1]:
+					general_logger.info("Skipping reporting of sibling as primary incident %s", name)
 					continue
 				self.monitor.reported_anomalies[key] = val
-				anomalies_to_report[key] = self.prepare_anomaly_to_report(key, val, False)
-				general_logger.info("Reporting anomaly %s", key)
-				if key.startswith(sibling_prefix):
-					metric = key.split('|', 1)[1]
+				anomalies_to_report[name] = self.prepare_anomaly_to_report(snapshot, name, val, False)
+				general_logger.info("Reporting anomaly %s", name)
+				if name.startswith(sibling_prefix):
+					metric = registry.metric(key)
 					for sibling in siblings:
-						full_name = sibling + '|' + metric
-						if full_name != key and full_name in current_all:
+						sibling_id = registry.lookup(sibling, metric)
+						sibling_info = current_anomalies.get(sibling_id) or snapshot.normals_found.get(sibling_id)
+						if sibling_id != key and sibling_info is not None:
+							full_name = registry.name(sibling_id)
 							general_logger.info("Reporting sibling anomaly %s", full_name)
-							anomalies_to_report[full_name] = self.prepare_anomaly_to_report(full_name, current_all[full_name], True)
+							anomalies_to_report[full_name] = self.prepare_anomaly_to_report(snapshot, full_name, sibling_info, True)
 			else:
-				general_logger.info("Skipping anomaly %s", key)
+				general_logger.info("Skipping anomaly %s", name)
 
 		for key in list(self.monitor.reported_anomalies.keys()):
 			if key not in current_anomalies:
-				general_logger.info("Deleting reported anomaly %s", key)
+				general_logger.info("Deleting reported anomaly %s", registry.name(key))
 				del self.monitor.reported_anomalies[key]
-		general_logger.info("Anomalies to report %s", str(anomalies_to_report))
-		return self._set_value(json_, anomalies_to_report)
+		# Series of the anomalies are not logged, they are sent to the client
+		general_logger.info("Anomalies to report %s", str(list(anomalies_to_report)))
+		return anomalies_to_report
 
 
 class Background(Monitor):
@@ -1003,7 +1013,7 @@ class Background(Monitor):
 			logging.error(e, exc_info=True)
 			raise
 
-	def _despatch(self, json_):
+	def _despatch(self, json_, servant):
 		if not json_:
 			general_logger.error('Invalid JSON command object')
 			return False
@@ -1013,13 +1023,23 @@ class Background(Monitor):
 			return False
 
 		c = json_['command']
-		o = getattr(Servant(self), c, None)
+		o = getattr(servant, c, None)
 		if not callable(o):
 			logging.error('Bad command name "%s"', c)
 			return False
 
 		return o(json_)
 
+	# Runs a command of the command server. Commands from stdin stop the monitor on any failure as before,
+	# those of the socket clients only by quit, and their result is the value of the command or its success
+	def _execute(self, json_, inline):
+		servant = Servant(self, inline)
+		result = self._despatch(json_, servant)
+		if not inline:
+			return result, None
+		go_on = not (isinstance(json_, dict) and json_.get('command') == 'quit')
+		return go_on, servant.value if servant.value is not None else {'result': bool(result) or not go_on}
+
 	def display_screen(self, pod, num_rows):
 		pass
 
@@ -1031,51 +1051,20 @@ class Background(Monitor):
 		w = threading.Thread(target=self._loop, args=[E])
 		w.start()
 
-		B = []
-		G = True
-		H = sys.stdin.fileno()
-		F = fcntl.fcntl(H, fcntl.F_GETFL)
-		fcntl.fcntl(H, fcntl.F_SETFL, F | os.O_NONBLOCK)
-
-		while G:
-			p = select.poll()
-			p.register(H, select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR)
-			b = None
-			try:
-				for h, f in p.poll():
-					if f & (select.POLLIN | select.POLLPRI):
-						b = os.read(h, 1024)
-					else:
-						break
-			except KeyboardInterrupt:
-				pass
-
-			if not b or len(b) == 0:
-				break
-
-			# TODO: need a check for the buffer is too large say more than 1024
-			B.extend(b)
-			while True:
-				p = None
-				try:
-					p = B.index(0)
-				except ValueError:
-					break
-
-				Q = None
-				try:
-					Q = json.loads(bytearray(B[0:p]).decode())
-				except json.decoder.JSONDecodeError:
-					pass
-
-				if not self._despatch(Q):
-					G = False
-					break
-
-				del B[0:p + 1]
+		try:
+			CommandServer(self._execute, self.args.socket, self.args.http).run()
+		except KeyboardInterrupt:
+			pass
 
 		E.set()
 		w.join()
+		self.stop()
+
+# Sets the module state in the pod worker processes, see pod_pool.py
+def set_worker_state(monitor_, learning_):
+	global monitor, learning
+	monitor = monitor_
+	learning = learning_
 
 def main():
 	parser = argparse.ArgumentParser()
@@ -1083,7 +1072,19 @@ def main():
 	parser.add_argument('-r', '--reffile', help='reference model file')
 	parser.add_argument('-p', '--pods', help='list of pods', nargs='+')
 	parser.add_argument('-B', '--background', help='enables background mode', action='store_true')
-	parser.add_argument('-m', '--multithreading', action='store_true', help='multithreading ml')
+	parser.add_argument('-m', '--multithreading', action='store_true', help='multithreading ml, one worker per pod')
+	parser.add_argument('--ml-workers', type=int, default=1, help='number of worker processes confirming anomalies by ML')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes to process pods in parallel')
+	parser.add_argument('-b', '--ml-batch', type=int, default=1, help='number of suspected metrics confirmed by ML together')
+	parser.add_argument('-d', '--detector', choices=DETECTORS, default=DETECTORS[0],
+						help='anomaly detector, staged confirms the median detector findings with lstm')
+	parser.add_argument('--ml-window', type=int, default=360, help='number of the last series analysed by ML, 0 for all')
+	parser.add_argument('--ml-history', type=int, default=0, help='number of points the older series are averaged into for ML')
+	parser.add_argument('--checkpoint', help='checkpoint file of the monitor state, by default next to the reference file')
+	parser.add_argument('--checkpoint-period', type=float, default=60, help='seconds between checkpoints')
+	parser.add_argument('--socket', help='Unix domain socket to serve the commands of the background mode on')
+	parser.add_argument('--http', type=int, help='port on localhost to serve the commands of the background mode over HTTP')
+	parser.add_argument('-w', '--window', type=int, default=DEFAULT_WINDOW, help='number of series kept in memory for each metric')
 	args = parser.parse_args()
 	if args.background:
 		Background(args).run()
@@ -1091,4 +1092,5 @@ def main():
 		# Use this wrapper to run in top-like mode
 		wrapper(lambda x_, y_: Monitor(x_, y_).run(), args)
 
-main()
+if __name__ == '__main__':
+	main()
@@ -11,6 +11,8 @@ from audioop import avg
 from tabulate import tabulate
 from matplotlib.font_manager import path
 
+from top_k import top_k
+
 STATS_PERCENTILE = 95
 EQUAL_ROWS_THRESHOLD_PERCENTAGE = 5
 
@@ -156,21 +158,13 @@ class Matrix:
 		return False
 	
 	def compute_results(self, num_rows, criteria):
-		for i in range(0, num_rows):
-			for criterion in criteria:
-				if not criterion.__name__ in self.top:
-					self.top[criterion.__name__] = []
-				self.top[criterion.__name__].append(('dummy', -1))
 		for row in self.matrix:
 			for criterion in criteria:
-				weight = criterion(self, row)
-				cname = criterion.__name__
-				self.results[row][cname] = weight
-				for i in range(0, num_rows):
-					if weight > self.top[cname][i][1]:
-						self.top[cname].insert(i, (row, weight))
-						del self.top[cname][-1]
-						break	 
+				self.results[row][criterion.__name__] = criterion(self, row)
+		for criterion in criteria:
+			cname = criterion.__name__
+			top = top_k(self.matrix, num_rows, lambda row_: self.results[row_][cname])
+			self.top[cname] = top + [('dummy', -1)] * (num_rows - len(top))
 
 class Pod:
 	def __init__(self, name, path):
@@ -0,0 +1,227 @@
+# Parallel processing of pods in worker processes.
+# Pods are distributed between the workers and stay there, on every tick the workers read
+# the new files of their pods and send back only the pod summaries and the series values
+# for the global matrix. Metric ids are taken from a counter shared by all the processes.
+
+import importlib
+import logging
+import multiprocessing
+import threading
+import types
+
+import numpy as np
+
+from metric_registry import registry
+
+# Pod attributes sent back to the monitor after processing
+SUMMARY = ['full_name', 'node', 'timestamp', 'processed_files', 'series_count', 'metrics_count',
+			'unique', 'empty', 'filtered_out', 'equaled_out', 'zeroed_out',
+			'anomalies', 'anomaly_unequal', 'anomaly_maxed', 'anomaly_deviated', 'anomaly_ml', 'suspected_anomalies']
+
+
+def summarize(pod):
+	return {name: getattr(pod, name) for name in SUMMARY}
+
+
+# Stands in for the global matrix in workers, keeps the series added by pods to send them to the monitor
+class SeriesBatch:
+
+	def __init__(self):
+		self.series = []
+
+	def extend(self, metric_ids, values):
+		self.series.append((np.array(metric_ids, dtype=np.int64), values))
+
+	# Block of series is sent as the series one by one
+	def extend_many(self, metric_ids, values, present):
+		metric_ids = np.array(metric_ids, dtype=np.int64)
+		for series_values, series_present in zip(values, present):
+			self.series.append((metric_ids[series_present], series_values[series_present]))
+
+	def take(self):
+		series = self.series
+		self.series = []
+		return series
+
+
+# Runs in the worker process, module_name is the module of the Pod class
+def run_pod_worker(module_name, path, names, pods, counter, commands, results):
+	monitor_module = importlib.import_module(module_name)
+	registry.load(names)
+	registry.share(counter)
+	monitor_module.Pod.path = path
+	# Pods reach the global matrix and the ML results through the monitor
+	global_matrix = SeriesBatch()
+	ml = types.SimpleNamespace(anomalies_found=set())
+	monitor = types.SimpleNamespace(global_matrix=global_matrix, ml=ml)
+
+	while True:
+		command, args = commands.get()
+		if command == 'quit':
+			break
+		try:
+			if command == 'process':
+				pod_files, learning, warming_up, anomalies_found, top = args
+				monitor_module.set_worker_state(monitor, learning)
+				ml.anomalies_found = anomalies_found
+				summaries = {}
+				series = {}
+				for name, pod in pods.items():
+					if warming_up:
+						pod.backfill(pod_files.get(name, []))
+						pod.return_to_normal()
+					else:
+						pod.process_pod(pod_files.get(name, []))
+					summaries[name] = summarize(pod)
+					series[name] = global_matrix.take()
+				top_pod, sort_metric, num_rows, empty_filter = top
+				top_table = None
+				if top_pod in pods:
+					pods[top_pod].sort_top(sort_metric, num_rows, empty_filter)
+					# The ids of the top metrics are sent along with the rows for the graphs of the monitor
+					top_table = (pods[top_pod].top, pods[top_pod].top_rows(num_rows))
+				results.put((summaries, series, registry.take_added(), top_table))
+			elif command == 'call':
+				name, method = args
+				value = getattr(pods[name], method)()
+				results.put((value, summarize(pods[name])))
+			elif command == 'pods':
+				results.put(pods)
+		except Exception as e:
+			logging.error("ERROR in pod worker")
+			logging.error(e, exc_info=True)
+			# Metrics added before the error are sent with it, otherwise their ids would have no names in the monitor
+			e.added = registry.take_added()
+			results.put(e)
+
+
+# Mirror of a pod living in a worker
+class RemotePod:
+
+	def __init__(self, name, pool):
+		self.name = name
+		self.pool = pool
+		self.top = []
+		self.top_table = []
+		for attr in SUMMARY:
+			setattr(self, attr, '' if attr in ['full_name', 'node', 'timestamp'] else 0)
+		self.suspected_anomalies = []
+
+	def update(self, summary):
+		self.__dict__.update(summary)
+
+	def return_to_normal(self):
+		self.pool.call(self.name, 'return_to_normal')
+
+	def set_reference(self):
+		self.pool.call(self.name, 'set_reference')
+
+	def memory_footprint(self):
+		return self.pool.call(self.name, 'memory_footprint')
+
+	def top_rows(self, num_rows):
+		return self.top_table[:num_rows]
+
+
+class PodPool:
+
+	def __init__(self, jobs, pods, path):
+		context = multiprocessing.get_context('spawn')
+		self.lock = threading.Lock()
+		# Next metric id, the monitor registry gets the ids added by the workers after every tick
+		self.counter = context.Value('q', len(registry))
+		registry.share(self.counter)
+		module_name = type(next(iter(pods.values()))).__module__
+		jobs = max(1, min(jobs, len(pods)))
+		self.workers = []
+		self.owners = {}
+		for i in range(jobs):
+			worker_pods = {name: pod for n, (name, pod) in enumerate(pods.items()) if n % jobs == i}
+			commands = context.Queue()
+			results = context.Queue()
+			process = context.Process(target=run_pod_worker,
+									args=(module_name, path, registry.names, worker_pods, self.counter, commands, results))
+			process.daemon = True
+			self.workers.append((process, commands, results))
+			for name in worker_pods:
+				self.owners[name] = i
+		self.pods = {name: RemotePod(name, self) for name in pods}
+
+	def start(self):
+		for process, commands, results in self.workers:
+			process.start()
+
+	def stop(self):
+		for process, commands, results in self.workers:
+			commands.put(('quit', None))
+		for process, commands, results in self.workers:
+			process.join(10)
+
+	# Metrics added by a worker which failed come with its error
+	def get_reply(self, results):
+		reply = results.get()
+		if isinstance(reply, Exception):
+			for metric_id, key in getattr(reply, 'added', []):
+				registry.add(metric_id, key)
+		return reply
+
+	def receive(self, results):
+		reply = self.get_reply(results)
+		if isinstance(reply, Exception):
+			raise reply
+		return reply
+
+	# Takes the replies of all the workers before any error is raised, so that no reply is left
+	# in the queues to be taken for the next command
+	def receive_all(self):
+		return [self.get_reply(results) for process, commands, results in self.workers]
+
+	def raise_error(self, replies):
+		for reply in replies:
+			if isinstance(reply, Exception):
+				raise reply
+
+	# Processes new files of all the pods in the workers and adds their series to the global matrix
+	def process(self, pod_files, learning, warming_up, anomalies_found, top, global_matrix):
+		with self.lock:
+			for i, (process, commands, results) in enumerate(self.workers):
+				files = {name: fnames for name, fnames in pod_files.items() if self.owners.get(name) == i}
+				commands.put(('process', (files, learning, warming_up, set(anomalies_found), top)))
+			series = {}
+			replies = self.receive_all()
+			# Results of the workers which succeeded are taken anyway
+			for reply in replies:
+				if isinstance(reply, Exception):
+					continue
+				summaries, worker_series, added, top_table = reply
+				for metric_id, key in added:
+					registry.add(metric_id, key)
+				for name, summary in summaries.items():
+					self.pods[name].update(summary)
+				series.update(worker_series)
+				if top_table is not None:
+					self.pods[top[0]].top, self.pods[top[0]].top_table = top_table
+			for name in self.pods:
+				for metric_ids, values in series.get(name, []):
+					global_matrix.extend(metric_ids.tolist(), values)
+			self.raise_error(replies)
+
+	def call(self, name, method):
+		with self.lock:
+			process, commands, results = self.workers[self.owners[name]]
+			commands.put(('call', (name, method)))
+			value, summary = self.receive(results)
+			self.pods[name].update(summary)
+			return value
+
+	# Returns copies of the pods from the workers
+	def fetch_pods(self):
+		with self.lock:
+			pods = {}
+			for process, commands, results in self.workers:
+				commands.put(('pods', None))
+			replies = self.receive_all()
+			self.raise_error(replies)
+			for reply in replies:
+				pods.update(reply)
+			return {name: pods[name] for name in self.pods}
@@ -0,0 +1,287 @@
+# Statistics of all the metrics of a pod kept as NumPy columns, one row per metric.
+# A whole series is processed in one vectorized step: counter increments, running stats,
+# normalized values, differences with the reference stats and maxed/deviated anomalies.
+
+import numpy as np
+
+# Column: (dtype, initial value)
+columns = {
+	# Ids: metric ids from the registry
+	'ids': (np.int64, 0),
+	# Is counter: counters are growing and their increments are taken as values
+	'is_counter': (np.bool_, False),
+	# Has counter: the counter has been read at least once
+	'has_counter': (np.bool_, False),
+	# Start: first number in sequence for counters
+	'start': (np.float64, 0.0),
+	# Counter: last read value of the counter
+	'counter': (np.float64, 0.0),
+	# Filtered out: the metric should be skipped everywhere
+	'filtered_out': (np.bool_, False),
+	# Equaled out: is a part of some other equaled group
+	'equaled_out': (np.bool_, False),
+	# Equals count: a number of equals in the group
+	'equals_count': (np.int64, 0),
+	# Empty: sign that the last read value was empty or there was no value yet
+	'empty': (np.bool_, True),
+	'last_value': (np.float64, np.nan),
+	'norm_last_value': (np.float64, np.nan),
+	# Count: number of values encountered so far
+	'count': (np.int64, 0),
+	'min': (np.float64, np.inf),
+	'avg': (np.float64, 0.0),
+	'max': (np.float64, 0.0),
+	'var': (np.float64, 0.0),
+	'dev': (np.float64, 0.0),
+	# Normalized stats - min is always 0 and max is always 1
+	'norm_avg': (np.float64, 0.0),
+	'norm_dev': (np.float64, 0.0),
+	# Reference stats frozen after learning stage
+	'ref_count': (np.int64, 0),
+	'ref_equals_count': (np.int64, 0),
+	'ref_max': (np.float64, 0.0),
+	'ref_dev': (np.float64, 0.0),
+	'ref_norm_dev': (np.float64, 0.0),
+	# Differences between current and reference stats
+	'diff_equals_count': (np.int64, 0),
+	'diff_max': (np.float64, 0.0),
+	'diff_dev': (np.float64, 0.0),
+	'diff_norm_dev': (np.float64, 0.0),
+	# Anomalies: count of anomalies of the metric
+	'anomalies': (np.int64, 0),
+	'anomaly_unequal': (np.float64, 0.0),
+	'anomaly_maxed': (np.float64, 0.0),
+	'anomaly_deviated': (np.float64, 0.0),
+	'anomaly_ml': (np.int64, 0),
+}
+
+# Anomaly columns cleared along with returning to normal and setting the reference
+anomaly_columns = ['anomalies', 'anomaly_unequal', 'anomaly_maxed', 'anomaly_deviated', 'anomaly_ml']
+
+
+class PodStats:
+
+	def __init__(self):
+		self.size = 0
+		self.capacity = 0
+		for name, (dtype, initial) in columns.items():
+			setattr(self, name, np.zeros(0, dtype=dtype))
+
+	def __len__(self):
+		return self.size
+
+	@property
+	def nbytes(self):
+		return sum(getattr(self, name).nbytes for name in columns)
+
+	# Returns the column trimmed to the existing rows
+	def column(self, name):
+		return getattr(self, name)[:self.size]
+
+	def add(self, metric_id, kind):
+		row = self.size
+		if row == self.capacity:
+			self.capacity = max(16, row * 2)
+			for name, (dtype, initial) in columns.items():
+				column = np.full(self.capacity, initial, dtype=dtype)
+				column[:row] = getattr(self, name)[:row]
+				setattr(self, name, column)
+		self.ids[row] = metric_id
+		self.is_counter[row] = kind == 'C'
+		self.size += 1
+		return row
+
+	def set_empty(self, rows):
+		self.empty[rows] = True
+		self.last_value[rows] = np.nan
+		self.norm_last_value[rows] = np.nan
+
+	# Processes values of the given rows (expected to be unique) read in one series,
+	# returns the rows which values are maxed in comparison with the reference
+	def update(self, rows, values, learning, anomalies_found, max_threshold, deviation_threshold):
+		# Normalize counters
+		counters = self.is_counter[rows]
+		if counters.any():
+			counter_rows = rows[counters]
+			counter_values = values[counters]
+			old_values = self.counter[counter_rows]
+			started = self.has_counter[counter_rows] & (old_values != 0)
+			self.start[counter_rows] = np.where(started, self.start[counter_rows], counter_values)
+			self.counter[counter_rows] = counter_values
+			self.has_counter[counter_rows] = True
+			values = values.copy()
+			values[counters] = np.where(started, counter_values - old_values, 0.0)
+
+		# Calculate stats
+		self.empty[rows] = False
+		self.last_value[rows] = values
+		count = self.count[rows] + 1
+		self.count[rows] = count
+		minimum = self.min[rows]
+		self.min[rows] = np.where(values < minimum, values, minimum)
+		avg = self.avg[rows]
+		delta = values - avg
+		avg = avg + delta / count
+		self.avg[rows] = avg
+		maximum = self.max[rows]
+		maximum = np.where(values > maximum, values, maximum)
+		self.max[rows] = maximum
+		var = (self.var[rows] * (count - 1) + delta * (values - avg)) / count
+		self.var[rows] = var
+		with np.errstate(divide='ignore', invalid='ignore'):
+			dev = np.sqrt(var)
+			self.dev[rows] = dev
+			normalized = maximum != 0
+			self.norm_last_value[rows] = np.where(normalized, values / maximum, 0.0)
+			norm_avg = np.where(normalized, avg / maximum, self.norm_avg[rows])
+			norm_dev = np.where(normalized, dev / maximum, self.norm_dev[rows])
+		self.norm_avg[rows] = norm_avg
+		self.norm_dev[rows] = norm_dev
+
+		if learning:
+			self.diff_equals_count[rows] = 0
+			self.diff_max[rows] = 0.0
+			self.diff_dev[rows] = 0.0
+			self.diff_norm_dev[rows] = 0.0
+			return rows[:0]
+
+		# We'll be looking for metrics with less equals than in reference, which means less uniformity
+		self.diff_equals_count[rows] = self.ref_equals_count[rows] - self.equals_count[rows]
+		# We'll be looking for metrics with increased values
+		ref_max = self.ref_max[rows]
+		diff_max = maximum - ref_max
+		self.diff_max[rows] = diff_max
+		self.diff_dev[rows] = dev - self.ref_dev[rows]
+		diff_norm_dev = norm_dev - self.ref_norm_dev[rows]
+		self.diff_norm_dev[rows] = diff_norm_dev
+		maxed = diff_max > ref_max * (1 + max_threshold)
+		self.anomaly_maxed[rows] = np.where(maxed, diff_max, 0.0)
+		deviated = diff_norm_dev > deviation_threshold
+		self.anomaly_deviated[rows] = np.where(deviated, diff_norm_dev, 0.0)
+		anomaly_ml = self.anomaly_ml[rows]
+		found = np.isin(self.ids[rows], np.fromiter(anomalies_found, dtype=np.int64, count=len(anomalies_found)))
+		cleared = ~found & (anomaly_ml == 1)
+		self.anomaly_ml[rows] = np.where(found, 1, np.where(cleared, 0, anomaly_ml))
+		self.anomalies[rows] += maxed.astype(np.int64) + deviated + found - cleared
+		return rows[maxed]
+
+	# Processes a block of series at once, with the same results as set_empty and update of every series in turn.
+	# Values is a (series, rows) array for the given rows, present tells which metrics were read in every series
+	# and empty which of them had empty values. Running stats of every series are taken from cumulative sums,
+	# so the anomalies are counted in every series, returns the rows which values are maxed in the last series
+	def update_many(self, rows, values, present, empty, learning, anomalies_found, max_threshold, deviation_threshold):
+		observed = present & ~empty
+		series_n, rows_n = values.shape
+		steps = np.arange(series_n)[:, None]
+		cols = np.arange(rows_n)
+		# Series of the last value observed up to every series, -1 before the first one
+		last_observed = np.maximum.accumulate(np.where(observed, steps, -1), axis=0)
+
+		# Normalize counters: increments between the values observed in succession
+		counters = np.flatnonzero(self.is_counter[rows])
+		if len(counters):
+			values = values.copy()
+			counter_rows = rows[counters]
+			counter_values = values[:, counters]
+			index = np.arange(len(counters))
+			previous = np.vstack((np.full((1, len(counters)), -1), last_observed[:-1, counters]))
+			old_values = np.where(previous >= 0, counter_values[np.maximum(previous, 0), index], self.counter[counter_rows])
+			started = ((previous >= 0) | self.has_counter[counter_rows]) & (old_values != 0)
+			# Start is the value of the last series in which the counter was not started
+			restarted = np.maximum.accumulate(np.where(observed[:, counters] & ~started, steps, -1), axis=0)[-1]
+			self.start[counter_rows] = np.where(restarted >= 0, counter_values[np.maximum(restarted, 0), index], self.start[counter_rows])
+			last = last_observed[-1, counters]
+			self.counter[counter_rows] = np.where(last >= 0, counter_values[np.maximum(last, 0), index], self.counter[counter_rows])
+			self.has_counter[counter_rows] |= last >= 0
+			values[:, counters] = np.where(started, counter_values - old_values, 0.0)
+
+		# Running stats after every series, sums are taken around the former average or the first value for precision
+		old_count = self.count[rows]
+		old_avg = self.avg[rows]
+		count = old_count + np.cumsum(observed, axis=0)
+		first = values[observed.argmax(axis=0), cols]
+		shift = np.where(old_count > 0, old_avg, np.where(observed.any(axis=0), first, 0.0))
+		shifted = np.where(observed, values - shift, 0.0)
+		sum1 = old_count * (old_avg - shift) + np.cumsum(shifted, axis=0)
+		sum2 = old_count * (self.var[rows] + (old_avg - shift) ** 2) + np.cumsum(shifted * shifted, axis=0)
+		minimum = np.minimum(self.min[rows], np.minimum.accumulate(np.where(observed, values, np.inf), axis=0))
+		maximum = np.maximum(self.max[rows], np.maximum.accumulate(np.where(observed, values, -np.inf), axis=0))
+		with np.errstate(divide='ignore', invalid='ignore'):
+			mean = sum1 / count
+			avg = shift + mean
+			var = np.maximum(sum2 / count - mean * mean, 0.0)
+			dev = np.sqrt(var)
+			norm_dev = np.where(maximum != 0, dev / maximum, self.norm_dev[rows])
+
+		# Stats of the last observed series
+		read = last_observed[-1] >= 0
+		self.count[rows] = count[-1]
+		self.min[rows] = minimum[-1]
+		self.max[rows] = maximum[-1]
+		self.avg[rows] = np.where(read, avg[-1], old_avg)
+		self.var[rows] = np.where(read, var[-1], self.var[rows])
+		self.dev[rows] = np.where(read, dev[-1], self.dev[rows])
+		normalized = read & (maximum[-1] != 0)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			self.norm_avg[rows] = np.where(normalized, avg[-1] / maximum[-1], self.norm_avg[rows])
+			self.norm_dev[rows] = np.where(normalized, dev[-1] / maximum[-1], self.norm_dev[rows])
+			# The last series a metric was read in tells if it is empty now
+			last_present = np.maximum.accumulate(np.where(present, steps, -1), axis=0)[-1]
+			last_value = values[np.maximum(last_present, 0), cols]
+			last_empty = empty[np.maximum(last_present, 0), cols]
+			norm_last_value = np.where(maximum[-1] != 0, last_value / maximum[-1], 0.0)
+		updated = last_present >= 0
+		self.empty[rows] = np.where(updated, last_empty, self.empty[rows])
+		self.last_value[rows] = np.where(updated, np.where(last_empty, np.nan, last_value), self.last_value[rows])
+		self.norm_last_value[rows] = np.where(updated, np.where(last_empty, np.nan, norm_last_value), self.norm_last_value[rows])
+
+		if learning:
+			for name in ['diff_equals_count', 'diff_max', 'diff_dev', 'diff_norm_dev']:
+				getattr(self, name)[rows] = np.where(read, 0, getattr(self, name)[rows])
+			return rows[:0]
+
+		ref_max = self.ref_max[rows]
+		diff_max = maximum - ref_max
+		maxed = observed & (diff_max > ref_max * (1 + max_threshold))
+		diff_norm_dev = norm_dev - self.ref_norm_dev[rows]
+		deviated = observed & (diff_norm_dev > deviation_threshold)
+		self.diff_equals_count[rows] = np.where(read, self.ref_equals_count[rows] - self.equals_count[rows], self.diff_equals_count[rows])
+		self.diff_max[rows] = np.where(read, diff_max[-1], self.diff_max[rows])
+		self.diff_dev[rows] = np.where(read, dev[-1] - self.ref_dev[rows], self.diff_dev[rows])
+		self.diff_norm_dev[rows] = np.where(read, diff_norm_dev[-1], self.diff_norm_dev[rows])
+		last = np.maximum(last_observed[-1], 0)
+		self.anomaly_maxed[rows] = np.where(read, np.where(maxed[last, cols], diff_max[-1], 0.0), self.anomaly_maxed[rows])
+		self.anomaly_deviated[rows] = np.where(read, np.where(deviated[last, cols], diff_norm_dev[-1], 0.0), self.anomaly_deviated[rows])
+		anomaly_ml = self.anomaly_ml[rows]
+		found = np.isin(self.ids[rows], np.fromiter(anomalies_found, dtype=np.int64, count=len(anomalies_found)))
+		cleared = read & ~found & (anomaly_ml == 1)
+		self.anomaly_ml[rows] = np.where(read & found, 1, np.where(cleared, 0, anomaly_ml))
+		# Found metrics are counted in every series they are read in, cleared ones only once
+		self.anomalies[rows] += maxed.sum(axis=0) + deviated.sum(axis=0) + found * observed.sum(axis=0) - cleared
+		return rows[maxed[-1]]
+
+	def set_reference(self):
+		n = self.size
+		self.ref_count[:n] = self.count[:n]
+		self.ref_equals_count[:n] = self.equals_count[:n]
+		self.ref_max[:n] = self.max[:n]
+		self.ref_dev[:n] = self.dev[:n]
+		self.ref_norm_dev[:n] = self.norm_dev[:n]
+		self.diff_equals_count[:n] = 0
+		for name in ['diff_max', 'diff_dev', 'diff_norm_dev'] + anomaly_columns:
+			getattr(self, name)[:n] = 0
+
+	def return_to_normal(self):
+		n = self.size
+		self.equals_count[:n] = self.ref_equals_count[:n]
+		self.max[:n] = self.ref_max[:n]
+		self.dev[:n] = self.ref_dev[:n]
+		self.norm_dev[:n] = self.ref_norm_dev[:n]
+		for name in anomaly_columns:
+			getattr(self, name)[:n] = 0
+
+	def zeroed_out(self):
+		return (self.column('min') == np.inf) | (self.column('max') == 0)
+
+	def discarded(self):
+		return self.column('empty') | self.column('filtered_out') | self.column('equaled_out') | self.zeroed_out()
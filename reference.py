@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+
+# Reference stats of the pods saved when learning is over, see Monitor.save_pods.
+# The file is an uncompressed .npz with the format version, the reference timestamp, the pod names and,
+# for every pod, the names of its metrics (without the pod), the reference stats of the metrics and
+# the equal groups as the row of the primary equal of every metric (-1 if the metric is not equaled out):
+#   version, timestamp, pods, <pod>/metrics, <pod>/ref_max, ..., <pod>/primary
+# Arrays are memory mapped from the file, the metrics of a pod are indexed on the first lookup in the pod.
+# Reference files pickled by former versions of the monitor are converted on loading or by running
+#   ./reference.py ../ref/refstats
+
+import argparse
+import mmap
+import os
+import pickle
+import struct
+import zipfile
+
+import numpy as np
+
+from metric_registry import registry
+
+REFERENCE_VERSION = 1
+# Reference stats saved for every metric, columns of PodStats
+ref_columns = ['ref_count', 'ref_equals_count', 'ref_max', 'ref_dev', 'ref_norm_dev']
+# Length of the fixed part of the zip local file header, followed by the member name and extra field
+ZIP_HEADER_SIZE = 30
+
+
+def encode_strings(strings):
+	return np.frombuffer('\n'.join(strings).encode(), dtype=np.uint8)
+
+def decode_strings(array):
+	text = bytes(array).decode()
+	return text.split('\n') if text else []
+
+# Pods are name -> (metric names, ref column name -> values, primary rows)
+def save_reference(path, timestamp, pods):
+	arrays = {
+		'version': np.array([REFERENCE_VERSION], dtype=np.int64),
+		'timestamp': encode_strings([timestamp]),
+		'pods': encode_strings(pods.keys()),
+	}
+	for pod_name, (metrics, columns, primary) in pods.items():
+		arrays[pod_name + '/metrics'] = encode_strings(metrics)
+		for name in ref_columns:
+			arrays[pod_name + '/' + name] = np.asarray(columns[name])
+		arrays[pod_name + '/primary'] = np.asarray(primary, dtype=np.int64)
+	# Saved while the monitor is running, so the file is replaced only when it is complete
+	with open(path + '.tmp', 'wb') as f:
+		np.savez(f, **arrays)
+	os.replace(path + '.tmp', path)
+
+# Reference of a live Pod: its metrics in the order of its rows in PodStats
+def pod_reference(pod):
+	stats = pod.pod_stats
+	metrics = [registry.metric(metric_id) for metric_id in stats.column('ids').tolist()]
+	columns = {name: stats.column(name).copy() for name in ref_columns}
+	primary = np.full(len(stats), -1, dtype=np.int64)
+	for result in pod.results.values():
+		if result.equaled_out and result.primary_equal is not None:
+			primary[result.row] = result.primary_equal.row
+	return metrics, columns, primary
+
+def is_reference(path):
+	return zipfile.is_zipfile(path)
+
+# Returns member name -> array mapped from the file, members must be stored uncompressed as np.savez does
+def map_npz(path):
+	arrays = {}
+	with open(path, 'rb') as f, zipfile.ZipFile(f) as zf:
+		buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		for info in zf.infolist():
+			if info.compress_type != zipfile.ZIP_STORED:
+				raise ValueError('Compressed member ' + info.filename + ' in ' + path)
+			f.seek(info.header_offset)
+			header = f.read(ZIP_HEADER_SIZE)
+			name_length, extra_length = struct.unpack('<HH', header[26:30])
+			f.seek(info.header_offset + ZIP_HEADER_SIZE + name_length + extra_length)
+			version = np.lib.format.read_magic(f)
+			if version == (1, 0):
+				shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+			else:
+				shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+			arrays[info.filename[:-len('.npy')]] = np.ndarray(shape, dtype, buffer=buffer, offset=f.tell(),
+														order='F' if fortran_order else 'C')
+	return arrays
+
+
+class Reference:
+
+	def __init__(self, path):
+		self.path = path
+		self.arrays = map_npz(path)
+		version = int(self.arrays['version'][0])
+		if version > REFERENCE_VERSION:
+			raise ValueError('Reference file ' + path + ' has version ' + str(version) + ', supported ' + str(REFERENCE_VERSION))
+		self.timestamp = (decode_strings(self.arrays['timestamp']) or [''])[0]
+		self.pods = decode_strings(self.arrays['pods'])
+
+	def pod(self, pod_name):
+		if pod_name not in self.pods:
+			return None
+		return PodReference(self.path, pod_name)
+
+
+# References opened in this process, pods of the same file share the mapping
+opened = {}
+
+def open_reference(path):
+	reference = opened.get(path)
+	mtime = os.path.getmtime(path)
+	if reference is None or reference[0] != mtime:
+		reference = (mtime, Reference(path))
+		opened[path] = reference
+	return reference[1]
+
+
+# Reference stats of one pod, opened on the first lookup.
+# It is pickled along with the pod, e.g. to a pod worker, as the path only
+class PodReference:
+
+	def __init__(self, path, pod_name):
+		self.path = path
+		self.pod_name = pod_name
+		self.rows = None
+		self.metrics = None
+		self.columns = None
+		self.primary = None
+
+	def __getstate__(self):
+		return {'path': self.path, 'pod_name': self.pod_name, 'rows': None, 'metrics': None, 'columns': None, 'primary': None}
+
+	def load(self):
+		arrays = open_reference(self.path).arrays
+		prefix = self.pod_name + '/'
+		self.columns = {name: arrays[prefix + name] for name in ref_columns}
+		self.primary = arrays[prefix + 'primary']
+		self.metrics = decode_strings(arrays[prefix + 'metrics'])
+		self.rows = {metric: row for row, metric in enumerate(self.metrics)}
+
+	def __len__(self):
+		if self.rows is None:
+			self.load()
+		return len(self.rows)
+
+	# Sets the reference stats of the metric in the row of PodStats, returns False if the metric is not in the reference
+	def apply(self, stats, row, metric):
+		if self.rows is None:
+			self.load()
+		ref_row = self.rows.get(metric)
+		if ref_row is None:
+			return False
+		for name in ref_columns:
+			getattr(stats, name)[row] = self.columns[name][ref_row]
+		return True
+
+	# Returns the metric name of the primary equal of the metric in the reference
+	def primary_equal(self, metric):
+		if self.rows is None:
+			self.load()
+		ref_row = self.rows.get(metric)
+		if ref_row is None or self.primary[ref_row] < 0:
+			return None
+		return self.metrics[self.primary[ref_row]]
+
+
+# Classes of the monitor are not needed to read the pickled pods, all the objects are read as plain attributes,
+# so the pickles of the former versions of the classes are read as well
+class LegacyObject:
+
+	def __setstate__(self, state):
+		if isinstance(state, tuple):
+			state = state[0] or {}
+		self.__dict__.update(state)
+
+class LegacyUnpickler(pickle.Unpickler):
+
+	def find_class(self, module, name):
+		if module.split('.')[0] in ['builtins', 'collections', 'copyreg', 'numpy', '_codecs']:
+			return super().find_class(module, name)
+		return LegacyObject
+
+def legacy_value(result, name):
+	state = vars(result)
+	if name in state:
+		return state[name]
+	# Numbers kept in PodStats columns
+	return getattr(state['stats'], name)[state['row']].item()
+
+# Reference of a pickled pod, names of its results are like pod|metric
+def legacy_pod_reference(pod):
+	results = list(pod.results.values())
+	rows = {id(result): row for row, result in enumerate(results)}
+	metrics = [result.name.split('|', 1)[1] for result in results]
+	columns = {name: np.array([legacy_value(result, name) for result in results]) for name in ref_columns}
+	columns['ref_count'] = columns['ref_count'].astype(np.int64)
+	columns['ref_equals_count'] = columns['ref_equals_count'].astype(np.int64)
+	primary = np.full(len(results), -1, dtype=np.int64)
+	for row, result in enumerate(results):
+		primary_equal = vars(result).get('primary_equal')
+		if legacy_value(result, 'equaled_out') and primary_equal is not None and id(primary_equal) in rows:
+			primary[row] = rows[id(primary_equal)]
+	return metrics, columns, primary
+
+# Converts the pickled (timestamp, pods[, names]) reference file into the reference format
+def convert_reference(path, output):
+	with open(path, 'rb') as f:
+		saved = LegacyUnpickler(f).load()
+	timestamp, pods = saved[0], saved[1]
+	save_reference(output, timestamp, {pod_name: legacy_pod_reference(pod) for pod_name, pod in pods.items()})
+	return timestamp, list(pods)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Converts a pickled reference file of the monitor into the reference format')
+	parser.add_argument('path', help='reference file')
+	parser.add_argument('-o', '--output', help='converted file, by default the reference file is replaced and kept with .pickle suffix')
+	args = parser.parse_args()
+	if is_reference(args.path):
+		reference = Reference(args.path)
+		print('%s is already in the reference format version %d with timestamp %s, pods: %s' %
+			(args.path, int(reference.arrays['version'][0]), reference.timestamp, ' '.join(reference.pods)))
+		return
+	output = args.output
+	if not output:
+		output = args.path
+		os.replace(args.path, args.path + '.pickle')
+		args.path += '.pickle'
+	timestamp, pods = convert_reference(args.path, output)
+	print('Converted %s pods with timestamp %s into %s' % (len(pods), timestamp, output))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,140 @@
+# Bounded retention of metric time series.
+# Each metric gets a preallocated ring buffer row keeping the last "window" samples,
+# so memory stays flat no matter how long the monitor is running.
+
+import numpy as np
+
+# 4 hours of series collected every 5 seconds
+DEFAULT_WINDOW = 2880
+
+
+class SeriesStore:
+
+	def __init__(self, window=DEFAULT_WINDOW):
+		self.window = window
+		# Data: ring buffers, one row per metric
+		self.data = np.zeros((0, window))
+		# Rows: metric id -> row in data
+		self.rows = {}
+		# Counts: number of samples ever appended to each row
+		self.counts = np.zeros(0, dtype=np.int64)
+		# Lengths: number of samples available in each row (at most window)
+		self.lengths = np.zeros(0, dtype=np.int64)
+
+	def __len__(self):
+		return len(self.rows)
+
+	# Only the available samples of the rows in use are pickled, e.g. into a checkpoint
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		n = len(self.rows)
+		data = np.zeros((n, self.window))
+		state['data'] = data[:, :self.copy_ordered(data, np.zeros(n, dtype=np.int64))]
+		state['counts'] = self.counts[:n]
+		state['lengths'] = self.lengths[:n]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		samples = self.data
+		length = samples.shape[1]
+		self.data = np.zeros((len(self.rows), self.window))
+		index = (self.counts[:, None] - length + np.arange(length)) % self.window
+		np.put_along_axis(self.data, index, samples, axis=1)
+
+	def __contains__(self, metric_id):
+		return metric_id in self.rows
+
+	def keys(self):
+		return self.rows.keys()
+
+	@property
+	def nbytes(self):
+		return self.data.nbytes + self.counts.nbytes + self.lengths.nbytes
+
+	def add_row(self, metric_id):
+		row = len(self.rows)
+		if row == self.data.shape[0]:
+			capacity = max(16, row * 2)
+			data = np.zeros((capacity, self.window))
+			data[:row] = self.data
+			self.data = data
+			self.counts = np.concatenate((self.counts, np.zeros(capacity - row, dtype=np.int64)))
+			self.lengths = np.concatenate((self.lengths, np.zeros(capacity - row, dtype=np.int64)))
+		self.rows[metric_id] = row
+		return row
+
+	def append(self, metric_id, value):
+		row = self.rows.get(metric_id)
+		if row is None:
+			row = self.add_row(metric_id)
+		count = self.counts[row]
+		self.data[row, count % self.window] = value
+		self.counts[row] = count + 1
+		if self.lengths[row] < self.window:
+			self.lengths[row] += 1
+
+	# Appends one value to each of the given metrics, ids are expected to be unique
+	def extend(self, metric_ids, values):
+		rows = np.fromiter((self.rows[metric_id] if metric_id in self.rows else self.add_row(metric_id) for metric_id in metric_ids),
+						dtype=np.int64, count=len(metric_ids))
+		counts = self.counts[rows]
+		self.data[rows, counts % self.window] = values
+		self.counts[rows] = counts + 1
+		self.lengths[rows] = np.minimum(self.lengths[rows] + 1, self.window)
+
+	# Appends a block of series at once: values is a (series, metrics) array and present tells
+	# which metrics have a value in every series, only the last window samples of a metric are written
+	def extend_many(self, metric_ids, values, present):
+		rows = np.fromiter((self.rows[metric_id] if metric_id in self.rows else self.add_row(metric_id) for metric_id in metric_ids),
+						dtype=np.int64, count=len(metric_ids))
+		counts = self.counts[rows]
+		added = present.sum(axis=0)
+		positions = counts + np.cumsum(present, axis=0) - 1
+		series, columns = np.nonzero(present & (positions >= counts + added - self.window))
+		self.data[rows[columns], positions[series, columns] % self.window] = values[series, columns]
+		self.counts[rows] = counts + added
+		self.lengths[rows] = np.minimum(self.lengths[rows] + added, self.window)
+
+	def count(self, metric_id):
+		return int(self.counts[self.rows[metric_id]])
+
+	def min_count(self):
+		if not self.rows:
+			return 0
+		return int(self.counts[:len(self.rows)].min())
+
+	def max_count(self):
+		if not self.rows:
+			return 0
+		return int(self.counts[:len(self.rows)].max())
+
+	# Drops the latest samples of the metrics which have more than count samples
+	def truncate(self, count):
+		n = len(self.rows)
+		excess = np.maximum(self.counts[:n] - count, 0)
+		self.counts[:n] -= excess
+		self.lengths[:n] = np.maximum(self.lengths[:n] - excess, 0)
+
+	# Returns a copy of the available samples of the metric in chronological order
+	def values(self, metric_id):
+		row = self.rows[metric_id]
+		end = self.counts[row] % self.window
+		start = end - self.lengths[row]
+		if start >= 0:
+			return self.data[row, start:end].copy()
+		return np.concatenate((self.data[row, start:], self.data[row, :end]))
+
+	# Copies samples of all the metrics in chronological order into out[rows, samples] array
+	# and their ids into out_ids, returns the number of samples copied for each metric
+	def copy_ordered(self, out, out_ids):
+		n = len(self.rows)
+		length = int(self.lengths[:n].max()) if n else 0
+		index = (self.counts[:n, None] - length + np.arange(length)) % self.window
+		out[:n, :length] = np.take_along_axis(self.data[:n], index, axis=1)
+		out_ids[:n] = list(self.rows.keys())
+		return length
+
+	# Returns metric id -> chronological samples for all the metrics
+	def snapshot(self):
+		return {metric_id: self.values(metric_id) for metric_id in self.rows}
@@ -0,0 +1,72 @@
+# State of the monitor published once per tick for the queries of the background mode, see Monitor.publish.
+# A snapshot is not changed after it is published, so queries read the latest one without locks or copies.
+# The ML results it refers to are not copied either: the ML workers replace their results as a whole, see MLWorker.update.
+# Load and anomalies keep the version of the snapshot they last changed in, a client which passes the version
+# it has gets "not modified" instead of the same data again, see Servant._set_versioned.
+
+import time
+
+# Seconds after which the memory footprint of a pod is taken again even if its metrics have not changed,
+# the series and results grow with the same metrics, e.g. after a restart from a checkpoint
+MEMORY_PERIOD = 60
+
+
+# ML results are taken as changed when their metrics or info (the ranges and positions found) change,
+# the series of the metrics are moving with every tick anyway
+def found_state(anomalies_found, normals_found):
+	return ({key: anomaly['info'] for key, anomaly in anomalies_found.items()},
+			{key: normal['info'] for key, normal in normals_found.items()})
+
+
+class Snapshot:
+
+	def __init__(self, version=0, load=None, pods=None, anomalies_found=None, normals_found=None, memory=None):
+		self.version = version
+		self.load_version = version
+		self.anomalies_version = version
+		# Result of query_load
+		self.load = load or {'pods': [], 'anomalies': [], 'samples': {'ref': 0, 'total': 0}}
+		# Pod name -> full name and suspected anomalies
+		self.pods = pods or {}
+		self.anomalies_found = anomalies_found or {}
+		self.normals_found = normals_found or {}
+		self.found = found_state(self.anomalies_found, self.normals_found)
+		# Pod name -> metrics count, memory footprint taken with it and the time it was taken
+		self.memory = memory or {}
+
+	# Memory footprint of the pod taken by the last publish, see MEMORY_PERIOD
+	def memory_footprint(self, name):
+		return self.memory.get(name, (None, 0, 0))[1]
+
+	# Returns the snapshot of the current state, or this one if nothing has changed
+	def publish(self, series_count, pods, anomalies_found, normals_found):
+		memory = {}
+		now = time.monotonic()
+		for pod in pods:
+			# Memory footprint walks all the results of the pod, so it is taken again only when the metrics change
+			# or once in MEMORY_PERIOD
+			metrics_count, size, taken = self.memory.get(pod.name, (None, 0, 0))
+			if metrics_count != pod.metrics_count or now - taken >= MEMORY_PERIOD:
+				size, taken = pod.memory_footprint(), now
+			memory[pod.name] = (pod.metrics_count, size, taken)
+		load = {
+			'pods': [{'name': p.full_name, 'ordinary': p.anomaly_maxed, 'ml_confirmed': p.anomaly_ml, 'memory': memory[p.name][1]} for p in pods],
+			'anomalies': [{'name': p.full_name, 'ordinary': p.anomaly_maxed, 'ml_confirmed': p.anomaly_ml} for p in pods if 0 < p.anomaly_maxed],
+			'samples': {'ref': 0, 'total': series_count},
+		}
+		pods_state = {p.name: (p.full_name, frozenset(p.suspected_anomalies)) for p in pods}
+		load_changed = load != self.load
+		anomalies_changed = pods_state != self.pods or found_state(anomalies_found, normals_found) != self.found
+		if not load_changed and not anomalies_changed:
+			# Only the times of the footprints taken again are new, queries do not read them
+			self.memory = memory
+			return self
+		if not anomalies_changed:
+			# Clients which have the anomalies of this version get exactly the same ones
+			anomalies_found, normals_found = self.anomalies_found, self.normals_found
+		snapshot = Snapshot(self.version + 1, load, pods_state, anomalies_found, normals_found, memory)
+		if not load_changed:
+			snapshot.load_version = self.load_version
+		if not anomalies_changed:
+			snapshot.anomalies_version = self.anomalies_version
+		return snapshot
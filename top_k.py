@@ -0,0 +1,24 @@
+# Selection of the k largest values, shared by the monitor screen and the offline tools.
+# Only values greater than the floor are taken, the largest come first and equal values keep
+# the order of the input, which is what the former insertion into a list of k placeholders gave.
+
+import heapq
+
+import numpy as np
+
+
+# Returns up to num (item, value) pairs with the largest key(item) values
+def top_k(items, num, key, floor=-1):
+	pairs = ((item, key(item)) for item in items)
+	pairs = [(item, value) for item, value in pairs if value is not None and value > floor]
+	return heapq.nlargest(num, pairs, key=lambda pair: pair[1])
+
+# Returns indices of up to num largest values of the array
+def top_k_indices(values, num, floor=-1):
+	indices = np.flatnonzero(values > floor)
+	if len(indices) > num > 0:
+		# Everything equal to the num-th largest value is kept so that ties are resolved by position below
+		kth = np.partition(values[indices], len(indices) - num)[len(indices) - num]
+		indices = indices[values[indices] >= kth]
+	order = np.argsort(-values[indices], kind='stable')
+	return indices[order[:max(num, 0)]]